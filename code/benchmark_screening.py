@@ -0,0 +1,370 @@
+"""
+Benchmarks for the demand screening filters
+
+Times the array implementations in screening.py against the original row-by-row
+implementations kept in screening_reference.py, and checks that both give the
+same results. Also times IncrementalScreener.append after histories of different
+lengths, times every stage of the screening on synthetic series from
+synthetic_demand.py and reports the precision of each screening category and the
+recall of each type of injected anomaly. Run from the code directory:
+
+    python benchmark_screening.py
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+import screening
+import screening_reference
+import synthetic_demand
+
+# parameters used by Ruggles et al. for the EIA demand data
+PARAMS = {'short_hour_window': 24,
+          'iqr_hours': 120,
+          'nDays': 10,
+          'global_dem_cut': 10,
+          'local_dem_cut_up': 3.5,
+          'local_dem_cut_down': 2.5,
+          'delta_multiplier': 2,
+          'delta_single_multiplier': 5,
+          'rel_multiplier': 15,
+          'anomalous_regions_width': 24,
+          'anomalous_pct': 0.85}
+
+
+def synthetic_series(n_hours=8760, seed=0):
+    """
+    Creates one synthetic demand series with injected anomalies, on a positional index as used by screening_reference
+    """
+    demand, _ = synthetic_demand.generate_demand(n_hours, n_series=1, seed=seed)
+    return demand.reset_index(drop=True).rename(columns={'demand_0': 'demand'})
+
+
+def screening_stages(value_column, params=PARAMS):
+    """
+    Lists the stages of screen_anomolies in the order they are run, as (name, function) pairs.
+    Each function takes the working dataframe and a `context` dict, which carries the global
+    IQR_{r} from the stage that calculates it to the single-sided delta filter.
+    """
+    def add_categories(df, context):
+        df = screening.add_categories(df, value_column)
+        return df.assign(missing=df[value_column].isna())
+
+    def calculate_iqr(df, context):
+        context['iqr_relative_deltas'] = screening.calculate_relative_demand_difference_IQR(df)
+        return df
+
+    return [
+        ('add_categories', add_categories),
+        ('filter_neg_and_zeros', lambda df, context: screening.filter_neg_and_zeros(df, value_column)),
+        ('filter_runs', lambda df, context: screening.filter_runs(df, value_column)),
+        ('filter_extrem_demand',
+         lambda df, context: screening.filter_extrem_demand(df, params['global_dem_cut'], value_column)),
+        ('filter_global_plus_minus_one', lambda df, context: screening.filter_global_plus_minus_one(df, value_column)),
+        ('add_rolling_dem',
+         lambda df, context: screening.add_rolling_dem(df, params['short_hour_window'], value_column)),
+        ('add_rolling_dem_long', lambda df, context: screening.add_rolling_dem_long(df, params['nDays'], value_column)),
+        ('add_demand_minus_rolling_dem', lambda df, context: screening.add_demand_minus_rolling_dem(df, value_column)),
+        ('add_demand_minus_rolling_dem_iqr',
+         lambda df, context: screening.add_demand_minus_rolling_dem_iqr(df, params['iqr_hours'])),
+        ('add_deltas', lambda df, context: screening.add_deltas(df, value_column)),
+        ('add_rolling_delta_iqr', lambda df, context: screening.add_rolling_delta_iqr(df, params['iqr_hours'])),
+        ('add_hourly_median_dem_deviations',
+         lambda df, context: screening.add_hourly_median_dem_deviations(df, params['nDays'])),
+        ('add_demand_rel_diff_wrt_hourly',
+         lambda df, context: screening.add_demand_rel_diff_wrt_hourly(df, value_column)),
+        ('add_delta_demand_rel_diff_wrt_hourly',
+         lambda df, context: screening.add_delta_demand_rel_diff_wrt_hourly(df)),
+        ('calculate_relative_demand_difference_IQR', calculate_iqr),
+        ('filter_local_demand',
+         lambda df, context: screening.filter_local_demand(df, params['local_dem_cut_up'],
+                                                           params['local_dem_cut_down'], value_column)),
+        ('filter_deltas', lambda df, context: screening.filter_deltas(df, params['delta_multiplier'], value_column)),
+        ('filter_single_sided_deltas',
+         lambda df, context: screening.filter_single_sided_deltas(df, params['delta_single_multiplier'],
+                                                                  params['rel_multiplier'],
+                                                                  context['iqr_relative_deltas'], value_column)),
+        ('filter_anomalous_regions',
+         lambda df, context: screening.filter_anomalous_regions(df, params['anomalous_regions_width'],
+                                                                params['anomalous_pct'], value_column)),
+    ]
+
+
+def run_stages(data, value_column, params=PARAMS, stop_before=None):
+    """
+    Runs the stages of screen_anomolies on a copy of data, timing each one
+    Args:
+        stop_before: name of the stage at which to stop, or None to run all stages
+    Returns:
+        df: the working dataframe after the last stage that was run
+        context: dict of values passed between stages
+        timings: dict of the wall time in seconds of each stage
+    """
+    df = data.copy()
+    context = {}
+    timings = {}
+    for name, stage in screening_stages(value_column, params):
+        if name == stop_before:
+            break
+        start = time.perf_counter()
+        df = stage(df, context)
+        timings[name] = time.perf_counter() - start
+    return df, context, timings
+
+
+def prepare_single_delta_input(data, value_column, params=PARAMS):
+    """
+    Runs the screening steps that precede the single-sided delta filter, in the same order as screen_anomolies
+    """
+    df, context, _ = run_stages(data, value_column, params, stop_before='filter_single_sided_deltas')
+    return df, context['iqr_relative_deltas']
+
+
+def time_call(func, *args, repeat=3):
+    """
+    Returns the best wall time in seconds of `repeat` calls, and the result of the last call
+    """
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def with_labels(df):
+    """
+    Returns a copy of a frame screened with category codes, with category labels as used by screening_reference
+    """
+    df = df.copy()
+    df['category'] = screening.category_labels(df['category'])
+    return df
+
+
+def frames_match(left, right, columns):
+    """
+    Checks that the listed columns are identical in both frames, treating NaN == NaN
+    """
+    for col in columns:
+        if not left[col].equals(right[col]):
+            # float columns can differ in dtype but not in value
+            if not np.array_equal(left[col].to_numpy(), right[col].to_numpy(), equal_nan=True):
+                return False
+    return True
+
+
+def benchmark_single_sided_deltas(n_hours=8760, seed=0, value_column='demand', params=PARAMS):
+    df, iqr_relative_deltas = prepare_single_delta_input(synthetic_series(n_hours, seed), value_column, params)
+    args = (params['delta_single_multiplier'], params['rel_multiplier'], iqr_relative_deltas, value_column)
+
+    # run once so that the numba kernel is compiled before timing
+    screening.filter_single_sided_deltas(df.copy(), *args)
+
+    old_time, old = time_call(lambda: screening_reference.filter_single_sided_deltas(with_labels(df), *args),
+                              repeat=1)
+    new_time, new = time_call(lambda: screening.filter_single_sided_deltas(df.copy(), *args))
+    new = with_labels(new)
+
+    columns = [value_column, 'category', 'deltaSingleFilteredFwd', 'deltaSingleFilteredBkw']
+    return {'stage': 'filter_single_sided_deltas',
+            'n_hours': n_hours,
+            'reference_s': old_time,
+            'array_s': new_time,
+            'speedup': old_time / new_time,
+            'identical': frames_match(old, new, columns)}
+
+
+def benchmark_anomalous_regions(n_hours=8760, seed=0, value_column='demand', params=PARAMS):
+    df, iqr_relative_deltas = prepare_single_delta_input(synthetic_series(n_hours, seed), value_column, params)
+    df = screening.filter_single_sided_deltas(df, params['delta_single_multiplier'], params['rel_multiplier'],
+                                              iqr_relative_deltas, value_column)
+    args = (params['anomalous_regions_width'], params['anomalous_pct'], value_column)
+
+    old_time, old = time_call(lambda: screening_reference.filter_anomalous_regions(with_labels(df), *args),
+                              repeat=1)
+    new_time, new = time_call(lambda: screening.filter_anomalous_regions(df.copy(), *args))
+    new = with_labels(new)
+
+    columns = [value_column, 'category', 'len_good_data', 'anomalousRegionsFiltered']
+    return {'stage': 'filter_anomalous_regions',
+            'n_hours': n_hours,
+            'reference_s': old_time,
+            'array_s': new_time,
+            'speedup': old_time / new_time,
+            'identical': frames_match(old, new, columns)}
+
+
+def benchmark_hourly_median_dem_deviations(n_hours=8760, seed=0, value_column='demand', params=PARAMS):
+    df = synthetic_series(n_hours, seed)
+    df = screening.add_rolling_dem(df, params['short_hour_window'], value_column)
+    df = screening.add_rolling_dem_long(df, params['nDays'], value_column)
+    df = screening.add_demand_minus_rolling_dem(df, value_column)
+
+    old_time, old = time_call(lambda: screening_reference.add_hourly_median_dem_deviations(df.copy(), params['nDays']))
+    new_time, new = time_call(lambda: screening.add_hourly_median_dem_deviations(df.copy(), params['nDays']))
+
+    columns = ['vals_dem_minus_rolling', 'hourly_median_dem_dev']
+    return {'stage': 'add_hourly_median_dem_deviations',
+            'n_hours': n_hours,
+            'reference_s': old_time,
+            'array_s': new_time,
+            'speedup': old_time / new_time,
+            'identical': frames_match(old, new, columns)}
+
+
+def benchmark_rolling_characteristics(n_hours=8760, seed=0, value_column='demand', params=PARAMS):
+    """
+    Times the four rolling median and IQR helpers together
+    """
+    df = synthetic_series(n_hours, seed)
+    df = screening.add_deltas(df, value_column)
+
+    def run(module):
+        out = module.add_rolling_dem(df.copy(), params['short_hour_window'], value_column)
+        out = module.add_rolling_dem_long(out, params['nDays'], value_column)
+        out = screening.add_demand_minus_rolling_dem(out, value_column)
+        out = module.add_demand_minus_rolling_dem_iqr(out, params['iqr_hours'])
+        out = module.add_rolling_delta_iqr(out, params['iqr_hours'])
+        return out
+
+    # run once so that the numba kernel is compiled before timing
+    run(screening)
+
+    old_time, old = time_call(lambda: run(screening_reference))
+    new_time, new = time_call(lambda: run(screening))
+
+    columns = ['rollingDem', 'rollingDemLong', 'dem_minus_rolling_IQR', 'delta_rolling_IQR']
+    return {'stage': 'rolling medians and IQRs',
+            'n_hours': n_hours,
+            'reference_s': old_time,
+            'array_s': new_time,
+            'speedup': old_time / new_time,
+            'identical': frames_match(old, new, columns)}
+
+
+def benchmark_incremental_append(history_years=(1, 2, 4, 8), n_days=14, seed=0, value_column='demand',
+                                 params=PARAMS):
+    """
+    Times IncrementalScreener.append for one day of data after histories of different lengths, which should
+    not grow with the length of the history, and checks the result against screen_anomolies on the whole series
+    """
+    demand, _ = synthetic_demand.generate_demand((max(history_years) * 365 + n_days) * 24, n_series=1, seed=seed)
+    data = demand.rename(columns={'demand_0': value_column})
+
+    rows = []
+    for years in history_years:
+        n_history = years * 365 * 24
+        screener = screening.IncrementalScreener(value_column, compact=True, **params)
+        screener.append(data.iloc[:n_history])
+        seconds = []
+        for day in range(n_days):
+            start = n_history + day * 24
+            append_time, _ = time_call(screener.append, data.iloc[start:start + 24], repeat=1)
+            seconds.append(append_time)
+
+        n_hours = n_history + n_days * 24
+        full = screening.screen_anomolies(data.iloc[:n_hours], value_column, compact=True, **params)
+        rows.append({'stage': 'IncrementalScreener.append (one day)',
+                     'n_hours': n_history,
+                     'median_s': np.median(seconds),
+                     'max_s': np.max(seconds),
+                     'identical': frames_match(screener.result, full, [value_column, 'category'])})
+    return rows
+
+
+def precision_by_category(categories, anomalies):
+    """
+    Share of the hours assigned to each screening category that had an injected anomaly
+    Args:
+        categories: array of category labels assigned by the screening
+        anomalies: array of injected anomaly types, '' for hours that were not changed
+    Returns:
+        dataframe with the number of hours flagged with each category, how many of those had an anomaly, and precision
+    """
+    df = pd.DataFrame({'category': np.ravel(categories), 'anomalous': np.ravel(anomalies) != ''})
+    df = df[~df['category'].isin(['OKAY', 'MISSING'])]
+    result = df.groupby('category')['anomalous'].agg(['count', 'sum']).rename(
+        columns={'count': 'flagged_hours', 'sum': 'true_positives'})
+    result['precision'] = result['true_positives'] / result['flagged_hours']
+    return result
+
+
+def recall_by_anomaly(categories, anomalies):
+    """
+    Share of the hours with each type of injected anomaly that were flagged, by any filter and by the filters
+    meant to catch that type (see synthetic_demand.EXPECTED_CATEGORIES)
+    Args:
+        categories: array of category labels assigned by the screening
+        anomalies: array of injected anomaly types, '' for hours that were not changed
+    Returns:
+        dataframe with the number of injected hours and the recall for each anomaly type
+    """
+    categories = np.ravel(categories)
+    anomalies = np.ravel(anomalies)
+    flagged = ~np.isin(categories, ['OKAY', 'MISSING'])
+    rows = []
+    for anomaly_type, expected in synthetic_demand.EXPECTED_CATEGORIES.items():
+        injected = anomalies == anomaly_type
+        n_injected = injected.sum()
+        rows.append({'anomaly': anomaly_type,
+                     'injected_hours': n_injected,
+                     'recall': (flagged & injected).sum() / n_injected if n_injected else np.nan,
+                     'recall_expected_category': (np.isin(categories, expected) & injected).sum() / n_injected
+                     if n_injected else np.nan})
+    return pd.DataFrame(rows).set_index('anomaly')
+
+
+def benchmark_stages(n_hours_list=(8760, 4 * 8760), n_series_list=(1, 10), params=PARAMS, seed=0):
+    """
+    Times every stage of screen_anomolies on synthetic series of different lengths and numbers of series,
+    and scores the detection of the injected anomalies
+    Returns:
+        timings: tidy dataframe of the total wall time of each stage, for each length and number of series
+        precision: precision by category, over all the series that were screened
+        recall: recall by anomaly type, over all the series that were screened
+    """
+    # run once so that the numba kernels are compiled before timing
+    run_stages(synthetic_series(500, seed), 'demand', params)
+
+    timings = []
+    categories = []
+    anomalies = []
+    for n_hours in n_hours_list:
+        for n_series in n_series_list:
+            demand, injected = synthetic_demand.generate_demand(n_hours, n_series=n_series, seed=seed)
+            totals = {}
+            for column in demand.columns:
+                df, _, stage_timings = run_stages(demand[[column]].reset_index(drop=True), column, params)
+                for stage, seconds in stage_timings.items():
+                    totals[stage] = totals.get(stage, 0.) + seconds
+                categories.append(screening.category_labels(df['category']))
+                anomalies.append(injected[column].to_numpy())
+            timings += [{'n_hours': n_hours, 'n_series': n_series, 'stage': stage, 'seconds': seconds}
+                        for stage, seconds in totals.items()]
+
+    categories = np.concatenate(categories)
+    anomalies = np.concatenate(anomalies)
+    return pd.DataFrame(timings), precision_by_category(categories, anomalies), recall_by_anomaly(categories, anomalies)
+
+
+if __name__ == '__main__':
+    results = pd.DataFrame([benchmark(n_hours)
+                            for benchmark in [benchmark_single_sided_deltas, benchmark_anomalous_regions,
+                                              benchmark_hourly_median_dem_deviations,
+                                              benchmark_rolling_characteristics]
+                            for n_hours in [8760, 2 * 8760]])
+    print(results.to_string(index=False))
+
+    print()
+    print(pd.DataFrame(benchmark_incremental_append()).to_string(index=False))
+
+    timings, precision, recall = benchmark_stages()
+    print()
+    table = timings.pivot_table(index='stage', columns=['n_hours', 'n_series'], values='seconds')
+    print(table.reindex(timings['stage'].unique()).to_string(float_format='{:.4f}'.format))
+    print()
+    print(precision.to_string(float_format='{:.3f}'.format))
+    print()
+    print(recall.to_string(float_format='{:.3f}'.format))
@@ -0,0 +1,334 @@
+"""
+Precomputed index of the per-building accounting bias, with a local HTTP/JSON service for summary queries
+
+build_bias_index writes the percent errors of notebook 7 (or of inventory.stream_inventories) to a compact
+store in INDEX_DIR:
+    errors.npy: float32 array with the percent error of each building and resolution
+    keys.npy: int16 array with one column of category codes per KEY_COLUMNS, with the rows sorted by key
+    index.json: the categories of each key column
+
+BiasIndex loads the store and precomputes the summary (median, IQR and range) of every combination of key values,
+including 'all' for any of them, so that a query is a dictionary lookup. Queries for several values of a key are
+summarized from the rows they select. To start the service on http://127.0.0.1:8050, run from the code directory:
+
+    python bias_index.py
+
+and query it with, for example:
+
+    http://127.0.0.1:8050/summary?location=CISO&building_category=SmallOffice&resolution=annual
+    http://127.0.0.1:8050/summary?location=CISO,BANC&building_sector=Residential
+    http://127.0.0.1:8050/keys
+"""
+
+import itertools
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import pandas as pd
+
+import demand_store
+
+
+# directory of the bias index
+INDEX_DIR = '../data/processed/bias_index'
+
+# columns that queries can filter on, in the order the rows are sorted by
+KEY_COLUMNS = ['resolution', 'location', 'building_sector', 'building_category', 'climate_zone']
+
+# building categories of the residential sector. All other categories are commercial. Notebook 6 gives the
+# ResStock buildings the categories of its res_building_categories, and load_data.load_nrel_eulp_data names the
+# buildings of a single weather station {climate_zone}_Residential_{building_name}_{building_id}. The building
+# names don't record the sector itself, so it is taken from the category
+RESIDENTIAL_CATEGORIES = ['MobileHome', 'SingleFamily', 'SmallMultifamily', 'MediumMultifamily', 'LargeMultifamily',
+                          'Residential']
+
+# resolution that is summarized if a query doesn't specify one
+DEFAULT_RESOLUTION = 'annual'
+
+# statistics in each summary, in percent
+SUMMARY_STATISTICS = ['n', 'median', 'q25', 'q75', 'iqr', 'min', 'max', 'mean']
+
+
+def percent_error_long(table):
+    """
+    Converts percent error results to the long format of notebook 7, with one row per building and resolution
+    Args:
+        table: one of
+            - the long percent_error of notebook 7, with 'resolution' and 'error' (in percent) columns
+            - the wide percent_error_wide of notebook 7, with one column of errors (in percent) per resolution
+            - a per-building inventory table (see inventory.inventory_table), with error_{resolution} columns
+              as fractions
+        Missing climate_zone and building_category columns are parsed from building_type, and a missing
+        building_sector from building_category
+    Returns:
+        percent_error: dataframe with the KEY_COLUMNS and the 'error' in percent, without missing errors
+    """
+    table = table.copy()
+    if 'error' not in table.columns:
+        error_columns = [column for column in table.columns if str(column).startswith('error_')]
+        if error_columns:
+            table = table.drop(columns=[column[len('error_'):] for column in error_columns], errors='ignore')
+            table = table.rename(columns={column: column[len('error_'):] for column in error_columns})
+            resolutions = [column[len('error_'):] for column in error_columns]
+            scale = 100
+        else:
+            resolutions = [resolution for resolution in ['monthly', 'monthhourly', 'annual']
+                           if resolution in table.columns]
+            scale = 1
+        if not resolutions:
+            raise ValueError('the table has no percent error columns')
+        id_columns = [column for column in table.columns if column not in resolutions]
+        table = table.melt(id_vars=id_columns, value_vars=resolutions, var_name='resolution', value_name='error')
+        table['error'] = table['error'] * scale
+
+    if ('climate_zone' not in table.columns or 'building_category' not in table.columns) \
+            and 'building_type' in table.columns:
+        metadata = demand_store.building_metadata(table['building_type'])
+        for column in ['climate_zone', 'building_category']:
+            if column not in table.columns:
+                table[column] = metadata[column].to_numpy()
+    if 'building_sector' not in table.columns and 'building_category' in table.columns:
+        table['building_sector'] = np.where(table['building_category'].isin(RESIDENTIAL_CATEGORIES),
+                                            'Residential', 'Commercial')
+
+    missing = [column for column in KEY_COLUMNS if column not in table.columns]
+    if missing:
+        raise ValueError(f'the table has no {missing} columns')
+    return table[KEY_COLUMNS + ['error']].dropna(subset=['error'])
+
+
+def build_bias_index(percent_error, index_dir=INDEX_DIR):
+    """
+    Writes the percent errors to the bias index
+    Args:
+        percent_error: percent error results in any format accepted by percent_error_long
+        index_dir: directory of the index
+    """
+    percent_error = percent_error_long(percent_error)
+    categories = {}
+    codes = np.empty((len(percent_error.index), len(KEY_COLUMNS)), dtype=np.int16)
+    for i, column in enumerate(KEY_COLUMNS):
+        values = percent_error[column].astype(str)
+        column_codes, uniques = pd.factorize(values, sort=True)
+        if len(uniques) > np.iinfo(np.int16).max:
+            raise ValueError(f'{column} has too many categories for the index')
+        codes[:, i] = column_codes
+        categories[column] = list(uniques)
+
+    order = np.lexsort(codes.T[::-1])
+    codes = np.ascontiguousarray(codes[order])
+    errors = percent_error['error'].to_numpy(dtype=np.float32)[order]
+
+    os.makedirs(index_dir, exist_ok=True)
+    # write to temporary files first, so that a failed build does not leave a partial index
+    np.save(f'{index_dir}/errors.tmp.npy', errors)
+    np.save(f'{index_dir}/keys.tmp.npy', codes)
+    with open(f'{index_dir}/index.tmp.json', 'w') as f:
+        json.dump({'key_columns': KEY_COLUMNS, 'n_rows': len(errors), 'categories': categories}, f)
+    os.replace(f'{index_dir}/errors.tmp.npy', f'{index_dir}/errors.npy')
+    os.replace(f'{index_dir}/keys.tmp.npy', f'{index_dir}/keys.npy')
+    os.replace(f'{index_dir}/index.tmp.json', f'{index_dir}/index.json')
+
+
+def summarize(errors):
+    """
+    Summarizes an array of percent errors
+    Returns:
+        summary: dict with the SUMMARY_STATISTICS, which are None if there are no errors
+    """
+    if len(errors) == 0:
+        return {'n': 0, **{statistic: None for statistic in SUMMARY_STATISTICS[1:]}}
+    errors = errors.astype(np.float64)
+    q25, median, q75 = np.percentile(errors, [25, 50, 75])
+    return {'n': len(errors), 'median': median, 'q25': q25, 'q75': q75, 'iqr': q75 - q25,
+            'min': errors.min(), 'max': errors.max(), 'mean': errors.mean()}
+
+
+class BiasIndex:
+    """
+    In-memory bias index, with the summary of every combination of key values precomputed
+
+    Usage:
+        index = BiasIndex()
+        index.summary(location='CISO', building_category='SmallOffice', resolution='annual')
+    """
+
+    def __init__(self, index_dir=INDEX_DIR):
+        with open(f'{index_dir}/index.json') as f:
+            metadata = json.load(f)
+        self.key_columns = metadata['key_columns']
+        self.categories = metadata['categories']
+        self.errors = np.load(f'{index_dir}/errors.npy')
+        self.codes = np.load(f'{index_dir}/keys.npy')
+        self.positions = {column: {value: code for code, value in enumerate(self.categories[column])}
+                          for column in self.key_columns}
+        self.summaries = self._precompute_summaries()
+
+    def _precompute_summaries(self):
+        """
+        Summarizes the errors for every combination of key values, where each key other than the resolution
+        can also be -1 for all values
+        Returns:
+            summaries: dict of summaries keyed by a tuple with the code of each key column
+        """
+        frame = pd.DataFrame(self.codes.astype(np.int64), columns=self.key_columns)
+        frame['error'] = self.errors.astype(np.float64)
+        filter_columns = self.key_columns[1:]
+
+        summaries = {}
+        for n_grouped in range(len(filter_columns) + 1):
+            for grouped in itertools.combinations(filter_columns, n_grouped):
+                group_columns = [self.key_columns[0]] + list(grouped)
+                groups = frame.groupby(group_columns, sort=False)['error']
+                stats = groups.agg(['count', 'median', 'min', 'max', 'mean'])
+                stats['q25'] = groups.quantile(0.25)
+                stats['q75'] = groups.quantile(0.75)
+                stats['iqr'] = stats['q75'] - stats['q25']
+                stats = stats.rename(columns={'count': 'n'})[SUMMARY_STATISTICS]
+
+                positions = [self.key_columns.index(column) for column in group_columns]
+                for group, row in zip(stats.index, stats.itertuples(index=False)):
+                    key = [-1] * len(self.key_columns)
+                    for position, code in zip(positions, group if isinstance(group, tuple) else (group,)):
+                        key[position] = code
+                    summary = dict(zip(SUMMARY_STATISTICS, row))
+                    summary['n'] = int(summary['n'])
+                    summaries[tuple(key)] = summary
+        return summaries
+
+    def _codes(self, column, values):
+        """
+        Returns the codes of a list of values of a key column, skipping values that are not in the index
+        """
+        if column not in self.positions:
+            raise ValueError(f'unknown key {column}, expected one of {self.key_columns}')
+        return [self.positions[column][value] for value in values if value in self.positions[column]]
+
+    def _filters(self, filters):
+        """
+        Normalizes query filters to a dict of lists of values, with the default resolution if there is none
+        """
+        filters = {column: [values] if isinstance(values, str) else list(values)
+                   for column, values in filters.items() if values is not None}
+        filters.setdefault(self.key_columns[0], [DEFAULT_RESOLUTION])
+        return filters
+
+    def mask(self, **filters):
+        """
+        Selects the rows of the index that match the filters
+        Args:
+            filters: key column names with a value or list of values to keep
+        Returns:
+            mask: boolean array with one value per row
+        """
+        mask = np.ones(len(self.errors), dtype=bool)
+        for column, values in self._filters(filters).items():
+            mask &= np.isin(self.codes[:, self.key_columns.index(column)], self._codes(column, values))
+        return mask
+
+    def values(self, **filters):
+        """
+        Returns the percent errors of the rows that match the filters, see mask
+        """
+        return self.errors[self.mask(**filters)]
+
+    def summary(self, **filters):
+        """
+        Summarizes the percent errors of the buildings that match the filters
+        Args:
+            filters: key column names with a value or list of values to keep. Keys that are not given match all
+                values, except the resolution, which defaults to DEFAULT_RESOLUTION
+        Returns:
+            summary: dict with the SUMMARY_STATISTICS, in percent
+        """
+        filters = self._filters(filters)
+        if all(len(values) == 1 for values in filters.values()):
+            key = [-1] * len(self.key_columns)
+            for column, values in filters.items():
+                codes = self._codes(column, values)
+                if not codes:
+                    return summarize(np.array([]))
+                key[self.key_columns.index(column)] = codes[0]
+            return self.summaries.get(tuple(key), summarize(np.array([])))
+        return summarize(self.values(**filters))
+
+    def keys(self):
+        """
+        Returns the values of each key column in the index
+        """
+        return {column: list(values) for column, values in self.categories.items()}
+
+
+def _json_value(value):
+    """
+    Converts numpy numbers and NaN to values that json can encode
+    """
+    if isinstance(value, (np.integer, int)):
+        return int(value)
+    if value is None or np.isnan(value):
+        return None
+    return float(value)
+
+
+def make_handler(index):
+    """
+    Creates a request handler class that answers queries from a BiasIndex
+    """
+
+    class BiasIndexHandler(BaseHTTPRequestHandler):
+
+        def _respond(self, status, body):
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/keys':
+                self._respond(200, index.keys())
+            elif url.path == '/summary':
+                # each parameter is a comma-separated list of values
+                filters = {column: ','.join(values).split(',') for column, values in parse_qs(url.query).items()}
+                try:
+                    summary = index.summary(**filters)
+                except ValueError as e:
+                    self._respond(400, {'error': str(e)})
+                    return
+                self._respond(200, {'filters': index._filters(filters),
+                                    **{statistic: _json_value(value) for statistic, value in summary.items()}})
+            else:
+                self._respond(404, {'error': f'unknown path {url.path}, expected /summary or /keys'})
+
+        def log_message(self, format, *args):
+            # don't write every request to stderr
+            pass
+
+    return BiasIndexHandler
+
+
+def serve(index_dir=INDEX_DIR, host='127.0.0.1', port=8050):
+    """
+    Serves queries of the bias index over HTTP until interrupted
+    Args:
+        index_dir: directory of the index
+        host: address to listen on. The default only accepts local connections
+        port: port to listen on
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(BiasIndex(index_dir)))
+    print(f'Serving the bias index on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    serve()
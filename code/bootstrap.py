@@ -0,0 +1,160 @@
+"""
+Bootstrap confidence intervals for the accounting bias of average emission factors
+
+The percent error of each building only depends on its inventory totals at each resolution, so the bootstrap
+resamples the rows of the per-building inventory table (see inventory.inventory_table) instead of recalculating
+any inventories. The resamples of each group are drawn as arrays of building indices, a block at a time.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import demand_store
+from inventory import AVERAGE_RESOLUTIONS
+
+# statistics of the percent errors of a group of buildings that can be bootstrapped
+#   median: median percent error of the buildings
+#   mean: mean percent error of the buildings
+#   aggregate: percent error of the summed inventories of the buildings
+STATISTICS = ['median', 'mean', 'aggregate']
+
+
+def _statistic(values, statistic):
+    """
+    Calculates the statistic for each resample
+    Args:
+        values: array of resamples x buildings x resolutions. For the 'aggregate' statistic, the first
+            resolution is the hourly inventory and the others are the inventories to compare with it
+        statistic: one of STATISTICS
+    Returns:
+        array of resamples x resolutions
+    """
+    if statistic == 'median':
+        return np.median(values, axis=1)
+    if statistic == 'mean':
+        return values.mean(axis=1)
+    totals = values.sum(axis=1)
+    return (totals[:, 1:] - totals[:, :1]) / totals[:, :1]
+
+
+def _weighted_statistic(values, weights, statistic):
+    """
+    Calculates the statistic of a group of buildings with their weights, as the estimate that the
+    resamples are drawn around
+    Args:
+        values: array of buildings x resolutions, as for _statistic
+        weights: weight of each building
+        statistic: one of STATISTICS
+    Returns:
+        array with the statistic for each resolution
+    """
+    if (weights == weights[0]).all():
+        return _statistic(values[np.newaxis], statistic)[0]
+    if statistic == 'median':
+        # weighted median: the first value at which the sorted cumulative weight reaches half of the total
+        order = np.argsort(values, axis=0)
+        cumulative_weights = np.cumsum(weights[order], axis=0)
+        position = (cumulative_weights < cumulative_weights[-1] / 2).sum(axis=0)
+        columns = np.arange(values.shape[1])
+        return values[order[position, columns], columns]
+    if statistic == 'mean':
+        return np.average(values, axis=0, weights=weights)
+    totals = (values * weights[:, np.newaxis]).sum(axis=0)
+    return (totals[1:] - totals[:1]) / totals[:1]
+
+
+def _bootstrap_group(values, weights, statistic, n_resamples, quantiles, resamples_per_block, seed):
+    """
+    Bootstraps the statistic for one group of buildings. Used as the task run for each group in bootstrap_bias.
+    Returns:
+        estimate: the statistic for the group itself, for each resolution
+        intervals: array of len(quantiles) x resolutions with the quantiles of the resampled statistic
+    """
+    rng = np.random.default_rng(seed)
+    n_buildings = values.shape[0]
+    # buildings are drawn with probabilities proportional to their weights
+    cumulative_weights = np.cumsum(weights)
+
+    resampled = np.empty((n_resamples, values.shape[1] - (statistic == 'aggregate')))
+    for start in range(0, n_resamples, resamples_per_block):
+        n_block = min(resamples_per_block, n_resamples - start)
+        draws = rng.random((n_block, n_buildings)) * cumulative_weights[-1]
+        indices = np.minimum(np.searchsorted(cumulative_weights, draws, side='right'), n_buildings - 1)
+        resampled[start:start + n_block] = _statistic(values[indices], statistic)
+
+    return _weighted_statistic(values, weights, statistic), np.quantile(resampled, quantiles, axis=0)
+
+
+def bootstrap_bias(table, group_columns=('location', 'building_category'), resolutions=AVERAGE_RESOLUTIONS,
+                   statistic='median', weight_column=None, n_resamples=2000, confidence=0.95, seed=None,
+                   n_workers=1, resamples_per_block=250):
+    """
+    Bootstraps confidence intervals of the percent error of each average resolution, for each group of buildings
+    Args:
+        table: per-building inventory table, as returned by inventory.inventory_table or stream_inventories, with
+            the inventory at each resolution and the percent errors as error_{resolution}. If a
+            building_category column is needed for grouping but missing, it is parsed from building_type
+        group_columns: columns of table to group the buildings by, such as BA and building category
+        resolutions: average resolutions to compare with the hourly inventory
+        statistic: statistic of the percent errors of each group, one of STATISTICS
+        weight_column: column of table with the weight of each building (such as customer_count or
+            scaling_factor). Buildings are resampled with probabilities proportional to their weights.
+            All buildings have the same weight if None
+        n_resamples: number of bootstrap resamples of each group
+        confidence: confidence level of the intervals
+        seed: seed for the random number generator. Each group gets its own stream, so the results
+            do not depend on n_workers
+        n_workers: number of worker processes to spread the groups over. If 1, runs in the current process
+        resamples_per_block: number of resamples drawn at once, which bounds the memory of each group
+    Returns:
+        intervals: tidy dataframe with one row per group and resolution, with the number of buildings, the
+            statistic of the group ('estimate') and the bounds of the confidence interval ('ci_lower',
+            'ci_upper'), as fractions
+    """
+    if statistic not in STATISTICS:
+        raise ValueError(f'unknown statistic {statistic}, expected one of {STATISTICS}')
+    group_columns = list(group_columns)
+    resolutions = list(resolutions)
+
+    if 'building_category' in group_columns and 'building_category' not in table.columns:
+        table = table.assign(building_category=demand_store.building_metadata(
+            table['building_type'])['building_category'].to_numpy())
+
+    if statistic == 'aggregate':
+        value_columns = ['hourly'] + resolutions
+    else:
+        value_columns = [f'error_{resolution}' for resolution in resolutions]
+    # buildings without a percent error (no hourly emissions) or weight can't be resampled
+    table = table.dropna(subset=value_columns + ([weight_column] if weight_column else []))
+    if weight_column is not None:
+        table = table[table[weight_column] > 0]
+
+    groups = []
+    tasks = []
+    for group, group_table in table.groupby(group_columns, sort=True):
+        groups.append((group if isinstance(group, tuple) else (group,)) + (len(group_table.index),))
+        weights = (np.ones(len(group_table.index)) if weight_column is None
+                   else group_table[weight_column].to_numpy(dtype=np.float64))
+        tasks.append((group_table[value_columns].to_numpy(dtype=np.float64), weights))
+
+    alpha = 1 - confidence
+    quantiles = [alpha / 2, 1 - alpha / 2]
+    seeds = np.random.SeedSequence(seed).spawn(len(tasks))
+    n_tasks = len(tasks)
+    task_args = ([values for values, _ in tasks], [weights for _, weights in tasks], [statistic] * n_tasks,
+                 [n_resamples] * n_tasks, [quantiles] * n_tasks, [resamples_per_block] * n_tasks, seeds)
+
+    if n_workers > 1 and n_tasks > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(_bootstrap_group, *task_args))
+    else:
+        results = list(map(_bootstrap_group, *task_args))
+
+    rows = []
+    for group, (estimate, interval) in zip(groups, results):
+        for i, resolution in enumerate(resolutions):
+            rows.append(group + (resolution, estimate[i], interval[0, i], interval[1, i]))
+    return pd.DataFrame(rows, columns=group_columns + ['n_buildings', 'resolution', 'estimate',
+                                                       'ci_lower', 'ci_upper'])
@@ -0,0 +1,208 @@
+"""
+Scores hourly (24/7) clean energy matching of building demand with candidate supply portfolios
+
+A portfolio contracts clean energy from each resource (such as solar and wind) as a fraction of a building's
+annual demand, with optional battery storage. For every building and portfolio pair, the contracted supply of
+each hour covers the demand of that hour, surplus supply charges the battery, and the battery discharges into
+the hours that are short. The demand that is not covered is residual demand, with emissions at the BA's hourly
+emission factors.
+
+The pairs are evaluated in chunks of pairs_per_chunk, as arrays of pairs x hours, so that memory does not depend
+on the number of buildings or portfolios.
+
+Usage:
+    portfolios = portfolio_grid({'solar': [0.5, 1], 'wind': [0, 0.5]}, storage_hours=[0, 4])
+    scores = match_portfolios(demand, hourly_ef, supply_profiles, portfolios)
+"""
+
+import itertools
+
+import numpy as np
+import pandas as pd
+
+import inventory
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    # without numba, the batteries are dispatched with one array operation over the pairs per hour instead
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+# columns of the portfolio table that describe the battery, and their defaults
+#   storage_hours: energy capacity, in hours of the building's average hourly demand
+#   storage_power: power capacity, as a multiple of the building's average hourly demand
+#   storage_efficiency: round-trip efficiency, applied when charging
+STORAGE_COLUMNS = {'storage_hours': 0., 'storage_power': 1., 'storage_efficiency': 0.85}
+
+
+def portfolio_grid(resource_fractions, storage_hours=(0,), storage_power=(1,), storage_efficiency=(0.85,)):
+    """
+    Creates a portfolio for every combination of resource fractions and storage parameters
+    Args:
+        resource_fractions: dict mapping each resource (a column of the supply profiles) to a list of the fractions
+            of annual demand to contract from it
+        storage_hours, storage_power, storage_efficiency: lists of storage parameters, see STORAGE_COLUMNS
+    Returns:
+        portfolios: dataframe with one row per portfolio, one column per resource and the STORAGE_COLUMNS
+    """
+    resources = list(resource_fractions)
+    rows = itertools.product(*[resource_fractions[resource] for resource in resources],
+                             storage_hours, storage_power, storage_efficiency)
+    return pd.DataFrame(list(rows), columns=resources + list(STORAGE_COLUMNS))
+
+
+@njit(cache=True)
+def _storage_discharge(surplus, shortfall, energy, power, efficiency):
+    """
+    Dispatches the battery of each pair hour by hour. surplus and shortfall are arrays of pairs x hours
+    Returns:
+        discharge: array of pairs x hours with the demand matched by discharging
+    """
+    n_pairs, n_hours = surplus.shape
+    discharge = np.zeros((n_pairs, n_hours))
+    for j in range(n_pairs):
+        if energy[j] <= 0 or efficiency[j] <= 0:
+            continue
+        state_of_charge = 0.
+        for hour in range(n_hours):
+            charge = min(surplus[j, hour], power[j], (energy[j] - state_of_charge) / efficiency[j])
+            state_of_charge += charge * efficiency[j]
+            discharged = min(shortfall[j, hour], power[j], state_of_charge)
+            state_of_charge -= discharged
+            discharge[j, hour] = discharged
+    return discharge
+
+
+def _dispatch_storage(supply, demand, matched, energy, power, efficiency):
+    """
+    Charges batteries from surplus supply and discharges them into short hours, in order of the hours
+    Args:
+        supply, demand: arrays of pairs x hours
+        matched: array of pairs x hours with the demand matched by supply in the same hour. Updated in place with
+            the demand matched by discharging
+        energy, power, efficiency: battery parameters of each pair, in the units of the demand
+    """
+    surplus = supply - matched
+    shortfall = demand - matched
+    if NUMBA_AVAILABLE:
+        matched += _storage_discharge(surplus, shortfall, energy, power, efficiency)
+        return
+
+    # every pair has its own battery, so each hour is one array operation over the pairs
+    state_of_charge = np.zeros(supply.shape[0])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        charge_limit = np.where(efficiency > 0, 1 / efficiency, 0.)
+    for hour in range(supply.shape[1]):
+        charge = np.minimum(np.minimum(surplus[:, hour], power), (energy - state_of_charge) * charge_limit)
+        state_of_charge += charge * efficiency
+        discharge = np.minimum(np.minimum(shortfall[:, hour], power), state_of_charge)
+        state_of_charge -= discharge
+        matched[:, hour] += discharge
+
+
+def match_portfolios(demand, hourly_ef, supply_profiles, portfolios, locations=None, pairs_per_chunk=256):
+    """
+    Scores every pair of building and supply portfolio
+    Args:
+        demand: pandas dataframe with one row per hour and one column per building, such as those returned by the
+            load_data functions or inventory.read_ba_demand
+        hourly_ef: pandas dataframe with one row per hour, in the same order as demand, and one column of hourly
+            emission factors per BA
+        supply_profiles: dataframe with one row per hour, in the same order as demand, and one column with the
+            generation profile of each resource. Each profile is scaled to the contracted annual energy
+        portfolios: dataframe with one row per portfolio, a column with the fraction of annual demand contracted
+            from each resource of supply_profiles, and optionally the STORAGE_COLUMNS
+        locations: BA of each demand column. Defaults to the 'location' level (or first level) of the columns
+        pairs_per_chunk: number of building and portfolio pairs to evaluate at once. Memory is about
+            8 x 8 bytes x hours x pairs_per_chunk
+    Returns:
+        scores: dataframe with one row per building and portfolio, with the building's columns, the 'portfolio'
+            (index in portfolios) and:
+                demand: annual demand
+                supply: annual contracted supply
+                hourly_matched: fraction of demand covered by supply in the same hour, or by storage
+                annual_matched: fraction of demand covered by annual supply, as in annual matching
+                residual_emissions: emissions of the demand that isn't matched hourly, at the hourly emission
+                    factors of the building's BA
+                annual_residual_emissions: emissions of the demand that isn't matched annually, at the BA's
+                    average emission factor
+            Buildings in a BA without emission factors have NaN emissions
+    """
+    n_hours = len(demand.index)
+    if len(hourly_ef.index) != n_hours or len(supply_profiles.index) != n_hours:
+        raise ValueError('demand, hourly_ef and supply_profiles must have the same number of hours')
+    resources = [column for column in portfolios.columns if column not in STORAGE_COLUMNS]
+    missing = [resource for resource in resources if resource not in supply_profiles.columns]
+    if missing:
+        raise ValueError(f'no supply profiles for {missing}')
+    if locations is None:
+        locations = inventory.building_locations(demand)
+
+    # buildings x hours, so that the hours of each pair are contiguous
+    values = np.ascontiguousarray(np.nan_to_num(demand.to_numpy(dtype=np.float64)).T)
+    annual_demand = values.sum(axis=1)
+    # supply of each portfolio per unit of annual demand: portfolios x hours
+    shapes = np.nan_to_num(supply_profiles[resources].to_numpy(dtype=np.float64))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shapes = np.nan_to_num(shapes / shapes.sum(axis=0))
+    fractions = portfolios[resources].to_numpy(dtype=np.float64)
+    unit_supply = fractions @ shapes.T
+    storage = {column: (portfolios[column].to_numpy(dtype=np.float64) if column in portfolios.columns
+                        else np.full(len(portfolios.index), default))
+               for column, default in STORAGE_COLUMNS.items()}
+
+    ef = hourly_ef.to_numpy(dtype=np.float64)
+    ef_filled = np.ascontiguousarray(np.nan_to_num(ef).T)
+    with np.errstate(invalid='ignore'):
+        annual_ef = np.nanmean(np.where(np.isnan(ef), np.nan, ef), axis=0)
+    ba_index = pd.Index(hourly_ef.columns).get_indexer(locations)
+    known = ba_index >= 0
+
+    n_buildings, n_portfolios = values.shape[0], len(portfolios.index)
+    buildings = np.repeat(np.arange(n_buildings), n_portfolios)
+    portfolio_index = np.tile(np.arange(n_portfolios), n_buildings)
+    hourly_matched = np.zeros(len(buildings))
+    residual_emissions = np.zeros(len(buildings))
+
+    for start in range(0, len(buildings), pairs_per_chunk):
+        chunk = slice(start, start + pairs_per_chunk)
+        b, p = buildings[chunk], portfolio_index[chunk]
+        pair_demand = values[b]
+        pair_supply = unit_supply[p] * annual_demand[b, np.newaxis]
+        matched = np.minimum(pair_demand, pair_supply)
+
+        average_demand = annual_demand[b] / n_hours
+        energy = storage['storage_hours'][p] * average_demand
+        # only the pairs with a battery need the hour by hour dispatch
+        with_storage = energy > 0
+        if with_storage.any():
+            storage_matched = matched[with_storage]
+            _dispatch_storage(pair_supply[with_storage], pair_demand[with_storage], storage_matched,
+                              energy[with_storage], (storage['storage_power'][p] * average_demand)[with_storage],
+                              storage['storage_efficiency'][p][with_storage])
+            matched[with_storage] = storage_matched
+
+        hourly_matched[chunk] = matched.sum(axis=1)
+        pair_ef = ef_filled[np.where(known[b], ba_index[b], 0)]
+        residual_emissions[chunk] = np.einsum('ph,ph->p', pair_demand - matched, pair_ef)
+
+    scores = demand.columns.to_frame(index=False).iloc[buildings].reset_index(drop=True)
+    scores['portfolio'] = portfolio_index
+    scores['demand'] = annual_demand[buildings]
+    scores['supply'] = fractions.sum(axis=1)[portfolio_index] * annual_demand[buildings]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores['hourly_matched'] = hourly_matched / scores['demand'].to_numpy()
+        scores['annual_matched'] = np.minimum(scores['supply'], scores['demand']) / scores['demand']
+    residual_emissions[~known[buildings]] = np.nan
+    scores['residual_emissions'] = residual_emissions
+    annual_residual = scores['demand'] - np.minimum(scores['supply'], scores['demand'])
+    scores['annual_residual_emissions'] = annual_residual * np.where(known, annual_ef[np.where(known, ba_index, 0)],
+                                                                     np.nan)[buildings]
+    return scores
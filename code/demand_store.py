@@ -0,0 +1,176 @@
+"""
+Columnar store for the building demand data in ../data/processed/nrel_demand
+
+Each BA is stored as two files:
+    {ba}.npy: float32 array of hours x buildings, in column-major order so that each building is contiguous
+    {ba}.json: the building names (columns of the array) and typed building metadata parsed from the names
+
+The arrays can be memory-mapped, so reading the buildings of a BA, or a few of them, does not parse or copy
+the whole file. Convert the csv.zip files written by notebook 6 by running from the code directory:
+
+    python demand_store.py
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# directory with one csv.zip file of building demand per BA, written by notebook 6
+DEMAND_DIR = '../data/processed/nrel_demand'
+
+# directory of the columnar demand store
+STORE_DIR = '../data/processed/nrel_demand_store'
+
+# building names are formatted as {climate_zone}_{building_category}_{building_name}_{building_id}
+METADATA_COLUMNS = ['climate_zone', 'building_category', 'building_name', 'building_id']
+
+
+def _typed_metadata(building_types, metadata):
+    """
+    Builds the metadata dataframe from lists of values for each of the METADATA_COLUMNS
+    """
+    frame = pd.DataFrame(index=pd.Index(building_types, name='building_type'))
+    for column in METADATA_COLUMNS[:-1]:
+        frame[column] = pd.Categorical(metadata[column])
+    building_id = pd.to_numeric(pd.Series(metadata['building_id'], dtype=object), errors='coerce')
+    if building_id.isna().any():
+        frame['building_id'] = pd.array(building_id.to_numpy(), dtype='Int64')
+    else:
+        frame['building_id'] = building_id.to_numpy(dtype=np.int64)
+    return frame
+
+
+def building_metadata(building_types):
+    """
+    Splits building names into the METADATA_COLUMNS
+    Args:
+        building_types: list of building names
+    Returns:
+        metadata: dataframe indexed by building name, with categorical string columns and an integer
+            building_id (nullable if any id is not a number)
+    """
+    parts = pd.Series(list(building_types), dtype=object).str.split('_', n=3, expand=True)
+    parts = parts.reindex(columns=range(len(METADATA_COLUMNS)))
+    parts.columns = METADATA_COLUMNS
+    return _typed_metadata(building_types, {column: parts[column].tolist() for column in METADATA_COLUMNS})
+
+
+def write_ba_demand(ba, demand, store_dir=STORE_DIR):
+    """
+    Writes the demand of the buildings in a BA to the store
+    Args:
+        ba: BA code
+        demand: dataframe with one row per hour and one column per building
+        store_dir: directory of the store
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    columns = [str(column) for column in demand.columns]
+    values = np.asfortranarray(demand.to_numpy(dtype=np.float32))
+
+    metadata = building_metadata(columns)
+    index = {'ba': ba,
+             'n_hours': values.shape[0],
+             'dtype': 'float32',
+             'columns': columns,
+             'metadata': {column: [None if pd.isna(value) else value for value in metadata[column].tolist()]
+                          for column in METADATA_COLUMNS}}
+
+    # write to temporary files first, so that a failed conversion does not leave a partial BA in the store
+    np.save(f'{store_dir}/{ba}.tmp.npy', values)
+    with open(f'{store_dir}/{ba}.tmp.json', 'w') as f:
+        json.dump(index, f)
+    os.replace(f'{store_dir}/{ba}.tmp.npy', f'{store_dir}/{ba}.npy')
+    os.replace(f'{store_dir}/{ba}.tmp.json', f'{store_dir}/{ba}.json')
+
+
+def convert_demand_files(ba_list=None, demand_dir=DEMAND_DIR, store_dir=STORE_DIR, overwrite=False):
+    """
+    Converts the {ba}.csv.zip demand files to the store
+    Args:
+        ba_list: list of BA codes to convert. Converts every file in demand_dir if None
+        demand_dir: directory containing the {ba}.csv.zip demand files
+        store_dir: directory of the store
+        overwrite: if False, BAs that are already in the store are skipped
+    """
+    if ba_list is None:
+        ba_list = sorted(filename[:-len('.csv.zip')] for filename in os.listdir(demand_dir)
+                         if filename.endswith('.csv.zip'))
+
+    for ba in ba_list:
+        if not os.path.exists(f'{demand_dir}/{ba}.csv.zip'):
+            print(f'No demand data for {ba}')
+        elif os.path.exists(f'{store_dir}/{ba}.json') and not overwrite:
+            print(f'BA {ba} already converted.')
+        else:
+            demand = pd.read_csv(f'{demand_dir}/{ba}.csv.zip', compression='zip', dtype='float32')
+            write_ba_demand(ba, demand, store_dir)
+
+
+def read_store_index(ba, store_dir=STORE_DIR):
+    """
+    Reads the JSON index of a BA, with its building names and metadata
+    """
+    with open(f'{store_dir}/{ba}.json') as f:
+        return json.load(f)
+
+
+def read_store_metadata(ba, store_dir=STORE_DIR):
+    """
+    Returns the building metadata of a BA as a dataframe indexed by building name, as returned by building_metadata
+    """
+    index = read_store_index(ba, store_dir)
+    return _typed_metadata(index['columns'], index['metadata'])
+
+
+def load_ba_array(ba, columns=None, store_dir=STORE_DIR, mmap=True):
+    """
+    Loads the demand array of a BA
+    Args:
+        ba: BA code
+        columns: list of building names to load. Loads all buildings if None
+        store_dir: directory of the store
+        mmap: if True, the array is memory-mapped instead of read into memory
+    Returns:
+        values: float32 array of hours x buildings. If mmap is True and columns is None, or selects a contiguous
+            range of buildings, this is a read-only view of the file and nothing is copied
+        columns: list of the building names of the columns of values
+    """
+    all_columns = read_store_index(ba, store_dir)['columns']
+    values = np.load(f'{store_dir}/{ba}.npy', mmap_mode='r' if mmap else None)
+    if columns is None:
+        return values, all_columns
+
+    positions = pd.Index(all_columns).get_indexer(columns)
+    if (positions < 0).any():
+        missing = [column for column, position in zip(columns, positions) if position < 0]
+        raise KeyError(f'{missing} not in the demand store for {ba}')
+    if len(positions) > 0 and (np.diff(positions) == 1).all():
+        # a contiguous range of buildings is a slice of the column-major array
+        values = values[:, positions[0]:positions[-1] + 1]
+    else:
+        values = values[:, positions]
+    return values, list(columns)
+
+
+def read_ba_demand(ba, columns=None, store_dir=STORE_DIR, mmap=True):
+    """
+    Reads the hourly demand of the buildings in a BA from the store, in the same format as inventory.read_ba_demand
+    Args:
+        ba: BA code
+        columns: list of building names to read. Reads all buildings if None
+        store_dir: directory of the store
+        mmap: if True, the dataframe is backed by the memory-mapped file where possible (see load_ba_array)
+    Returns:
+        demand: dataframe with one row per hour and a (location, building_type) column for each building
+    """
+    values, columns = load_ba_array(ba, columns, store_dir, mmap)
+    return pd.DataFrame(values, columns=pd.MultiIndex.from_product([[ba], columns],
+                                                                   names=['location', 'building_type']),
+                        copy=False)
+
+
+if __name__ == '__main__':
+    convert_demand_files()
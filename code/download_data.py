@@ -3,6 +3,27 @@ import requests
 import pandas as pd
 from datetime import timedelta
 import numpy as np
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import unquote
+
+
+# url of the Singularity API
+SINGULARITY_API = 'https://api.singularity.energy/v1'
+
+# directory of the hourly emission factors of each BA
+SINGULARITY_EF_DIR = '../data/processed/singularity_efs'
+
+# directory for the cached pages of Singularity API responses, one subdirectory per BA
+SINGULARITY_CACHE_DIR = '../data/downloads/singularity'
+
+# cached windows that were downloaded less than this long after the window ended are downloaded again, since the
+# API may not have had all of the data for the window yet
+SINGULARITY_REFRESH_AFTER = timedelta(days=1)
 
 
 def ba_timezone(ba, format):
@@ -107,9 +128,11 @@ def check_singularity_region_exists(api_key, ba):
     header = {'X-Api-Key': api_key}
 
 
-def download_singularity_data(api_key, ba, start_date, end_date):
+def singularity_windows(ba, start_date, end_date):
     """
-
+    Splits a date range into the 7-day windows that the Singularity API accepts
+    Returns:
+        windows: list of (start, end) timestamps, formatted for the API url
     """
 
     # set the start and end datetimes
@@ -118,17 +141,7 @@ def download_singularity_data(api_key, ba, start_date, end_date):
     end_datetime = pd.to_datetime(f'{end_date}T23:55:00{utc_offset}')
     current_datetime = start_datetime
 
-    # start a session object
-    session = requests.Session()
-    session.headers.update({'X-Api-Key': api_key})
-
-    # define parameters for API call
-    event_type = 'carbon_intensity'
-    #header = {'X-Api-Key': api_key}
-
-    # create an empty dataframe to which we will append each api response for the ba
-    df_ba = pd.DataFrame()
-
+    windows = []
     while current_datetime <= end_datetime:
         # format the timestamp for the API
         start = str(current_datetime).replace(' ', 'T').replace('+', '%2B')
@@ -139,96 +152,393 @@ def download_singularity_data(api_key, ba, start_date, end_date):
                                                     minutes=55)).replace(' ', 'T').replace('+', '%2B'))
         else:
             end = (str(end_datetime).replace(' ', 'T').replace('+', '%2B'))
+        windows.append((start, end))
+
+        current_datetime = (current_datetime + timedelta(days=7))
+
+    return windows
+
+
+def singularity_url(ba, start, end, page, base_url=SINGULARITY_API):
+    """
+    Returns the url of one page of carbon intensity events for a window
+    """
+    event_type = 'carbon_intensity'
+    return f'{base_url}/region_events/search?region={ba}&start={start}&end={end}&event_type={event_type}&per_page=1000&page={page}'
+
+
+class SingularityRecords:
+    """
+    Collects the events of the pages of API results for one BA in flat column buffers, and builds the hourly
+    emission factor frame from them once all the pages have been added
+    """
+
+    # emissions source metadata fields of each event
+    SOURCE_FIELDS = ('consumed_emissions_source', 'generated_emissions_source')
+
+    def __init__(self):
+        self.page = []
+        self.datetime_local = []
+        self.source = []
+        self.production_ef = []
+        self.consumption_ef = []
+        self.has_production = False
+        self.has_consumption = False
+        self.n_pages = 0
+
+    def add_page(self, page):
+        """
+        Appends the events of the decoded json of one page of API results. Pages must be added in order
+        """
+        for event in page['data']:
+            # only keep observations where the dedup key ends in +00:00, otherwise there will be some duplicate entries
+            if not event.get('dedup_key', '').endswith('+00:00'):
+                continue
+
+            # the emission source is the first source in the event's metadata.
+            # if the source data is misisng, assume that it is EGRID_u2018, per email with Jeff Burka of Singularity Energy
+            source = 'EGRID_u2018'
+            for field, value in (event.get('meta') or {}).items():
+                if field in self.SOURCE_FIELDS and value is not None:
+                    source = value
+                    break
+
+            data = event.get('data') or {}
+            self.has_production = self.has_production or 'generated_rate' in data
+            self.has_consumption = self.has_consumption or 'consumed_rate' in data
+            self.page.append(self.n_pages)
+            self.datetime_local.append(event['start_date'])
+            self.source.append(source)
+            self.production_ef.append(data.get('generated_rate'))
+            self.consumption_ef.append(data.get('consumed_rate'))
+        self.n_pages += 1
+
+    def to_frame(self, ba):
+        """
+        Builds the hourly emission factors of the BA in kg/kWh, in the BA's local standard time, with one
+        production_ef and consumption_ef column per emissions source
+        """
+        if not self.page:
+            return pd.DataFrame()
+
+        value_columns = [column for column, present in [('production_ef', self.has_production),
+                                                         ('consumption_ef', self.has_consumption)] if present]
+        df = pd.DataFrame({'page': np.array(self.page, dtype=np.int64),
+                           'datetime_local': pd.to_datetime(pd.Series(self.datetime_local, dtype=object), utc=True),
+                           'source': pd.Series(self.source, dtype=object),
+                           'production_ef': np.array(self.production_ef, dtype=np.float64),
+                           'consumption_ef': np.array(self.consumption_ef, dtype=np.float64)})
+
+        # if a page has several events for the same datetime and source, keep the one with the fewest missing values
+        df['missing'] = df[value_columns].isna().sum(axis=1)
+        df = df.sort_values(by=['page', 'datetime_local', 'source', 'missing'], kind='mergesort')
+        df = df.drop_duplicates(subset=['page', 'datetime_local', 'source'])
+
+        # order the columns as if the pages were pivoted one by one and concatenated: the columns of each page are
+        # ordered by value and then source, and the columns of later pages follow those of earlier pages
+        columns = []
+        for _, page_sources in df[['page', 'source']].drop_duplicates().groupby('page', sort=True)['source']:
+            for column in [(value, source) for value in value_columns for source in sorted(page_sources)]:
+                if column not in columns:
+                    columns.append(column)
+
+        # if there are duplicate datetimes across pages, only keep the first non-NA value of each column
+        df_ba = df.groupby(['datetime_local', 'source'], sort=True)[value_columns].first().unstack(level=-1)
+        df_ba = df_ba.reindex(columns=pd.MultiIndex.from_tuples(columns))
+        df_ba.columns = ['_'.join(col).strip() for col in df_ba.columns.values]
+
+        # convert values from lb/MWh to kg/kWh
+        df_ba = df_ba * 0.453592 / 1000
+
+        # convert datetime to local
+        df_ba.index = df_ba.index.tz_convert(ba_timezone(ba, format='GMT'))
+
+        # resample the data to 1 hour frequency
+        df_ba = df_ba.resample('H').mean()
+
+        return df_ba
+
+
+def download_singularity_data(api_key, ba, start_date, end_date, base_url=SINGULARITY_API):
+    """
+
+    """
+
+    # start a session object
+    session = requests.Session()
+    session.headers.update({'X-Api-Key': api_key})
+
+    # collect the events of every page of api responses for the ba
+    records = SingularityRecords()
+
+    for start, end in singularity_windows(ba, start_date, end_date):
         print(f'{ba}:{start}')
 
-        # call API
-        output = session.get(
-            f'https://api.singularity.energy/v1/region_events/search?region={ba}&start={start}&end={end}&event_type={event_type}&per_page=1000&page=1')
+        # call API, and decode the response once
+        page = session.get(singularity_url(ba, start, end, 1, base_url)).json()
 
         # check to see if there are multiple pages of response
-        current_page = output.json()['meta']['pagination']['this']
-        last_page = output.json()['meta']['pagination']['last']
+        current_page = page['meta']['pagination']['this']
+        last_page = page['meta']['pagination']['last']
 
         # if there are multiple pages, loop through them until finished
         while current_page <= last_page:
 
-            # convert the json to a dataframe
-            df = pd.json_normalize(output.json(), 'data')
-
-            if df.empty:
-                pass
-            else:
-
-                # only keep observations where the dedup key ends in +00:00, otherwise there will be some duplicate entries
-                df = df[df['dedup_key'].str.endswith('+00:00')]
-
-                # only keep columns that have the rate data or source metadata
-                columns_to_keep = ['start_date',
-                                'data.generated_rate', 'data.consumed_rate',
-                                'meta.consumed_emissions_source', 'meta.generated_emissions_source']
-                df = df.loc[:, df.columns.isin(columns_to_keep)]
-
-                # create a new emission source column that combines each of the three emissions source columns into one
-                source_columns = ['meta.consumed_emissions_source',
-                                'meta.generated_emissions_source']
-                try:
-                    df['source'] = df.loc[:, df.columns.isin(source_columns)].stack().groupby(
-                        level=0).apply(lambda x: x.unique().tolist()[0])
-                except IndexError:
-                    # if the source data column is missing, create one
-                    df['source'] = np.NaN
-
-                # if any of the source data is misisng, assume that it is EGRID_u2018, per email with Jeff Burka of Singularity Energy
-                df['source'] = df['source'].fillna('EGRID_u2018')
-
-                # drop the original emissions source columns
-                df = df.drop(columns=['meta.consumed_emissions_source',
-                                    'meta.generated_emissions_source'], errors='ignore')
-
-                # rename the columns
-                df = df.rename(columns={'start_date': 'datetime_local', 'data.generated_rate': 'production_ef',
-                                        'data.consumed_rate': 'consumption_ef'})
-
-                # pivot the data to get unique columns for each emissions source
-                df = df.set_index(['datetime_local', 'source'])
-                if df.index.duplicated().any():
-                    df['missing'] = df.isna().sum(axis=1)
-                    df = df.sort_values(by=['datetime_local', 'source', 'missing'])
-                    df = df[~df.index.duplicated(keep='first')]
-                    df = df.drop(columns=['missing'])
-                df = df.unstack(level=-1)
-                df.columns = ['_'.join(col).strip() for col in df.columns.values]
-
-                df_ba = pd.concat([df_ba, df])
+            records.add_page(page)
 
             if current_page < last_page:
                 # get the next page of data
-                output = session.get(
-                    f'https://api.singularity.energy/v1/region_events/search?region={ba}&start={start}&end={end}&event_type={event_type}&per_page=1000&page={current_page+1}')
+                page = session.get(singularity_url(ba, start, end, current_page + 1, base_url)).json()
 
-                current_page = output.json()['meta']['pagination']['this']
+                current_page = page['meta']['pagination']['this']
             elif current_page == last_page:
                 break
 
-        current_datetime = (current_datetime + timedelta(days=7))
+    return records.to_frame(ba)
+
+
+def singularity_cache_path(cache_dir, ba, start, end, page):
+    """
+    Returns the path of the cached response for one page of a window, named by the request parameters
+    """
+    start, end = (pd.Timestamp(unquote(time)).strftime('%Y%m%dT%H%M%z') for time in (start, end))
+    return f'{cache_dir}/{ba}/{start}_{end}_page{page}.json'
+
+
+def read_cached_page(path, end, refresh_after=SINGULARITY_REFRESH_AFTER):
+    """
+    Reads a cached page of API results
+    Args:
+        path: path of the cached page, see singularity_cache_path
+        end: end of the page's window, formatted for the API url
+        refresh_after: pages that were downloaded less than this long after the window ended are stale
+    Returns:
+        page: the decoded json of the page, or None if the page isn't cached or is stale
+    """
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
 
-    # set the datetime index
-    df_ba.index = pd.to_datetime(df_ba.index)
+    if pd.Timestamp(cached['fetched_at']) < pd.Timestamp(unquote(end)) + refresh_after:
+        return None
+    return cached['response']
 
-    # if there are duplicate datetimes, group by datetime and only keep non-NA values
-    df_ba = df_ba.groupby('datetime_local').agg(
-        lambda x: np.nan if x.isnull().all() else x.dropna())
 
-    # convert values from lb/MWh to kg/kWh
-    df_ba = df_ba * 0.453592 / 1000
+def write_cached_page(path, page):
+    """
+    Caches the decoded json of a page of API results, with the time it was downloaded
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file first, so that an interrupted download does not leave a partial page in the cache
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump({'fetched_at': pd.Timestamp.now(tz='UTC').isoformat(), 'response': page}, f)
+    os.replace(f'{path}.tmp', path)
 
-    # convert datetime to local
-    df_ba.index = df_ba.index.tz_convert(ba_timezone(ba, format='GMT'))
 
-    # resample the data to 1 hour frequency
-    df_ba = df_ba.resample('H').mean()
+class TokenBucket:
+    """
+    Thread-safe token bucket that limits the rate of requests shared by all download threads
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        Args:
+            rate: number of requests allowed per second, on average
+            capacity: number of requests that can be made at once after a pause. Defaults to rate
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Waits until a request can be made
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def _get_with_retries(session, url, bucket, max_retries, backoff):
+    """
+    Gets a url, retrying with exponential backoff on connection errors and 429 or 5xx responses
+    Returns:
+        the decoded json of the response
+    """
+    for attempt in range(max_retries + 1):
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            response = session.get(url)
+        except requests.exceptions.ConnectionError:
+            if attempt == max_retries:
+                raise
+            response = None
+
+        if response is not None and response.status_code != 429 and response.status_code < 500:
+            response.raise_for_status()
+            return response.json()
+        if attempt == max_retries:
+            response.raise_for_status()
+
+        # wait for as long as the server asks, or back off exponentially with some jitter
+        retry_after = None if response is None else response.headers.get('Retry-After')
+        try:
+            wait = float(retry_after)
+        except (TypeError, ValueError):
+            wait = backoff * 2 ** attempt * (1 + random.random())
+        time.sleep(wait)
+
+
+def download_singularity_data_concurrent(api_key, ba_list, start_date, end_date, max_concurrency=8,
+                                         requests_per_second=5, max_retries=5, backoff=1, base_url=SINGULARITY_API,
+                                         cache_dir=None, refresh_after=SINGULARITY_REFRESH_AFTER):
+    """
+    Downloads the emission factors of several BAs, fetching windows, pages and BAs concurrently
+    Args:
+        api_key: Singularity API key
+        ba_list: list of BA codes
+        start_date, end_date: first and last dates to download, as 'YYYY-MM-DD'
+        max_concurrency: maximum number of requests in flight at once
+        requests_per_second: average rate limit of the requests, shared by all threads. None for no limit
+        max_retries: number of times a request is retried after a 429 or 5xx response or a connection error
+        backoff: base wait in seconds between retries, doubled after each retry
+        base_url: url of the API, which can point to mock_singularity for offline testing
+        cache_dir: if given, every downloaded page is cached in this directory, and only the pages that aren't
+            cached yet, or are stale (see read_cached_page), are downloaded. An interrupted download resumes from
+            the pages it had finished
+        refresh_after: see read_cached_page
+    Returns:
+        dfs: dict of the dataframe of each BA, as returned by download_singularity_data
+    """
+    bucket = TokenBucket(requests_per_second) if requests_per_second else None
+    # requests sessions are not thread-safe, so each thread gets its own
+    local = threading.local()
+
+    def get(url):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+            local.session.headers.update({'X-Api-Key': api_key})
+        return _get_with_retries(local.session, url, bucket, max_retries, backoff)
+
+    windows = {ba: singularity_windows(ba, start_date, end_date) for ba in ba_list}
+
+    def fetch(ba, i, page_number):
+        start, end = windows[ba][i]
+        page = get(singularity_url(ba, start, end, page_number, base_url))
+        if cache_dir is not None:
+            write_cached_page(singularity_cache_path(cache_dir, ba, start, end, page_number), page)
+        return page
+
+    def cached(ba, i, page_number):
+        if cache_dir is None:
+            return None
+        start, end = windows[ba][i]
+        return read_cached_page(singularity_cache_path(cache_dir, ba, start, end, page_number), end, refresh_after)
+
+    pages = {}
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        other_pages = {}
+
+        def fetch_other_pages(ba, i, last_page):
+            for page_number in range(2, last_page + 1):
+                page = cached(ba, i, page_number)
+                if page is not None:
+                    pages[(ba, i, page_number)] = page
+                else:
+                    other_pages[pool.submit(fetch, ba, i, page_number)] = (ba, i, page_number)
+
+        # the first page of each window tells how many pages it has
+        first_pages = {}
+        for ba in ba_list:
+            for i in range(len(windows[ba])):
+                page = cached(ba, i, 1)
+                if page is not None:
+                    pages[(ba, i, 1)] = page
+                    fetch_other_pages(ba, i, page['meta']['pagination']['last'])
+                else:
+                    first_pages[pool.submit(fetch, ba, i, 1)] = (ba, i)
+        print(f'{len(pages)} pages cached, downloading the first pages of {len(first_pages)} windows')
+
+        for future in as_completed(first_pages):
+            ba, i = first_pages[future]
+            page = future.result()
+            pages[(ba, i, 1)] = page
+            fetch_other_pages(ba, i, page['meta']['pagination']['last'])
+        for future in as_completed(other_pages):
+            pages[other_pages[future]] = future.result()
+
+    dfs = {}
+    for ba in ba_list:
+        print(f'{ba}: {len(windows[ba])} windows')
+        records = SingularityRecords()
+        for key in sorted(key for key in pages if key[0] == ba):
+            records.add_page(pages[key])
+        dfs[ba] = records.to_frame(ba)
+
+    return dfs
+
+
+def read_singularity_efs(ba, ef_dir=SINGULARITY_EF_DIR):
+    """
+    Reads the hourly emission factors of a BA, as written by update_singularity_efs
+    Returns:
+        df: dataframe like those returned by download_singularity_data, or None if the BA has no file
+    """
+    path = f'{ef_dir}/{ba}.csv'
+    if not os.path.exists(path):
+        return None
+    df = pd.read_csv(path, index_col='datetime_local')
+    df.index = pd.to_datetime(df.index, utc=True).tz_convert(ba_timezone(ba, format='GMT'))
+    df.index.name = 'datetime_local'
+    return df
+
+
+def update_singularity_efs(api_key, ba_list, start_date, end_date, ef_dir=SINGULARITY_EF_DIR,
+                           cache_dir=SINGULARITY_CACHE_DIR, **kwargs):
+    """
+    Downloads the emission factors of several BAs for a date range, and merges them into the file of each BA in
+    ef_dir. Only the pages of API results that aren't cached in cache_dir yet, or are stale, are downloaded, so
+    rerunning over the same range only downloads the windows that are new or were still incomplete, such as the
+    latest week, and an interrupted run resumes where it stopped
+    Args:
+        api_key, ba_list, start_date, end_date: see download_singularity_data_concurrent
+        ef_dir: directory of the emission factor files. The hours of the date range replace those of an existing
+            file, and the hours outside of the date range are kept
+        cache_dir: directory of the cached pages
+        kwargs: other arguments of download_singularity_data_concurrent
+    Returns:
+        dfs: dict of the merged dataframe of each BA
+    """
+    dfs = download_singularity_data_concurrent(api_key, ba_list, start_date, end_date, cache_dir=cache_dir,
+                                               **kwargs)
+    os.makedirs(ef_dir, exist_ok=True)
+    for ba, df in dfs.items():
+        existing = read_singularity_efs(ba, ef_dir)
+        if existing is not None and not df.empty:
+            df = pd.concat([existing[~existing.index.isin(df.index)], df]).sort_index()
+        elif existing is not None:
+            df = existing
+        df.index.name = 'datetime_local'
+
+        # write to a temporary file first, so that an interrupted run does not leave a partial file
+        df.to_csv(f'{ef_dir}/{ba}.tmp.csv')
+        os.replace(f'{ef_dir}/{ba}.tmp.csv', f'{ef_dir}/{ba}.csv')
+        dfs[ba] = df
+
+    return dfs
 
-    return df_ba
 
 def download_doe_building_data():
     pass
\ No newline at end of file
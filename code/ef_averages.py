@@ -0,0 +1,233 @@
+"""
+Calculates average emission factors over groups of hours (annual, monthly, month-hour, seasonal, etc.)
+
+Each averaging scheme assigns an integer calendar code to every hour. The average of each group is then a
+weighted np.bincount of the hourly emission factors, which is broadcast back to the hours with an index lookup.
+The broadcast variants of an emission factor file can be cached on disk, keyed by a hash of the file and the
+scheme, so that repeat runs only read the cached arrays.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# built-in averaging schemes. 'hourly' is the hourly data itself and is only used by expand_efs
+SCHEMES = ['annual', 'monthly', 'monthhourly', 'season', 'weekday', 'tou']
+
+# meteorological seasons, by month
+SEASONS = {12: 'winter', 1: 'winter', 2: 'winter',
+           3: 'spring', 4: 'spring', 5: 'spring',
+           6: 'summer', 7: 'summer', 8: 'summer',
+           9: 'fall', 10: 'fall', 11: 'fall'}
+SEASON_LABELS = ['winter', 'spring', 'summer', 'fall']
+
+# time of use periods, by hour beginning. Weekends have no peak period
+TOU_PERIODS = {'super_off_peak': range(9, 14),
+               'peak': range(16, 21)}
+TOU_LABELS = ['off_peak', 'super_off_peak', 'peak']
+
+# directory for cached broadcast variants of emission factor files
+CACHE_DIR = '../data/processed/emission_factors/cache'
+
+
+def calendar_codes(index, scheme):
+    """
+    Assigns each hour to a group of an averaging scheme
+    Args:
+        index: pandas DatetimeIndex of the hours
+        scheme: name of a built-in scheme in SCHEMES, an array of group labels with one label per hour, or a
+            function that takes the index and returns such an array (custom periods)
+    Returns:
+        codes: integer array with the group of each hour, from 0 to len(labels) - 1
+        labels: list of the label of each group
+    """
+    if isinstance(scheme, str):
+        month = index.month.to_numpy() - 1
+        hour = index.hour.to_numpy()
+        if scheme == 'annual':
+            return np.zeros(len(index), dtype=np.int64), ['annual']
+        if scheme == 'monthly':
+            return month.astype(np.int64), list(range(1, 13))
+        if scheme == 'monthhourly':
+            return (month * 24 + hour).astype(np.int64), [(m, h) for m in range(1, 13) for h in range(24)]
+        if scheme == 'season':
+            season_of_month = np.array([SEASON_LABELS.index(SEASONS[m]) for m in range(1, 13)])
+            return season_of_month[month], list(SEASON_LABELS)
+        if scheme == 'weekday':
+            return (index.dayofweek.to_numpy() >= 5).astype(np.int64), ['weekday', 'weekend']
+        if scheme == 'tou':
+            off_peak = TOU_LABELS.index('off_peak')
+            period_of_hour = np.full(24, off_peak, dtype=np.int64)
+            for period, hours in TOU_PERIODS.items():
+                period_of_hour[list(hours)] = TOU_LABELS.index(period)
+            codes = period_of_hour[hour]
+            codes[(index.dayofweek.to_numpy() >= 5) & (codes == TOU_LABELS.index('peak'))] = off_peak
+            return codes, list(TOU_LABELS)
+        raise ValueError(f'unknown averaging scheme {scheme}, expected one of {SCHEMES}')
+
+    labels = scheme(index) if callable(scheme) else scheme
+    labels = np.asarray(labels)
+    if len(labels) != len(index):
+        raise ValueError(f'the custom scheme has {len(labels)} labels for {len(index)} hours')
+    codes, uniques = pd.factorize(labels, sort=True)
+    if (codes < 0).any():
+        raise ValueError('the custom scheme has missing labels')
+    return codes.astype(np.int64), list(uniques)
+
+
+def group_means(values, codes, n_groups):
+    """
+    Averages the columns of an array within each group, skipping NaN
+    Args:
+        values: 2d array of hours x columns
+        codes: integer group of each hour, from 0 to n_groups - 1
+        n_groups: number of groups
+    Returns:
+        means: array of n_groups x columns, NaN for groups without data
+    """
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0.)
+    sums = np.zeros((n_groups, values.shape[1]))
+    counts = np.zeros((n_groups, values.shape[1]))
+    for i in range(values.shape[1]):
+        sums[:, i] = np.bincount(codes, weights=filled[:, i], minlength=n_groups)
+        counts[:, i] = np.bincount(codes, weights=valid[:, i], minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def average_efs(hourly_ef, scheme):
+    """
+    Calculates the average emission factors of each group of an averaging scheme
+    Args:
+        hourly_ef: pandas dataframe with a DatetimeIndex and one column of hourly emission factors per BA
+        scheme: averaging scheme, see calendar_codes
+    Returns:
+        averages: dataframe with one row per group, indexed by the group labels, and one column per BA
+    """
+    codes, labels = calendar_codes(hourly_ef.index, scheme)
+    means = group_means(hourly_ef.to_numpy(dtype=np.float64), codes, len(labels))
+    if len(labels) > 0 and isinstance(labels[0], tuple):
+        index = pd.MultiIndex.from_tuples(labels, names=['month', 'hour'])
+    else:
+        index = pd.Index(labels, name=scheme if isinstance(scheme, str) else 'period')
+    return pd.DataFrame(means, index=index, columns=hourly_ef.columns)
+
+
+def broadcast_average_efs(hourly_ef, scheme, preserve_missing=True):
+    """
+    Calculates the average emission factor of each hour's group for every hour
+    Args:
+        hourly_ef: pandas dataframe with a DatetimeIndex and one column of hourly emission factors per BA
+        scheme: averaging scheme, see calendar_codes
+        preserve_missing: if True, hours with a missing hourly emission factor are also missing in the averages
+    Returns:
+        averages: dataframe with the same shape and index as hourly_ef
+    """
+    values = hourly_ef.to_numpy(dtype=np.float64)
+    codes, labels = calendar_codes(hourly_ef.index, scheme)
+    averages = group_means(values, codes, len(labels))[codes]
+    if preserve_missing:
+        averages[np.isnan(values)] = np.nan
+    return pd.DataFrame(averages, index=hourly_ef.index, columns=hourly_ef.columns)
+
+
+def fill_missing(hourly_ef, scheme='monthhourly'):
+    """
+    Fills missing hourly emission factors with the average of their group, such as the month-hour average
+    """
+    return hourly_ef.fillna(broadcast_average_efs(hourly_ef, scheme, preserve_missing=False))
+
+
+def expand_efs(hourly_ef, schemes=('hourly', 'monthhourly', 'monthly', 'annual'), preserve_missing=True,
+               variants=None):
+    """
+    Builds the emission factor frame used by the inventory notebooks, with the hourly data and the broadcast
+    average of each scheme for every BA
+    Args:
+        hourly_ef: pandas dataframe with a DatetimeIndex and one column of hourly emission factors per BA
+        schemes: list of scheme names, or dict mapping names to schemes (see calendar_codes). 'hourly' is the
+            hourly data itself
+        preserve_missing: if True, hours with a missing hourly emission factor are also missing in the averages
+        variants: dict of precomputed broadcast variants by name, such as those loaded from the cache
+    Returns:
+        ef: dataframe with the same index as hourly_ef and (BA, scheme name) columns
+    """
+    if not isinstance(schemes, dict):
+        schemes = {name: name for name in schemes}
+    if variants is None:
+        variants = {}
+
+    frames = []
+    for name, scheme in schemes.items():
+        if name in variants:
+            frames.append(variants[name])
+        elif name == 'hourly':
+            frames.append(hourly_ef.astype(np.float64))
+        else:
+            frames.append(broadcast_average_efs(hourly_ef, scheme, preserve_missing))
+
+    ef = pd.concat(frames, axis='columns', keys=list(schemes))
+    ef.columns = ef.columns.swaplevel(0, 1)
+    return ef.reindex(columns=pd.MultiIndex.from_product([hourly_ef.columns, list(schemes)]))
+
+
+def file_hash(path, block_size=1 << 20):
+    """
+    Returns the sha256 hex digest of the contents of a file
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_expanded_efs(ef_path, schemes=('hourly', 'monthhourly', 'monthly', 'annual'), preserve_missing=True,
+                      usecols=None, cache_dir=CACHE_DIR):
+    """
+    Reads an hourly emission factor csv and returns expand_efs for it, caching each broadcast variant on disk.
+
+    The cache key of a variant is a hash of the contents of the csv, the columns read, the calendar codes
+    of the scheme and preserve_missing, so a changed file or scheme is recalculated.
+    Args:
+        ef_path: path of a csv with a datetime_local column and one column of hourly emission factors per BA
+        schemes: see expand_efs
+        preserve_missing: see expand_efs
+        usecols: list of BA columns to read. Reads all columns if None
+        cache_dir: directory for the cached variants. Nothing is cached if None
+    Returns:
+        ef: dataframe with (BA, scheme name) columns, as returned by expand_efs
+    """
+    hourly_ef = pd.read_csv(ef_path, index_col='datetime_local', parse_dates=True,
+                            usecols=None if usecols is None else ['datetime_local'] + list(usecols))
+    if not isinstance(schemes, dict):
+        schemes = {name: name for name in schemes}
+    if cache_dir is None:
+        return expand_efs(hourly_ef, schemes, preserve_missing)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    source_key = hashlib.sha256((file_hash(ef_path) + repr(list(hourly_ef.columns))).encode()).hexdigest()
+
+    variants = {}
+    for name, scheme in schemes.items():
+        if name == 'hourly':
+            continue
+        codes, labels = calendar_codes(hourly_ef.index, scheme)
+        key = hashlib.sha256(source_key.encode() + codes.tobytes() + repr(labels).encode()
+                             + repr(preserve_missing).encode()).hexdigest()[:32]
+        cache_path = f'{cache_dir}/{name}_{key}.npy'
+        if os.path.exists(cache_path):
+            averages = np.load(cache_path)
+        else:
+            averages = broadcast_average_efs(hourly_ef, scheme, preserve_missing).to_numpy()
+            # write to a temporary file first, so that an interrupted run does not leave a partial array
+            np.save(f'{cache_path}.tmp.npy', averages)
+            os.replace(f'{cache_path}.tmp.npy', cache_path)
+        variants[name] = pd.DataFrame(averages, index=hourly_ef.index, columns=hourly_ef.columns)
+
+    return expand_efs(hourly_ef, schemes, preserve_missing, variants)
@@ -0,0 +1,287 @@
+"""
+Calculates GHG inventories for building demand at different emission factor resolutions
+
+For each building, the inventory is the sum over all hours of demand times the emission factor of the
+building's balancing authority. The monthly, month-hour and annual average emission factors are constant
+within 12, 288 and 1 groups of hours, so those inventories are calculated exactly from the demand summed
+over each group, and only the hourly inventory needs the hourly products.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import demand_store
+import ef_averages
+
+
+# emission factor resolutions, in the order of the inventory columns
+RESOLUTIONS = ['hourly', 'monthhourly', 'monthly', 'annual']
+
+# average resolutions that are compared to the hourly inventory
+AVERAGE_RESOLUTIONS = ['monthly', 'monthhourly', 'annual']
+
+# directory with one csv.zip file of building demand per BA, written by notebook 6
+DEMAND_DIR = '../data/processed/nrel_demand'
+
+
+def group_sums(values, groups, n_groups):
+    """
+    Sums the rows of an array within each group
+    Args:
+        values: 2d array of hours x columns
+        groups: integer group of each hour, from 0 to n_groups - 1
+        n_groups: number of groups
+    Returns:
+        sums: float64 array of n_groups x columns, with 0 for groups that have no hours
+    """
+    # sort the hours so that each group is contiguous, then sum each run of rows
+    order = np.argsort(groups, kind='stable')
+    sorted_groups = groups[order]
+    starts = np.flatnonzero(np.diff(sorted_groups, prepend=-1))
+    sums = np.zeros((n_groups, values.shape[1]))
+    if len(starts) > 0:
+        sums[sorted_groups[starts]] = np.add.reduceat(values[order], starts, axis=0, dtype=np.float64)
+    return sums
+
+
+def average_efs(hourly_ef):
+    """
+    Calculates the month-hour, monthly and annual average emission factors, skipping missing hours
+    Args:
+        hourly_ef: pandas dataframe with a DatetimeIndex and one column of hourly emission factors per BA
+    Returns:
+        averages: dict of float64 arrays with one column per BA: 'monthhourly' (288 rows, one per
+            month * 24 + hour), 'monthly' (12 rows) and 'annual' (1 row). Groups without data are NaN
+    """
+    values = hourly_ef.to_numpy(dtype=np.float64)
+    averages = {}
+    for scheme in ['monthhourly', 'monthly', 'annual']:
+        codes, labels = ef_averages.calendar_codes(hourly_ef.index, scheme)
+        averages[scheme] = ef_averages.group_means(values, codes, len(labels))
+    return averages
+
+
+def building_locations(demand, location_level='location'):
+    """
+    Returns the BA of each demand column, from the location_level of a MultiIndex, or the first level if there
+    is no level with that name
+    """
+    if location_level in demand.columns.names:
+        return demand.columns.get_level_values(location_level)
+    return demand.columns.get_level_values(0)
+
+
+def calculate_inventories(demand, hourly_ef, locations=None, preserve_missing=True, buildings_per_block=256):
+    """
+    Calculates the inventory of each building with hourly, month-hour, monthly and annual average emission factors
+
+    Missing demand and emission factor values are skipped, as with pandas sums. If preserve_missing is True, the
+    hours with a missing hourly emission factor are also skipped at the average resolutions, so that every
+    resolution covers the same hours.
+
+    The buildings are processed in blocks. For each block, the demand is summed over the 288 month-hour groups
+    once (the monthly and annual sums follow from those), and the hourly inventory is the matrix product of
+    the block's (buildings x hours) demand and the (hours x BAs) emission factors.
+    Args:
+        demand: pandas dataframe with one row per hour, in the same order as hourly_ef, and one column per building
+        hourly_ef: pandas dataframe with a DatetimeIndex and one column of hourly emission factors per BA
+        locations: BA of each demand column. Defaults to the 'location' level (or first level) of the columns
+        preserve_missing: if True, skip the hours with missing hourly emission factors at every resolution
+        buildings_per_block: number of buildings for which to calculate the inventories at once
+    Returns:
+        inventory: dataframe indexed by the demand columns, with one column per resolution in RESOLUTIONS.
+            Buildings in a BA without emission factors are NaN
+        percent_error: dataframe with the relative error of each of the AVERAGE_RESOLUTIONS with respect to
+            the hourly inventory, as a fraction
+    """
+    if len(demand.index) != len(hourly_ef.index):
+        raise ValueError(f'demand has {len(demand.index)} hours but hourly_ef has {len(hourly_ef.index)}')
+    if locations is None:
+        locations = building_locations(demand)
+
+    ef = hourly_ef.to_numpy(dtype=np.float64)
+    valid = ~np.isnan(ef)
+    ef_filled = np.where(valid, ef, 0.)
+    # month-hour group of each hour, numbered as (month - 1) * 24 + hour
+    groups, _ = ef_averages.calendar_codes(hourly_ef.index, 'monthhourly')
+
+    # averages of groups without data contribute nothing, like the NaN products in a pandas sum
+    averages = {resolution: np.nan_to_num(values) for resolution, values in average_efs(hourly_ef).items()}
+
+    # column of each building's BA in hourly_ef, or -1 if there is none
+    ba_index = pd.Index(hourly_ef.columns).get_indexer(locations)
+    known = ba_index >= 0
+    ba_index = np.where(known, ba_index, 0)
+    apply_mask = preserve_missing and not valid.all()
+
+    n_buildings = len(demand.columns)
+    results = np.full((n_buildings, len(RESOLUTIONS)), np.nan)
+    for start in range(0, n_buildings, buildings_per_block):
+        block = slice(start, start + buildings_per_block)
+        values = np.nan_to_num(demand.iloc[:, block].to_numpy(dtype=np.float64))
+        block_ba = ba_index[block]
+        buildings = np.arange(values.shape[1])
+
+        # hourly inventory of every building in the block with the emission factors of every BA,
+        # keeping each building's own BA
+        results[block, 0] = (values.T @ ef_filled)[buildings, block_ba]
+
+        if apply_mask:
+            values *= valid[:, block_ba]
+        month_hour_demand = group_sums(values, groups, 288)
+        monthly_demand = month_hour_demand.reshape(12, 24, -1).sum(axis=1)
+        annual_demand = monthly_demand.sum(axis=0, keepdims=True)
+
+        results[block, 1] = (month_hour_demand * averages['monthhourly'][:, block_ba]).sum(axis=0)
+        results[block, 2] = (monthly_demand * averages['monthly'][:, block_ba]).sum(axis=0)
+        results[block, 3] = (annual_demand * averages['annual'][:, block_ba]).sum(axis=0)
+
+    results[~known] = np.nan
+    inventory = pd.DataFrame(results, index=demand.columns, columns=RESOLUTIONS)
+
+    percent_error = pd.DataFrame(index=demand.columns)
+    for resolution in AVERAGE_RESOLUTIONS:
+        percent_error[resolution] = (inventory[resolution] - inventory['hourly']) / inventory['hourly']
+
+    return inventory, percent_error
+
+
+def ba_demand_columns(ba, demand_dir=DEMAND_DIR):
+    """
+    Returns the names of the buildings in the demand file of a BA, without reading the demand data
+    """
+    return list(pd.read_csv(f'{demand_dir}/{ba}.csv.zip', compression='zip', nrows=0).columns)
+
+
+def read_ba_demand(ba, columns=None, demand_dir=DEMAND_DIR, dtype='float32'):
+    """
+    Reads the hourly demand of the buildings in a BA
+    Args:
+        ba: BA code, the name of the demand file
+        columns: list of the buildings to read. Reads all buildings if None
+        demand_dir: directory containing the {ba}.csv.zip demand files
+        dtype: dtype of the demand values
+    Returns:
+        demand: dataframe with one row per hour and a (location, building_type) column for each building
+    """
+    demand = pd.read_csv(f'{demand_dir}/{ba}.csv.zip', compression='zip', usecols=columns, dtype=dtype)
+    if columns is not None:
+        # usecols keeps the order of the file
+        demand = demand[columns]
+    demand.columns = pd.MultiIndex.from_product([[ba], demand.columns], names=['location', 'building_type'])
+    return demand
+
+
+def inventory_table(inventory, percent_error):
+    """
+    Combines the outputs of calculate_inventories into one table with a row per building, with the
+    inventory at each resolution and the percent error of each average resolution as error_{resolution}
+    """
+    table = pd.concat([inventory, percent_error.add_prefix('error_')], axis='columns')
+    return table.reset_index()
+
+
+def ba_inventories(ba, hourly_ef, demand_dir=DEMAND_DIR, columns_per_chunk=None, preserve_missing=True,
+                   store_dir=None):
+    """
+    Calculates the inventories of all buildings in one BA, reading columns_per_chunk buildings at a time
+    (all at once if None). Used as the task run for each BA in stream_inventories.
+    Args:
+        ba: BA code
+        hourly_ef: pandas dataframe with a DatetimeIndex and a column of hourly emission factors for ba
+        store_dir: if given, the demand is read from the columnar store in this directory (see demand_store)
+            instead of the csv.zip files in demand_dir
+    Returns:
+        table: dataframe with one row per building, as returned by inventory_table
+    """
+    if store_dir is None:
+        columns = ba_demand_columns(ba, demand_dir)
+    else:
+        columns = demand_store.read_store_index(ba, store_dir)['columns']
+    if columns_per_chunk is None:
+        columns_per_chunk = max(len(columns), 1)
+
+    tables = []
+    for start in range(0, len(columns), columns_per_chunk):
+        if store_dir is None:
+            demand = read_ba_demand(ba, columns[start:start + columns_per_chunk], demand_dir)
+        else:
+            demand = demand_store.read_ba_demand(ba, columns[start:start + columns_per_chunk], store_dir)
+        inventory, percent_error = calculate_inventories(demand, hourly_ef[[ba]], preserve_missing=preserve_missing)
+        tables.append(inventory_table(inventory, percent_error))
+    return pd.concat(tables, ignore_index=True)
+
+
+def stream_inventories(ba_list, hourly_ef, output_path=None, demand_dir=DEMAND_DIR, columns_per_chunk=None,
+                       preserve_missing=True, n_workers=1, store_dir=None):
+    """
+    Calculates the inventories of the buildings in every BA, one BA at a time, so that the national demand
+    data is never held in memory at once. Peak memory depends on the number of buildings read at a time
+    (columns_per_chunk, or a whole BA) and on the number of workers.
+
+    Reading a BA in chunks of columns parses its csv.zip demand file once per chunk, so chunks only need to be
+    used for BAs that are too large to read at once. The columnar store (store_dir) reads each chunk directly.
+    Args:
+        ba_list: list of BA codes
+        hourly_ef: pandas dataframe with a DatetimeIndex and one column of hourly emission factors per BA
+        output_path: if given, the results of each BA are appended to a csv at this path as they are calculated,
+            instead of being returned, so that the results of the BAs aren't held in memory either
+        demand_dir: directory containing the {ba}.csv.zip demand files
+        columns_per_chunk: number of buildings to read at a time from each file. Reads whole BAs if None
+        preserve_missing: see calculate_inventories
+        n_workers: number of worker processes to spread the BAs over. If 1, runs in the current process
+        store_dir: if given, the demand is read from the columnar store in this directory (see demand_store)
+    Returns:
+        table: dataframe with one row per building, as returned by inventory_table, or None if output_path is
+            given
+    """
+    bas = []
+    for ba in ba_list:
+        if store_dir is None:
+            has_demand = os.path.exists(f'{demand_dir}/{ba}.csv.zip')
+        else:
+            has_demand = os.path.exists(f'{store_dir}/{ba}.json')
+        if not has_demand:
+            print(f'No demand data for {ba}')
+        elif ba not in hourly_ef.columns:
+            print(f'No emission factors for {ba}')
+        else:
+            bas.append(ba)
+
+    # only send each worker the emission factors of its BA
+    task_efs = [hourly_ef[[ba]] for ba in bas]
+    n_tasks = len(bas)
+
+    pool = ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+    try:
+        if pool is None:
+            results = map(ba_inventories, bas, task_efs, [demand_dir] * n_tasks,
+                          [columns_per_chunk] * n_tasks, [preserve_missing] * n_tasks, [store_dir] * n_tasks)
+        else:
+            results = pool.map(ba_inventories, bas, task_efs, [demand_dir] * n_tasks,
+                               [columns_per_chunk] * n_tasks, [preserve_missing] * n_tasks, [store_dir] * n_tasks)
+
+        tables = []
+        n_written = 0
+        for table in results:
+            if output_path is None:
+                tables.append(table)
+            else:
+                table.to_csv(output_path, mode='w' if n_written == 0 else 'a', header=(n_written == 0), index=False)
+                n_written += 1
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    empty = pd.DataFrame(columns=['location', 'building_type'] + RESOLUTIONS
+                         + [f'error_{resolution}' for resolution in AVERAGE_RESOLUTIONS])
+    if output_path is not None:
+        if n_written == 0:
+            empty.to_csv(output_path, index=False)
+        return None
+    if not tables:
+        return empty
+    return pd.concat(tables, ignore_index=True)
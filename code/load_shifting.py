@@ -0,0 +1,195 @@
+"""
+Evaluates how much the emissions of buildings fall if they shift load from high to low emission factor hours
+
+A shift policy moves a fraction of the load in the n_hours highest emission factor hours of each day's flexible
+window to the n_hours lowest emission factor hours of the same window. The demand of all buildings in a BA is
+reshaped to buildings x days x 24 hours and shifted at once, using the ranking of each day's hours by the BA's
+emission factors. The reductions are compared under hourly and average (such as annual) accounting.
+
+Usage:
+    policies = policy_grid(shift_fractions=[0.1, 0.2], windows=[(0, 24), (8, 20)], n_hours=[2, 4])
+    reductions = evaluate_policies(demand, hourly_ef, policies)
+"""
+
+import itertools
+
+import numpy as np
+import pandas as pd
+
+import ef_averages
+import inventory
+
+
+# parameters of a shift policy
+#   shift_fraction: fraction of the load in each high emission factor hour that is shifted
+#   window_start, window_end: hours of the day within which load can be shifted, as [start, end). A window
+#       that starts after it ends covers the hours after window_start and before window_end of the same calendar
+#       day, so load is never shifted across midnight into another day (e.g. (22, 6) shifts within the early
+#       morning and late evening of each day)
+#   n_hours: number of hours of the window that load is shifted from, and the number it is shifted to
+#   conserve_energy: if True, the shifted load is spread evenly over the low emission factor hours so that the
+#       daily energy of each building is unchanged. If False, the shifted load is curtailed
+POLICY_COLUMNS = ['shift_fraction', 'window_start', 'window_end', 'n_hours', 'conserve_energy']
+
+
+def policy_grid(shift_fractions, windows=((0, 24),), n_hours=(4,), conserve_energy=(True,)):
+    """
+    Creates a policy for every combination of parameters
+    Args:
+        shift_fractions: list of shift fractions
+        windows: list of (window_start, window_end) hours
+        n_hours: list of numbers of hours to shift from and to
+        conserve_energy: list of conserve_energy values
+    Returns:
+        policies: dataframe with the POLICY_COLUMNS and one row per policy
+    """
+    rows = [(fraction, start, end, hours, conserve) for fraction, (start, end), hours, conserve
+            in itertools.product(shift_fractions, windows, n_hours, conserve_energy)]
+    return pd.DataFrame(rows, columns=POLICY_COLUMNS)
+
+
+def _window_hours(window_start, window_end):
+    """
+    Returns a boolean array marking the hours of the day in the window
+    """
+    hours = np.arange(24)
+    if window_start <= window_end:
+        return (hours >= window_start) & (hours < window_end)
+    return (hours >= window_start) | (hours < window_end)
+
+
+def rank_hours(ef, window, n_hours):
+    """
+    Finds the highest and lowest emission factor hours of each day within the window
+    Args:
+        ef: array of days x 24 hourly emission factors of a BA
+        window: boolean array marking the hours of the day in the window
+        n_hours: number of hours to select
+    Returns:
+        high: array of days x n_hours with the hours of the day with the highest emission factors
+        low: array of days x n_hours with the hours of the day with the lowest emission factors
+        can_shift: boolean array marking the days with at least 2 * n_hours window hours that have an emission
+            factor, so that the high and low hours don't overlap
+    """
+    if not 0 < n_hours <= 12:
+        raise ValueError(f'n_hours must be between 1 and 12, got {n_hours}')
+    eligible = window[np.newaxis, :] & ~np.isnan(ef)
+    high = np.argsort(np.where(eligible, ef, -np.inf), axis=1, kind='stable')[:, 24 - n_hours:]
+    low = np.argsort(np.where(eligible, ef, np.inf), axis=1, kind='stable')[:, :n_hours]
+    return high, low, eligible.sum(axis=1) >= 2 * n_hours
+
+
+def shift_load(demand, hourly_ef, shift_fraction, window_start=0, window_end=24, n_hours=4, conserve_energy=True,
+               locations=None):
+    """
+    Applies a shift policy to the demand of every building (see POLICY_COLUMNS for the parameters)
+    Args:
+        demand: pandas dataframe with one row per hour, in the same order as hourly_ef, and one column per
+            building, such as those returned by the load_data functions or inventory.read_ba_demand
+        hourly_ef: pandas dataframe with a DatetimeIndex of whole days and one column of hourly emission factors
+            per BA
+        locations: BA of each demand column. Defaults to the 'location' level (or first level) of the columns
+    Returns:
+        shifted: dataframe like demand with the shifted load. Buildings in a BA without emission factors are
+            not shifted
+    """
+    n_hours_total = len(hourly_ef.index)
+    if len(demand.index) != n_hours_total:
+        raise ValueError(f'demand has {len(demand.index)} hours but hourly_ef has {n_hours_total}')
+    if n_hours_total % 24 != 0 or (hourly_ef.index[::24].hour != 0).any():
+        raise ValueError('hourly_ef must cover whole days, starting at midnight')
+    if locations is None:
+        locations = inventory.building_locations(demand)
+
+    n_days = n_hours_total // 24
+    window = _window_hours(window_start, window_end)
+    values = np.nan_to_num(demand.to_numpy(dtype=np.float64))
+    ba_index = pd.Index(hourly_ef.columns).get_indexer(locations)
+    ef = hourly_ef.to_numpy(dtype=np.float64)
+
+    for ba in np.unique(ba_index[ba_index >= 0]):
+        columns = np.flatnonzero(ba_index == ba)
+        high, low, can_shift = rank_hours(ef[:, ba].reshape(n_days, 24), window, n_hours)
+        # days x 24 hours x buildings
+        days = values[:, columns].reshape(n_days, 24, len(columns))
+
+        shifted = shift_fraction * np.take_along_axis(days, high[:, :, np.newaxis], axis=1)
+        shifted *= can_shift[:, np.newaxis, np.newaxis]
+        np.put_along_axis(days, high[:, :, np.newaxis],
+                          np.take_along_axis(days, high[:, :, np.newaxis], axis=1) - shifted, axis=1)
+        if conserve_energy:
+            added = shifted.sum(axis=1, keepdims=True) / n_hours
+            np.put_along_axis(days, low[:, :, np.newaxis],
+                              np.take_along_axis(days, low[:, :, np.newaxis], axis=1) + added, axis=1)
+        values[:, columns] = days.reshape(n_hours_total, len(columns))
+
+    return pd.DataFrame(values, index=demand.index, columns=demand.columns)
+
+
+def evaluate_policies(demand, hourly_ef, policies, resolutions=('hourly', 'annual'), preserve_missing=True):
+    """
+    Calculates the emission reductions of each building under each shift policy
+
+    A policy only changes the load in the high and low emission factor hours of each day, so the reduction at
+    each resolution is calculated from the load moved in those hours and the emission factors of that resolution
+    in the same hours, without recalculating the inventories of the shifted demand.
+    Args:
+        demand: pandas dataframe with one row per hour and one column per building, see shift_load
+        hourly_ef: pandas dataframe with a DatetimeIndex of whole days and one column of hourly emission factors
+            per BA
+        policies: dataframe with the POLICY_COLUMNS, such as returned by policy_grid
+        resolutions: emission factor resolutions to account the emissions with, from inventory.RESOLUTIONS
+        preserve_missing: see inventory.calculate_inventories
+    Returns:
+        reductions: tidy dataframe with one row per policy, building and resolution, with the policy parameters,
+            the baseline and shifted emissions, the reduction (baseline - shifted) and the reduction as a fraction
+            of the baseline
+    """
+    resolutions = list(resolutions)
+    baseline, _ = inventory.calculate_inventories(demand, hourly_ef, preserve_missing=preserve_missing)
+    baseline = baseline[resolutions].to_numpy()
+
+    n_hours_total = len(hourly_ef.index)
+    if n_hours_total % 24 != 0 or (hourly_ef.index[::24].hour != 0).any():
+        raise ValueError('hourly_ef must cover whole days, starting at midnight')
+    n_days = n_hours_total // 24
+    ef = hourly_ef.to_numpy(dtype=np.float64)
+    # emission factor of each hour at each resolution, as days x 24 hours x BAs
+    resolution_efs = np.stack([ef if resolution == 'hourly' else
+                               ef_averages.broadcast_average_efs(hourly_ef, resolution, preserve_missing).to_numpy()
+                               for resolution in resolutions]).reshape(len(resolutions), n_days, 24, -1)
+
+    values = np.nan_to_num(demand.to_numpy(dtype=np.float64))
+    ba_index = pd.Index(hourly_ef.columns).get_indexer(inventory.building_locations(demand))
+    ba_days = {ba: values[:, ba_index == ba].reshape(n_days, 24, -1) for ba in np.unique(ba_index[ba_index >= 0])}
+
+    buildings = demand.columns.to_frame(index=False)
+    tables = []
+    for policy in policies[POLICY_COLUMNS].itertuples(index=False):
+        window = _window_hours(policy.window_start, policy.window_end)
+        reduction = np.zeros((len(resolutions), len(buildings.index)))
+        for ba, days in ba_days.items():
+            high, low, can_shift = rank_hours(ef[:, ba].reshape(n_days, 24), window, policy.n_hours)
+            # load moved out of each high emission factor hour: days x n_hours x buildings
+            moved = policy.shift_fraction * np.take_along_axis(days, high[:, :, np.newaxis], axis=1)
+            moved *= can_shift[:, np.newaxis, np.newaxis]
+            for i in range(len(resolutions)):
+                high_ef = np.take_along_axis(resolution_efs[i, :, :, ba], high, axis=1)
+                ba_reduction = np.einsum('dnb,dn->b', moved, high_ef)
+                if policy.conserve_energy:
+                    low_ef = np.take_along_axis(resolution_efs[i, :, :, ba], low, axis=1)
+                    ba_reduction -= np.einsum('db,d->b', moved.sum(axis=1), low_ef.mean(axis=1))
+                reduction[i, ba_index == ba] = ba_reduction
+
+        table = pd.concat([buildings] * len(resolutions), ignore_index=True)
+        table.insert(0, 'resolution', np.repeat(resolutions, len(buildings.index)))
+        table['baseline'] = baseline.T.ravel()
+        table['shifted'] = (baseline.T - reduction).ravel()
+        for position, (column, value) in enumerate(zip(POLICY_COLUMNS, policy)):
+            table.insert(position, column, value)
+        tables.append(table)
+
+    reductions = pd.concat(tables, ignore_index=True)
+    reductions['reduction'] = reductions['baseline'] - reductions['shifted']
+    reductions['reduction_fraction'] = reductions['reduction'] / reductions['baseline']
+    return reductions
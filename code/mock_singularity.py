@@ -0,0 +1,151 @@
+"""
+Local stand-in for the Singularity region_events/search API, for testing the downloaders in download_data offline
+
+The server returns deterministic 5-minute carbon intensity events for any region and window, paginated like the
+API, including the duplicate events (dedup keys that don't end in +00:00), events without source metadata and a
+change of emissions source partway through the year. It can also add latency and 429/503 errors, to test the
+concurrency, rate limiting and retries of the downloaders. To serve it on http://127.0.0.1:8060/v1, run from the
+code directory:
+
+    python mock_singularity.py
+
+and download from it with, for example:
+
+    server, base_url = start_mock_server(latency=0.05, error_rate=0.1)
+    dfs = download_data.download_singularity_data_concurrent('', ['CISO'], '2019-01-01', '2019-03-31',
+                                                             base_url=base_url)
+    server.shutdown()
+"""
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import pandas as pd
+
+
+# emissions source of the events before and after this date
+SOURCE_CHANGE = pd.Timestamp('2019-07-01', tz='UTC')
+
+
+def region_events(region, start, end):
+    """
+    Creates the events of a region for a window, as the API would return them
+    Args:
+        region: region code
+        start, end: pandas Timestamps with time zones, the first and last times of the window
+    Returns:
+        events: list of event dicts, in order of time, with a duplicate of some events
+    """
+    times = pd.date_range(start.ceil('5min'), end, freq='5min').tz_convert('UTC')
+    # deterministic values for each region and time
+    seed = sum(ord(character) for character in region)
+    minutes = (times.asi8 // 60_000_000_000).astype(np.int64)
+    phase = (minutes % 1440) / 1440 * 2 * np.pi
+    generated = 900 + 300 * np.sin(phase + seed) + (minutes * 7919 + seed) % 97
+    consumed = generated * 0.95 + (minutes * 104729 + seed) % 31
+
+    events = []
+    for i, time_utc in enumerate(times):
+        start_date = time_utc.isoformat()
+        event = {'start_date': start_date,
+                 'dedup_key': f'{region}:{start_date}',
+                 'data': {'generated_rate': float(generated[i]), 'consumed_rate': float(consumed[i])}}
+        # every 100th event is missing its source metadata, and the rest change source partway through the year
+        if minutes[i] % 500 != 0:
+            source = 'EGRID_2018' if time_utc < SOURCE_CHANGE else 'EGRID_2019'
+            event['meta'] = {'generated_emissions_source': source, 'consumed_emissions_source': source}
+        events.append(event)
+        # every 12th event also appears with a local time dedup key, which the downloaders skip
+        if minutes[i] % 60 == 0:
+            events.append(dict(event, dedup_key=f'{region}:{time_utc.tz_convert("Etc/GMT+8").isoformat()}',
+                               data={'generated_rate': -1., 'consumed_rate': -1.}))
+    return events
+
+
+def make_handler(latency=0., error_rate=0., seed=None):
+    """
+    Creates a request handler class for the mock API
+    Args:
+        latency: seconds to wait before answering each request
+        error_rate: fraction of requests that are answered with a 429 or 503 error instead
+        seed: seed of the random errors
+    """
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    class MockSingularityHandler(BaseHTTPRequestHandler):
+
+        def _respond(self, status, body, headers=None):
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            for header, value in (headers or {}).items():
+                self.send_header(header, value)
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            if latency:
+                time.sleep(latency)
+            with lock:
+                error = rng.random() < error_rate
+                status = rng.choice([429, 503])
+            if error:
+                self._respond(status, {'error': 'mock error'}, {'Retry-After': '0'} if status == 429 else None)
+                return
+
+            url = urlparse(self.path)
+            if not url.path.endswith('/region_events/search'):
+                self._respond(404, {'error': f'unknown path {url.path}'})
+                return
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            try:
+                start, end = pd.Timestamp(query['start']), pd.Timestamp(query['end'])
+                per_page, page = int(query.get('per_page', 1000)), int(query.get('page', 1))
+            except (KeyError, ValueError) as e:
+                self._respond(400, {'error': f'bad query: {e}'})
+                return
+
+            events = region_events(query.get('region', ''), start, end)
+            last_page = max((len(events) + per_page - 1) // per_page, 1)
+            self._respond(200, {'data': events[(page - 1) * per_page:page * per_page],
+                                'meta': {'pagination': {'this': page, 'last': last_page}}})
+
+        def log_message(self, format, *args):
+            # don't write every request to stderr
+            pass
+
+    return MockSingularityHandler
+
+
+def start_mock_server(host='127.0.0.1', port=0, latency=0., error_rate=0., seed=None):
+    """
+    Starts the mock API in a background thread
+    Args:
+        host, port: address to listen on. Port 0 picks a free port
+        latency, error_rate, seed: see make_handler
+    Returns:
+        server: the running server, stopped with server.shutdown()
+        base_url: url to pass as base_url to the downloaders
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(latency, error_rate, seed))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f'http://{host}:{server.server_address[1]}/v1'
+
+
+if __name__ == '__main__':
+    server = ThreadingHTTPServer(('127.0.0.1', 8060), make_handler())
+    print('Serving the mock Singularity API on http://127.0.0.1:8060/v1')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
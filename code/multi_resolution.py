@@ -0,0 +1,243 @@
+"""
+Emission factor statistics and inventory errors at any time resolution from prefix sums
+
+Notebook 1 compares 5-minute emission factors with their averages over 15 minutes up to a year. Instead of
+resampling the data once per resolution, PrefixSums calculates the cumulative sums of the emission factors,
+their squares and their products with demand once. The sum over any period is then the difference of two
+cumulative sums, so the mean, standard deviation and coefficient of variation of every period, and the
+inventory error of accounting with period averages, take O(1) per period at any resolution. Variances within
+the rounding error of the sums they are taken from, such as those of constant or single-value periods, are 0.
+"""
+
+import warnings
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.frequencies import to_offset
+from pandas.tseries.offsets import Tick, MonthBegin, QuarterBegin, YearBegin
+
+
+# number of rows after which the cumulative sums restart, see PrefixSums._cumulative
+ROWS_PER_BLOCK = 4096
+
+# variances below this fraction of the cumulative sums of squares they are calculated from, per value, are
+# rounding error and are set to 0. A few hundred times the float64 machine epsilon
+VARIANCE_TOLERANCE = 1e-13
+
+
+class PrefixSums:
+    """
+    Cumulative sums of one or more emission factor series, and optionally of demand, for calculating
+    statistics over periods of any length.
+
+    Usage:
+        sums = PrefixSums(ef)  # ef: dataframe with a DatetimeIndex and one column per region
+        sums.period_stats('MS')['cov']  # same as ef.resample('MS').apply(lambda x: x.std(ddof=0) / x.mean())
+        sums.variability(['15min', '30min', 'H', 'MS', 'QS', 'AS'])
+    """
+
+    def __init__(self, ef, demand=None):
+        """
+        Args:
+            ef: pandas dataframe (or series) of emission factors with a sorted DatetimeIndex
+            demand: demand for the inventory errors, in the same row order as ef. Either one column, used with
+                every emission factor column, or one column per emission factor column
+        """
+        if isinstance(ef, pd.Series):
+            ef = ef.to_frame()
+        self.index = ef.index
+        self.columns = ef.columns
+
+        values = ef.to_numpy(dtype=np.float64)
+        valid = ~np.isnan(values)
+        # center each column before summing the squares, so that the variances don't lose precision
+        # to the difference of two large cumulative sums
+        with np.errstate(invalid='ignore'):
+            self.center = np.nan_to_num(np.nanmean(np.where(valid, values, np.nan), axis=0))
+        centered = np.where(valid, values - self.center, 0.)
+
+        # the counts, sums and sums of squares side by side, so that the sums of a period are read in one lookup
+        self.moments = self._cumulative(np.hstack([valid.astype(np.float64), centered, centered ** 2]))
+
+        self.has_demand = demand is not None
+        if self.has_demand:
+            demand = np.asarray(demand, dtype=np.float64)
+            if demand.ndim == 1:
+                demand = demand[:, np.newaxis]
+            if demand.shape[0] != values.shape[0]:
+                raise ValueError(f'demand has {demand.shape[0]} rows but ef has {values.shape[0]}')
+            # only hours with an emission factor count towards the inventories, at every resolution
+            demand = np.where(valid, np.nan_to_num(demand), 0.)
+            self.demand = self._cumulative(demand)
+            self.demand_ef = self._cumulative(demand * np.where(valid, values, 0.))
+
+    @staticmethod
+    def _cumulative(values):
+        """
+        Cumulative sums along the rows, so that the sum of rows [a, b) is S[b] - S[a].
+
+        The sums restart every ROWS_PER_BLOCK rows, with the running total of the whole blocks kept separately,
+        so that the sum of a short period is the difference of two small numbers and keeps its precision
+        however long the series is.
+        Returns:
+            within: array with the sum of the rows before each row in its block, for rows 0 to len(values)
+            blocks: array with the sum of the rows before each block
+        """
+        n_rows, n_columns = values.shape
+        n_blocks = n_rows // ROWS_PER_BLOCK + 1
+        padded = np.zeros((n_blocks * ROWS_PER_BLOCK, n_columns))
+        padded[:n_rows] = values
+        padded = padded.reshape(n_blocks, ROWS_PER_BLOCK, n_columns)
+        block_totals = padded.sum(axis=1)
+        within = np.cumsum(padded, axis=1) - padded
+        blocks = np.concatenate([np.zeros((1, n_columns)), np.cumsum(block_totals[:-1], axis=0)])
+        return within.reshape(-1, n_columns)[:n_rows + 1], blocks
+
+    @staticmethod
+    def _period_sums(cumulative, edges, magnitude_columns=None):
+        """
+        Sums the rows of each period from the cumulative sums returned by _cumulative
+        Args:
+            magnitude_columns: slice of columns for which to also return the sum of the absolute values of the
+                cumulative sums that each period sum is the difference of, which bounds its rounding error
+        """
+        within, blocks = cumulative
+        within = within[edges]
+        blocks = blocks[edges // ROWS_PER_BLOCK]
+        sums = (blocks[1:] - blocks[:-1]) + (within[1:] - within[:-1])
+        if magnitude_columns is None:
+            return sums
+        within = np.abs(within[:, magnitude_columns])
+        blocks = np.abs(blocks[:, magnitude_columns])
+        return sums, (blocks[1:] + blocks[:-1]) + (within[1:] + within[:-1])
+
+    def _moment_sums(self, edges, with_magnitudes=False):
+        """
+        Splits the period sums of the moments into the count, sum and sum of squares of each column, and if
+        with_magnitudes is True, the rounding error bound of the sums of squares (see _period_sums)
+        """
+        n_columns = len(self.columns)
+        squares = slice(2 * n_columns, 3 * n_columns)
+        sums = self._period_sums(self.moments, edges, squares if with_magnitudes else None)
+        if with_magnitudes:
+            sums, magnitudes = sums
+        moments = [sums[:, i * n_columns:(i + 1) * n_columns] for i in range(3)]
+        return moments + [magnitudes] if with_magnitudes else moments
+
+    def period_edges(self, freq):
+        """
+        Splits the index into the periods that pandas resample(freq) would use
+        Args:
+            freq: pandas frequency string or offset, such as '15min', 'H', 'MS', 'QS' or 'AS'
+        Returns:
+            labels: DatetimeIndex with the start of each period
+            edges: integer array with the position of the first row of each period, and the number of rows last
+        """
+        offset = to_offset(freq)
+        n = len(self.index)
+        if n == 0:
+            return pd.DatetimeIndex([]), np.zeros(1, dtype=np.int64)
+
+        if isinstance(offset, Tick):
+            # resample bins fixed frequencies from midnight of the first day, and labels them from the bin of the
+            # first row. For frequencies that divide a day, this is index[0].floor(freq)
+            midnight = self.index[0].normalize()
+            start = midnight + (self.index[0] - midnight) // offset.delta * offset.delta
+        elif isinstance(offset, (MonthBegin, QuarterBegin, YearBegin)) and offset.n == 1:
+            start = offset.rollback(self.index[0].normalize())
+        else:
+            # other offsets (such as month ends) have their own closing and labelling rules, so take the periods
+            # from resample itself
+            counts = pd.Series(np.ones(n), index=self.index).resample(offset).count()
+            return counts.index, np.concatenate([[0], np.cumsum(counts.to_numpy())]).astype(np.int64)
+
+        labels = pd.date_range(start=start, end=self.index[-1], freq=offset)
+        edges = np.append(self.index.asi8.searchsorted(labels.asi8, side='left'), n).astype(np.int64)
+        return labels, edges
+
+    def period_stats(self, freq):
+        """
+        Calculates the statistics of the emission factors over each period
+        Args:
+            freq: pandas frequency of the periods, see period_edges
+        Returns:
+            stats: dict of dataframes with one row per period and one column per emission factor column:
+                'count' (number of non-missing values), 'mean', 'std' (population standard deviation)
+                and 'cov' (std / mean). Periods without data are NaN
+        """
+        labels, edges = self.period_edges(freq)
+        stats = self._period_stat_arrays(edges)
+        return {name: pd.DataFrame(values, index=labels, columns=self.columns) for name, values in stats.items()}
+
+    def _period_stat_arrays(self, edges):
+        """
+        Calculates the statistics of period_stats as arrays, for the periods between edges
+        """
+        count, total, total_squares, magnitudes = self._moment_sums(edges, with_magnitudes=True)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            centered_mean = total / count
+            variance = total_squares / count - centered_mean ** 2
+            # the difference of the two terms cancels to rounding error for constant or single-value periods,
+            # which can leave a small (or negative) variance. Clamp variances within the rounding error of the
+            # cumulative sums they come from to 0
+            tolerance = VARIANCE_TOLERANCE * magnitudes / count
+            variance = np.where(count > 0, np.where(variance > tolerance, variance, 0.), np.nan)
+            mean = centered_mean + self.center
+            std = np.sqrt(variance)
+            cov = std / mean
+
+        return {'count': count, 'mean': mean, 'std': std, 'cov': cov}
+
+    def variability(self, freqs):
+        """
+        Summarizes the variability of the emission factors within periods of each frequency, as in notebook 1
+        Args:
+            freqs: list of pandas frequencies
+        Returns:
+            variability: tidy dataframe with one row per frequency and emission factor column, with the mean
+                over all periods of the standard deviation ('std') and coefficient of variation ('cov')
+        """
+        rows = []
+        for freq in freqs:
+            _, edges = self.period_edges(freq)
+            stats = self._period_stat_arrays(edges)
+            with warnings.catch_warnings():
+                # columns without data have a NaN mean, as with pandas
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                mean_std = np.nanmean(stats['std'], axis=0)
+                mean_cov = np.nanmean(stats['cov'], axis=0)
+            for i, column in enumerate(self.columns):
+                rows.append({'freq': freq, 'column': column, 'std': mean_std[i], 'cov': mean_cov[i]})
+        return pd.DataFrame(rows)
+
+    def inventory_error(self, freq):
+        """
+        Calculates the relative error of the inventory calculated with the average emission factor of each
+        period, with respect to the inventory calculated with the original emission factors
+        Args:
+            freq: pandas frequency of the averaging periods
+        Returns:
+            error: series with the error of each emission factor column, as a fraction
+        """
+        if not self.has_demand:
+            raise ValueError('PrefixSums needs demand to calculate inventory errors')
+        _, edges = self.period_edges(freq)
+        count, total, _ = self._moment_sums(edges)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count + self.center
+        demand = self._period_sums(self.demand, edges)
+
+        # periods without emission factors have no demand that counts towards the inventory
+        averaged = np.where(count > 0, mean * demand, 0.).sum(axis=0)
+        actual = self._period_sums(self.demand_ef, np.array([0, len(self.index)]))[0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return pd.Series((averaged - actual) / actual, index=self.columns)
+
+    def inventory_errors(self, freqs):
+        """
+        Calculates inventory_error for each frequency
+        Returns:
+            errors: dataframe with one row per frequency and one column per emission factor column
+        """
+        return pd.DataFrame([self.inventory_error(freq) for freq in freqs], index=list(freqs))
@@ -0,0 +1,233 @@
+"""
+Evaluates the bias of average emission factors under future grid scenarios with more variable emission factors
+
+Each transform creates a set of scenario emission factors from the observed hourly emission factors, as an array
+of scenarios x hours x BAs. Since inventories are linear in demand, the demand of the buildings is aggregated
+into one profile per group (such as BA and building category) before evaluating the scenarios, and the
+inventories of all scenarios are calculated at once for each BA:
+    hourly: the (profiles x hours) demand of the BA times the (hours x scenarios) emission factors
+    averages: the demand summed over each group of hours times the group means of every scenario
+
+Usage:
+    tensor, scenarios = build_scenarios(hourly_ef, variance_factors=[1, 1.5, 2], solar_depths=[0.25, 0.5])
+    profiles = aggregate_demand(demand)
+    bias = scenario_bias(tensor, scenarios, hourly_ef, profiles)
+"""
+
+import numpy as np
+import pandas as pd
+
+import demand_store
+import ef_averages
+import inventory
+
+
+# shape of solar generation by hour of the day, as a fraction of the peak, used for the solar dip scenarios
+SOLAR_PROFILE = np.clip(np.sin((np.arange(24) + 0.5 - 6) / 12 * np.pi), 0, None)
+
+# average resolutions evaluated for each scenario, and the averaging scheme of each (see ef_averages)
+SCENARIO_RESOLUTIONS = ['monthhourly', 'monthly', 'annual']
+
+
+def _daily_means(values, index):
+    """
+    Returns the mean of each day for every hour, as an array of hours x columns, skipping missing values
+    """
+    days, labels = ef_averages.calendar_codes(index, index.normalize())
+    return ef_averages.group_means(values, days, len(labels))[days]
+
+
+def scale_intraday_variance(hourly_ef, factors, dtype=np.float32):
+    """
+    Scales the deviations of the emission factors from their daily mean, keeping the daily means. Scenario
+    emission factors are clipped at zero, so large factors can raise the daily mean of low-carbon days
+    Args:
+        hourly_ef: pandas dataframe with a DatetimeIndex and one column of hourly emission factors per BA
+        factors: list of factors to scale the intraday deviations by. 1 is the observed emission factors
+        dtype: dtype of the returned array
+    Returns:
+        tensor: array of len(factors) x hours x BAs
+    """
+    values = hourly_ef.to_numpy(dtype=np.float64)
+    daily_means = _daily_means(values, hourly_ef.index)
+    factors = np.asarray(factors, dtype=np.float64)[:, np.newaxis, np.newaxis]
+    return np.maximum(daily_means + factors * (values - daily_means), 0.).astype(dtype)
+
+
+def add_solar_dips(hourly_ef, depths, solar_profile=SOLAR_PROFILE, dtype=np.float32):
+    """
+    Lowers the emission factors during daylight hours, in the shape of solar generation
+    Args:
+        hourly_ef: pandas dataframe with a DatetimeIndex and one column of hourly emission factors per BA
+        depths: list of the fractions by which the emission factor is lowered at the solar peak
+        solar_profile: array with the shape of solar generation for each hour of the day, with a peak of 1
+        dtype: dtype of the returned array
+    Returns:
+        tensor: array of len(depths) x hours x BAs
+    """
+    values = hourly_ef.to_numpy(dtype=np.float64)
+    shape = np.asarray(solar_profile, dtype=np.float64)[hourly_ef.index.hour.to_numpy()]
+    depths = np.asarray(depths, dtype=np.float64)[:, np.newaxis, np.newaxis]
+    return (values * (1 - depths * shape[:, np.newaxis])).astype(dtype)
+
+
+def blend_profiles(hourly_ef, partners, weights, dtype=np.float32):
+    """
+    Blends the emission factors of each BA with the hourly profile of a partner BA, rescaled to the BA's own
+    annual mean, so that the BA takes on some of the partner's variability without changing its average
+    Args:
+        hourly_ef: pandas dataframe with a DatetimeIndex and one column of hourly emission factors per BA
+        partners: dict mapping BAs to the BA whose profile they are blended with. BAs that are not in the dict,
+            or whose partner has no emission factors, keep their own emission factors
+        weights: list of the weights of the partner profiles, from 0 (own profile) to 1 (partner profile)
+        dtype: dtype of the returned array
+    Returns:
+        tensor: array of len(weights) x hours x BAs
+    """
+    values = hourly_ef.to_numpy(dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.nanmean(values, axis=0)
+    columns = list(hourly_ef.columns)
+    partner_values = values.copy()
+    for i, ba in enumerate(columns):
+        partner = partners.get(ba)
+        if partner in columns and partner != ba:
+            j = columns.index(partner)
+            # keep the hours that are missing for the BA itself missing
+            partner_values[:, i] = np.where(np.isnan(values[:, i]), np.nan, values[:, j] * means[i] / means[j])
+    weights = np.asarray(weights, dtype=np.float64)[:, np.newaxis, np.newaxis]
+    return ((1 - weights) * values + weights * partner_values).astype(dtype)
+
+
+def build_scenarios(hourly_ef, variance_factors=(), solar_depths=(), blend_weights=(), partners=None,
+                    dtype=np.float32):
+    """
+    Creates the scenario emission factors of every transform
+    Args:
+        hourly_ef: pandas dataframe with a DatetimeIndex and one column of hourly emission factors per BA
+        variance_factors: factors for scale_intraday_variance
+        solar_depths: depths for add_solar_dips
+        blend_weights: weights for blend_profiles, with the partners dict
+        partners: dict mapping BAs to partner BAs for blend_profiles
+        dtype: dtype of the scenario emission factors
+    Returns:
+        tensor: array of scenarios x hours x BAs
+        scenarios: dataframe with the 'transform' and 'parameter' of each scenario
+    """
+    tensors = []
+    labels = []
+    if len(variance_factors) > 0:
+        tensors.append(scale_intraday_variance(hourly_ef, variance_factors, dtype))
+        labels += [('intraday_variance', factor) for factor in variance_factors]
+    if len(solar_depths) > 0:
+        tensors.append(add_solar_dips(hourly_ef, solar_depths, dtype=dtype))
+        labels += [('solar_dip', depth) for depth in solar_depths]
+    if len(blend_weights) > 0:
+        if partners is None:
+            raise ValueError('blend_weights needs a dict of partner BAs')
+        tensors.append(blend_profiles(hourly_ef, partners, blend_weights, dtype))
+        labels += [('blend', weight) for weight in blend_weights]
+    if not tensors:
+        raise ValueError('no scenarios to build')
+    return np.concatenate(tensors, axis=0), pd.DataFrame(labels, columns=['transform', 'parameter'])
+
+
+def aggregate_demand(demand, group_levels=('location', 'building_category')):
+    """
+    Sums the demand of the buildings in each group into one profile per group
+    Args:
+        demand: pandas dataframe with one row per hour and a (location, building_type) column for each building,
+            as read by inventory.read_ba_demand or load_data
+        group_levels: levels to group the buildings by. The first must be the BA. 'building_category' and
+            'climate_zone' are parsed from building_type if they are not levels of the columns
+    Returns:
+        profiles: dataframe with one row per hour and one column per group
+    """
+    group_levels = list(group_levels)
+    columns = demand.columns.to_frame(index=False)
+    if 'location' not in columns.columns:
+        columns = columns.rename(columns={columns.columns[0]: 'location'})
+    parsed = [level for level in group_levels if level not in columns.columns]
+    if parsed:
+        if 'building_type' not in columns.columns or \
+                any(level not in demand_store.METADATA_COLUMNS for level in parsed):
+            raise ValueError(f'demand has no {parsed} levels')
+        metadata = demand_store.building_metadata(columns['building_type'])
+        for level in parsed:
+            columns[level] = metadata[level].astype(str).to_numpy()
+
+    codes, groups = pd.MultiIndex.from_frame(columns[group_levels]).factorize(sort=True)
+    values = np.nan_to_num(demand.to_numpy(dtype=np.float64))
+    sums = inventory.group_sums(values.T, codes, len(groups)).T
+    return pd.DataFrame(sums, index=demand.index,
+                        columns=pd.MultiIndex.from_tuples(list(groups), names=group_levels))
+
+
+def scenario_inventories(tensor, hourly_ef, profiles, resolutions=SCENARIO_RESOLUTIONS, preserve_missing=True):
+    """
+    Calculates the inventories of every demand profile under every scenario
+    Args:
+        tensor: array of scenarios x hours x BAs, as returned by build_scenarios
+        hourly_ef: pandas dataframe of the observed hourly emission factors, with the hours and BAs of the tensor
+        profiles: dataframe with one row per hour and one column per demand profile, whose first column level
+            is the BA (see aggregate_demand)
+        resolutions: average resolutions to compare with the hourly inventories
+        preserve_missing: if True, the hours with a missing emission factor are skipped at every resolution
+    Returns:
+        inventories: array of scenarios x profiles x (1 + len(resolutions)), with the hourly inventory first.
+            Profiles in a BA without emission factors are NaN
+    """
+    n_scenarios, n_hours, n_bas = tensor.shape
+    if (n_hours, n_bas) != hourly_ef.shape or len(profiles.index) != n_hours:
+        raise ValueError('the tensor, hourly_ef and profiles must have the same hours and BAs')
+    resolutions = list(resolutions)
+    valid = ~np.isnan(hourly_ef.to_numpy(dtype=np.float64))
+    demand = np.nan_to_num(profiles.to_numpy(dtype=np.float64))
+    profile_bas = pd.Index(hourly_ef.columns).get_indexer(profiles.columns.get_level_values(0))
+    codes = {resolution: ef_averages.calendar_codes(hourly_ef.index, resolution) for resolution in resolutions}
+
+    results = np.full((n_scenarios, len(profiles.columns), 1 + len(resolutions)), np.nan)
+    for ba in np.unique(profile_bas[profile_bas >= 0]):
+        columns = np.flatnonzero(profile_bas == ba)
+        ef = tensor[:, :, ba].astype(np.float64).T
+        ba_valid = valid[:, ba]
+        ba_demand = demand[:, columns] * ba_valid[:, np.newaxis] if preserve_missing else demand[:, columns]
+
+        # hourly inventories of every profile under every scenario: profiles x scenarios
+        results[:, columns, 0] = (demand[:, columns].T @ np.where(np.isnan(ef), 0., ef)).T
+        for i, resolution in enumerate(resolutions):
+            groups, labels = codes[resolution]
+            means = np.nan_to_num(ef_averages.group_means(ef, groups, len(labels)))
+            group_demand = inventory.group_sums(ba_demand, groups, len(labels))
+            results[:, columns, i + 1] = (group_demand.T @ means).T
+    return results
+
+
+def scenario_bias(tensor, scenarios, hourly_ef, profiles, resolutions=SCENARIO_RESOLUTIONS, preserve_missing=True):
+    """
+    Calculates the percent error of each average resolution for every scenario and demand profile
+    Args:
+        tensor, scenarios: scenario emission factors and labels, as returned by build_scenarios
+        hourly_ef, profiles, resolutions, preserve_missing: see scenario_inventories
+    Returns:
+        bias: tidy dataframe with one row per scenario, profile and resolution, with the scenario labels, the
+            profile's column levels, the hourly inventory, the inventory at the resolution and the percent
+            error as a fraction
+    """
+    resolutions = list(resolutions)
+    results = scenario_inventories(tensor, hourly_ef, profiles, resolutions, preserve_missing)
+    n_scenarios, n_profiles, _ = results.shape
+    with np.errstate(invalid='ignore', divide='ignore'):
+        errors = (results[:, :, 1:] - results[:, :, :1]) / results[:, :, :1]
+
+    scenario_index = np.repeat(np.arange(n_scenarios), n_profiles * len(resolutions))
+    profile_index = np.tile(np.repeat(np.arange(n_profiles), len(resolutions)), n_scenarios)
+    bias = scenarios.iloc[scenario_index].reset_index(drop=True)
+    bias.insert(0, 'scenario', scenario_index)
+    profile_columns = profiles.columns.to_frame(index=False).iloc[profile_index].reset_index(drop=True)
+    bias = pd.concat([bias, profile_columns], axis='columns')
+    bias['resolution'] = np.tile(resolutions, n_scenarios * n_profiles)
+    bias['hourly'] = np.repeat(results[:, :, 0].ravel(), len(resolutions))
+    bias['inventory'] = results[:, :, 1:].ravel()
+    bias['error'] = errors.ravel()
+    return bias
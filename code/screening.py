@@ -6,20 +6,203 @@ Copied and modified from https://github.com/truggles/EIA_Cleaned_Hourly_Electric
 
 import pandas as pd
 import numpy as np
+import bisect
+import itertools
 import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
-def add_rolling_dem(df, short_hour_window, value_column):
-    df["rollingDem"] = df[value_column].rolling(
-        short_hour_window * 2, min_periods=1, center=True
-    ).median()
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    # numba is part of the emissions environment, but the array kernels below
+    # are plain python and still run (more slowly) without it
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+# Integer codes for the category labels that the screening can assign.
+# The filters work on these codes, and screen_anomolies converts them back to labels
+# unless compact output is requested. New categories must be added at the end so
+# that stored codes keep their meaning.
+CATEGORY_CODES = {'OKAY': 0,
+                  'MISSING': 1,
+                  'NEG_OR_ZERO': 2,
+                  'IDENTICAL_RUN': 3,
+                  'GLOBAL_DEM': 4,
+                  'GLOBAL_DEM_PLUS_MINUS': 5,
+                  'LOCAL_DEM_UP': 6,
+                  'LOCAL_DEM_DOWN': 7,
+                  'DELTA': 8,
+                  'SINGLE_DELTA': 9,
+                  'ANOMALOUS_REGION': 10}
+
+# category labels, in code order
+CATEGORIES = list(CATEGORY_CODES)
+
+
+def category_labels(codes):
+    """
+    Converts an array of category codes into an array of category label strings
+    """
+    return np.array(CATEGORIES, dtype=object)[np.asarray(codes)]
+
+
+# Window parameters can be given as time spans (anything accepted by pd.Timedelta, such as '48h' or '10D')
+# or as numbers. Numbers are read in the unit of the parameter name, hours for short_hour_window, iqr_hours
+# and anomalous_regions_width, and days for nDays, so the hourly parameters used so far keep their meaning.
+# The number of time steps in each window is derived from the frequency of the series.
+HOURLY = pd.Timedelta(hours=1)
+
+
+def infer_step(index, default=HOURLY):
+    """
+    Returns the time step of a series as a pd.Timedelta: the most common difference between consecutive
+    timestamps of a DatetimeIndex, so that gaps and daylight saving time changes are ignored.
+    Other indexes (such as the positional index used internally) are assumed to have the default step.
+    """
+    if isinstance(index, pd.DatetimeIndex) and len(index) > 1:
+        diffs = np.diff(index.to_numpy(dtype='datetime64[ns]'))
+        diffs, counts = np.unique(diffs[diffs > np.timedelta64(0)], return_counts=True)
+        if len(diffs) > 0:
+            return pd.Timedelta(diffs[np.argmax(counts)])
+    return pd.Timedelta(default)
+
+
+def window_steps(span, freq=HOURLY, unit='h'):
+    """
+    Number of time steps of length freq in a time span
+    Args:
+        span: time span, as a number of units or anything accepted by pd.Timedelta
+        freq: time step of the series, as anything accepted by pd.Timedelta
+        unit: unit of span if it is a number
+    Returns:
+        steps: integer number of steps
+    """
+    if isinstance(span, (int, float, np.integer, np.floating)):
+        span = pd.Timedelta(float(span), unit=unit)
+    steps = pd.Timedelta(span) / pd.Timedelta(freq)
+    if not np.isclose(steps, round(steps)):
+        raise ValueError(f'window of {span} is not a whole number of {pd.Timedelta(freq)} time steps')
+    return int(round(steps))
+
+
+def characteristics_reach(short_hour_window, iqr_hours, nDays, freq=HOURLY):
+    """
+    Number of time steps on each side of a time step that its demand characteristics depend on
+    """
+    return (window_steps(short_hour_window, freq) + window_steps(nDays, freq, unit='D')
+            + window_steps(iqr_hours, freq) + 1)
+
+
+@njit(cache=True)
+def _rolling_order_statistics(values, window, quantiles):
+    """
+    Centered rolling quantiles over a sorted window, skipping NaN.
+
+    The non-NaN values of the current window are kept sorted in a buffer. Moving
+    the window replaces the value that leaves it by the one that enters it, and
+    shifts only the part of the buffer between their positions. Every requested
+    quantile is then read from the same buffer.
+    """
+    n = values.shape[0]
+    output = np.full((n, quantiles.shape[0]), np.nan)
+    # same alignment as pandas rolling(window, center=True)
+    left = window // 2
+    right = window - 1 - left
+
+    buffer = np.empty(window)
+    count = 0
+    for t in range(-right, n):
+        leaving = values[t - left - 1] if t - left - 1 >= 0 else np.nan
+        entering = values[t + right] if t + right < n else np.nan
+
+        if not np.isnan(leaving) and not np.isnan(entering):
+            # replace the leaving value by the entering one and move it into place.
+            # Values one window apart tend to be close, so this usually moves few elements
+            k = np.searchsorted(buffer[:count], leaving)
+            if entering >= leaving:
+                while k + 1 < count and buffer[k + 1] < entering:
+                    buffer[k] = buffer[k + 1]
+                    k += 1
+            else:
+                while k > 0 and buffer[k - 1] > entering:
+                    buffer[k] = buffer[k - 1]
+                    k -= 1
+            buffer[k] = entering
+        else:
+            if not np.isnan(leaving):
+                k = np.searchsorted(buffer[:count], leaving)
+                for i in range(k, count - 1):
+                    buffer[i] = buffer[i + 1]
+                count -= 1
+            if not np.isnan(entering):
+                k = np.searchsorted(buffer[:count], entering)
+                for i in range(count, k, -1):
+                    buffer[i] = buffer[i - 1]
+                buffer[k] = entering
+                count += 1
+
+        if t < 0 or count == 0:
+            continue
+        for j in range(quantiles.shape[0]):
+            quantile = quantiles[j]
+            if quantile == 0.5:
+                # median, as the mean of the two middle values
+                mid = count // 2
+                if count % 2:
+                    output[t, j] = buffer[mid]
+                else:
+                    output[t, j] = (buffer[mid] + buffer[mid - 1]) / 2
+            else:
+                # linear interpolation, with the same arithmetic as pandas
+                position = quantile * (count - 1)
+                low = int(position)
+                if position == low:
+                    output[t, j] = buffer[low]
+                else:
+                    output[t, j] = buffer[low] + (buffer[low + 1] - buffer[low]) * (position - low)
+    return output
+
+
+def rolling_quantiles(values, window, quantiles):
+    """
+    Calculates several quantiles of a centered rolling window in a single pass.
+
+    Matches pandas `rolling(window, min_periods=1, center=True)` followed by `median()`
+    (for the 0.5 quantile) or `quantile(q)` (for any other q), with NaN values skipped.
+    Args:
+        values: 1d array or series of values
+        window: width of the rolling window in number of values
+        quantiles: list of quantiles between 0 and 1
+    Returns:
+        array with one row per value and one column per quantile
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if not NUMBA_AVAILABLE:
+        # the sorted window is only fast when compiled, so use the pandas skiplist instead
+        rolling_window = pd.Series(values).rolling(int(window), min_periods=1, center=True)
+        return np.column_stack([rolling_window.median() if q == 0.5 else rolling_window.quantile(q)
+                                for q in quantiles])
+    quantiles = np.asarray(quantiles, dtype=np.float64)
+    return _rolling_order_statistics(values, int(window), quantiles)
+
+
+def add_rolling_dem(df, short_hour_window, value_column, freq=HOURLY):
+    window = window_steps(short_hour_window, freq) * 2
+    df["rollingDem"] = rolling_quantiles(df[value_column], window, [0.5])[:, 0]
     return df
 
 
-def add_rolling_dem_long(df, nDays, value_column):
-    df["rollingDemLong"] = df[value_column].rolling(
-        nDays * 24 * 2, min_periods=1, center=True
-    ).median()
+def add_rolling_dem_long(df, nDays, value_column, freq=HOURLY):
+    window = window_steps(nDays, freq, unit='D') * 2
+    df["rollingDemLong"] = rolling_quantiles(df[value_column], window, [0.5])[:, 0]
     return df
 
 
@@ -52,24 +235,64 @@ def calculate_relative_demand_difference_IQR(df):
     return iqr_relative_deltas
 
     
-def add_demand_minus_rolling_dem_iqr(df, iqr_hours):
-    rolling_window = df["dem_minus_rolling"].rolling(iqr_hours * 2, min_periods=1, center=True)
-    df["dem_minus_rolling_IQR"] = rolling_window.quantile(0.75) - rolling_window.quantile(0.25)
+def add_demand_minus_rolling_dem_iqr(df, iqr_hours, freq=HOURLY):
+    quartiles = rolling_quantiles(df["dem_minus_rolling"], window_steps(iqr_hours, freq) * 2, [0.25, 0.75])
+    df["dem_minus_rolling_IQR"] = quartiles[:, 1] - quartiles[:, 0]
     return df
 
 
-def add_hourly_median_dem_deviations(df, nDays):
-    # Create a df to hold all values to take nanmedian later
-    vals_dem_minus_rolling = df['dem_minus_rolling']
-    # Loop over nDays days on each side
-    for i in range(-nDays, nDays+1):
-        # Already initialized with zero value
-        if i == 0:
-            continue
-        vals_dem_minus_rolling = pd.concat(
-            [vals_dem_minus_rolling, df.shift(periods=i*24)['dem_minus_rolling']], axis=1)
-
-    df['vals_dem_minus_rolling'] = vals_dem_minus_rolling.median(axis=1, skipna=True)
+def same_hour_median(values, nDays, steps_per_day=24, days_per_block=64):
+    """
+    Median of the values at the same hour of the day over the nDays days on each
+    side of every hour (including the hour itself), skipping NaN.
+
+    Equivalent to taking the row-wise median of the 2*nDays+1 copies of the data
+    shifted by multiples of one day, but computed from a strided view of a
+    day-by-hour array, so that no shifted copies are allocated. The medians are
+    taken a block of days at a time to bound the temporary memory.
+    Args:
+        values: 1d array of hourly values, or 2d array of hours x series
+        nDays: number of days on each side of each hour to include
+        steps_per_day: number of time steps in one day
+        days_per_block: number of days for which to compute the median at once
+    Returns:
+        array with the same shape as values
+    """
+    values = np.asarray(values, dtype=np.float64)
+    is_1d = values.ndim == 1
+    if is_1d:
+        values = values[:, np.newaxis]
+    n_steps, n_series = values.shape
+    n_days = -(-n_steps // steps_per_day)
+
+    # pad with NaN to whole days, plus nDays on each side for the shifts that fall off the ends
+    padded = np.full(((n_days + 2 * nDays) * steps_per_day, n_series), np.nan)
+    padded[nDays * steps_per_day:nDays * steps_per_day + n_steps] = values
+    days = padded.reshape(n_days + 2 * nDays, steps_per_day, n_series)
+
+    # view of shape (day, shift, hour, series), where day d and shift j refer to day d + j of the padded array
+    windows = np.lib.stride_tricks.as_strided(
+        days, shape=(n_days, 2 * nDays + 1, steps_per_day, n_series),
+        strides=(days.strides[0],) + days.strides, writeable=False)
+
+    medians = np.empty((n_days, steps_per_day, n_series))
+    with warnings.catch_warnings():
+        # hours with no data in any of the shifted days are NaN, as with pandas
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        for start in range(0, n_days, days_per_block):
+            medians[start:start + days_per_block] = np.nanmedian(windows[start:start + days_per_block], axis=1)
+
+    medians = medians.reshape(n_days * steps_per_day, n_series)[:n_steps]
+    if is_1d:
+        medians = medians[:, 0]
+    return medians
+
+
+def add_hourly_median_dem_deviations(df, nDays, freq=HOURLY):
+    # Take the median of the same time of day across nDays days on each side
+    df['vals_dem_minus_rolling'] = same_hour_median(df['dem_minus_rolling'].to_numpy(),
+                                                    window_steps(nDays, '1D', unit='D'),
+                                                    steps_per_day=window_steps('1D', freq))
     # 1+vals to make it a scale factor
     return df.assign(hourly_median_dem_dev=1.+df['vals_dem_minus_rolling']/df['rollingDemLong'])
 
@@ -82,70 +305,84 @@ def add_deltas(df, value_column):
     return df
 
 
-def add_rolling_delta_iqr(df, iqr_hours):
-    rolling_window = df["delta_pre"].rolling(iqr_hours * 2, min_periods=1, center=True)
-    df["delta_rolling_IQR"] = rolling_window.quantile(0.75) - rolling_window.quantile(0.25)
+def add_rolling_delta_iqr(df, iqr_hours, freq=HOURLY):
+    quartiles = rolling_quantiles(df["delta_pre"], window_steps(iqr_hours, freq) * 2, [0.25, 0.75])
+    df["delta_rolling_IQR"] = quartiles[:, 1] - quartiles[:, 0]
     return df
 
 
 def add_categories(df, value_column):
-    df['category'] = np.where(df[value_column].isna(), 'MISSING', 'OKAY')
+    df['category'] = np.where(df[value_column].isna(),
+                              CATEGORY_CODES['MISSING'], CATEGORY_CODES['OKAY']).astype(np.int8)
     return df
 
 
 def filter_neg_and_zeros(df, value_column):
-    df['category'] = np.where(df[value_column] <= 0., 'NEG_OR_ZERO', df['category'])
+    df['category'] = np.where(df[value_column] <= 0., CATEGORY_CODES['NEG_OR_ZERO'], df['category'])
     filtered = np.where(df[value_column] <= 0., df[value_column], np.nan)
     df['negAndZeroFiltered'] = filtered
     df[value_column] = df[value_column].mask(df[value_column] <= 0.)
     return df
 
     
-def filter_extrem_demand(df, multiplier, value_column):
-    med = np.nanmedian(df[value_column])
+def filter_extrem_demand(df, multiplier, value_column, med=None):
+    # the median can be passed in when df only holds part of the series
+    if med is None:
+        med = np.nanmedian(df[value_column])
     filtered = df[value_column].where(df[value_column] < med * multiplier)
     df['globalDemandFiltered'] = np.where(df[value_column] != filtered, df[value_column], np.nan)
     df['category'] = df['category'].mask(((df[value_column] != filtered) & \
-                    (df[value_column].notna())), other='GLOBAL_DEM')
+                    (df[value_column].notna())), other=CATEGORY_CODES['GLOBAL_DEM'])
     df[value_column] = filtered
     return df
 
 
 def filter_global_plus_minus_one(df, value_column):
-    globalDemPlusMinusFiltered = [np.nan for _ in df.index]
-    for idx in df.index:
-        if df.loc[idx, 'category'] == 'GLOBAL_DEM':
-            if df.loc[idx-1, 'category'] == 'OKAY':
-                df.loc[idx-1, 'category'] = 'GLOBAL_DEM_PLUS_MINUS'
-                globalDemPlusMinusFiltered[idx-1] = df.loc[idx-1, value_column]
-                df.loc[idx-1, value_column] = np.nan
-            if df.loc[idx+1, 'category'] == 'OKAY':
-                df.loc[idx+1, 'category'] = 'GLOBAL_DEM_PLUS_MINUS'
-                globalDemPlusMinusFiltered[idx+1] = df.loc[idx+1, value_column]
-                df.loc[idx+1, value_column] = np.nan
-    df['globalDemPlusMinusFiltered'] = globalDemPlusMinusFiltered
+    category = df['category'].to_numpy()
+    is_global = category == CATEGORY_CODES['GLOBAL_DEM']
+    # hours directly before or after a globally filtered hour
+    next_to_global = np.zeros(len(category), dtype=bool)
+    next_to_global[:-1] |= is_global[1:]
+    next_to_global[1:] |= is_global[:-1]
+    to_filter = next_to_global & (category == CATEGORY_CODES['OKAY'])
+
+    values = df[value_column].to_numpy(dtype=np.float64, copy=True)
+    df['category'] = np.where(to_filter, CATEGORY_CODES['GLOBAL_DEM_PLUS_MINUS'], category)
+    df['globalDemPlusMinusFiltered'] = np.where(to_filter, values, np.nan)
+    values[to_filter] = np.nan
+    df[value_column] = values
+    return df
+
+
+def _apply_filter(df, value_column, to_filter, filtered_column, category):
+    """
+    Sets value_column to NaN where to_filter is True, keeping the removed values in
+    filtered_column and marking the hours that had a value with the category code
+    """
+    values = df[value_column].to_numpy(dtype=np.float64, copy=True)
+    to_filter = to_filter & ~np.isnan(values)
+    df[filtered_column] = np.where(to_filter, values, np.nan)
+    df['category'] = np.where(to_filter, CATEGORY_CODES[category], df['category'])
+    values[to_filter] = np.nan
+    df[value_column] = values
     return df
-    
+
 
 def filter_local_demand(df, multiplier_up, multiplier_down, value_column):
-    
+
+    expected = df['rollingDem'].to_numpy() * df['hourly_median_dem_dev'].to_numpy()
+    iqr = df['dem_minus_rolling_IQR'].to_numpy()
+
     # Filter in two steps to provide different labels for the categories
-    filtered = df[value_column].where(
-            (df[value_column] < df['rollingDem'] * df['hourly_median_dem_dev'] + \
-                     multiplier_up * df['dem_minus_rolling_IQR']))
-    df['localDemandFilteredUp'] = np.where(df[value_column] != filtered, df[value_column], np.nan)
-    df['category'] = df['category'].mask(((df[value_column] != filtered) & \
-                    (df[value_column].notna())), other='LOCAL_DEM_UP')
-    df[value_column] = filtered
-    
-    filtered = df[value_column].where(
-            (df[value_column] > df['rollingDem'] * df['hourly_median_dem_dev'] - \
-                     multiplier_down * df['dem_minus_rolling_IQR']))
-    df['localDemandFilteredDown'] = np.where(df[value_column] != filtered, df[value_column], np.nan)
-    df['category'] = df['category'].mask(((df[value_column] != filtered) & \
-                    (df[value_column].notna())), other='LOCAL_DEM_DOWN')
-    df[value_column] = filtered
-    
+    # (comparisons with NaN are False, so hours without a threshold are filtered, as before)
+    upper = expected + multiplier_up * iqr
+    df = _apply_filter(df, value_column, ~(df[value_column].to_numpy() < upper),
+                       'localDemandFilteredUp', 'LOCAL_DEM_UP')
+
+    lower = expected - multiplier_down * iqr
+    df = _apply_filter(df, value_column, ~(df[value_column].to_numpy() > lower),
+                       'localDemandFilteredDown', 'LOCAL_DEM_DOWN')
+
     return df
 
 
@@ -154,18 +391,98 @@ def filter_local_demand(df, multiplier_up, multiplier_down, value_column):
 # Only consider "double deltas", hours with
 # large deltas on both sides
 def filter_deltas(df, multiplier, value_column):
-    
-    filtered = df[value_column].mask(
-            ((df['delta_pre'] > df['delta_rolling_IQR'] * multiplier) & \
-            (df['delta_post'] > df['delta_rolling_IQR'] * multiplier)) | \
-            ((df['delta_pre'] < -1. * df['delta_rolling_IQR'] * multiplier) & \
-            (df['delta_post'] < -1. * df['delta_rolling_IQR'] * multiplier)))
 
-    df['deltaFiltered'] = np.where(df[value_column] != filtered, df[value_column], np.nan)
-    df['category'] = df['category'].mask(((df[value_column] != filtered) & \
-                    (df[value_column].notna())), other='DELTA')
-    df[value_column] = filtered
-    return df
+    delta_pre = df['delta_pre'].to_numpy()
+    delta_post = df['delta_post'].to_numpy()
+    threshold = df['delta_rolling_IQR'].to_numpy() * multiplier
+
+    to_filter = ((delta_pre > threshold) & (delta_post > threshold)) | \
+                ((delta_pre < -1. * threshold) & (delta_post < -1. * threshold))
+
+    return _apply_filter(df, value_column, to_filter, 'deltaFiltered', 'DELTA')
+
+
+@njit(cache=True)
+def _single_sided_delta_steps(values, rel_diff, rel_diff_long, delta_iqr, multiplier, rel_threshold, reverse,
+                              start, prev_good, filtered, trace, critical, previous_trace, stop_below):
+    """
+    State machine for one direction of the single-sided delta filter, from row `start` with `prev_good` as the
+    previous good row (-1 if there is none yet).
+
+    Reads `values` without changing them. For every row visited, records the value if it is filtered (NaN
+    otherwise) in `filtered`, the previous good row after it in `trace`, and the relative delta that was compared
+    with rel_threshold (NaN if it wasn't) in `critical`. When `reverse` is True the rows are visited from last to
+    first, and the previous good row is never kept in place of the current one.
+    Stops at the first row before `stop_below` after which the previous good row, also before `stop_below`, is the
+    one in `previous_trace`, since every row after it would give the same results as before.
+    Returns the last row visited.
+    """
+    n = values.shape[0]
+    step = -1 if reverse else 1
+    end = -1 if reverse else n
+    idx = start
+    while idx != end:
+        filtered[idx] = np.nan
+        critical[idx] = np.nan
+        if not np.isnan(values[idx]):
+            # Initialize first good entry, this will never be flagged
+            if prev_good < 0:
+                prev_good = idx
+
+            # Check deltas demand and relative wrt hourly adjustment
+            prev_good_delta_dem = abs(values[prev_good] - values[idx])
+            prev_good_delta_rel = abs(rel_diff[prev_good] - rel_diff[idx])
+
+            if prev_good_delta_dem > delta_iqr[idx] * multiplier:
+                critical[idx] = prev_good_delta_rel
+            if (prev_good_delta_dem > delta_iqr[idx] * multiplier) and \
+                    (prev_good_delta_rel > rel_threshold):
+                keep_current = False
+                if not reverse:
+                    # same ordering as the builtin max(), which keeps the first
+                    # argument when the second is not larger (or is NaN)
+                    prev_max = abs(1. - rel_diff[prev_good])
+                    prev_long = abs(1. - rel_diff_long[prev_good])
+                    if prev_long > prev_max:
+                        prev_max = prev_long
+                    current_max = abs(1. - rel_diff[idx])
+                    current_long = abs(1. - rel_diff_long[idx])
+                    if current_long > current_max:
+                        current_max = current_long
+                    keep_current = abs(current_max) < abs(prev_max)
+                if keep_current:
+                    prev_good = idx
+                else:
+                    filtered[idx] = values[idx]
+            else:
+                prev_good = idx
+
+        trace[idx] = prev_good
+        if idx < stop_below and prev_good < stop_below and prev_good == previous_trace[idx]:
+            return idx
+        idx += step
+    return idx - step
+
+
+@njit(cache=True)
+def _single_sided_delta_pass(values, rel_diff, rel_diff_long, delta_iqr,
+                             multiplier, rel_threshold, reverse):
+    """
+    One direction of the single-sided delta filter over a whole series.
+
+    Works on plain arrays: `values` is modified in place (filtered hours are set
+    to NaN) and the filtered values are returned in an array that is NaN elsewhere.
+    """
+    n = values.shape[0]
+    filtered = np.empty(n)
+    trace = np.empty(n, dtype=np.int64)
+    critical = np.empty(n)
+    _single_sided_delta_steps(values, rel_diff, rel_diff_long, delta_iqr, multiplier, rel_threshold, reverse,
+                              n - 1 if reverse else 0, -1, filtered, trace, critical, trace, -1)
+    for idx in range(n):
+        if not np.isnan(filtered[idx]):
+            values[idx] = np.nan
+    return filtered
 
 
 # March through all hours recording previous "good"
@@ -175,96 +492,29 @@ def filter_deltas(df, multiplier, value_column):
 # Go forwards once, then backwards once to get all options.
 def filter_single_sided_deltas(df, multiplier, rel_multiplier, iqr_relative_deltas, value_column):
 
-
-    # Go through forwards first, then reverse
-    prev_good_index = np.nan
-    
-    deltaSingleFiltered = []
-    for idx in df.index:
-        deltaSingleFiltered.append(np.nan)
-        if np.isnan(df.loc[idx, value_column]):
-            continue
-        
-        
-        # Initialize first good entry, this will never be flagged
-        if np.isnan(prev_good_index):
-            prev_good_index = idx
-            
-        
-        # Check deltas demand and relative wrt hourly adjustment
-        prev_good_delta_dem = abs(df.loc[prev_good_index, value_column] - df.loc[idx, value_column])
-        prev_good_delta_dem_rel_diff_wrt_hourly = abs(df.loc[prev_good_index, 
-                        'dem_rel_diff_wrt_hourly'] - df.loc[idx, 'dem_rel_diff_wrt_hourly'])
-
-        
-        # delta_rolling_IQR is over 5 days on each side so should be
-        # similar regardless of which hours' we use. If delta is
-        # large, mark this hour anomalous
-        if (prev_good_delta_dem > df.loc[idx, 'delta_rolling_IQR'] * multiplier) and \
-                (prev_good_delta_dem_rel_diff_wrt_hourly > rel_multiplier * iqr_relative_deltas):
-            
-            
-            # If the previous "good" value was farther from expected values, then consider current hour good
-            # and the previous hour will be caught on the way back through the reverse direction.
-            # The max deviation from the rolling 4 day dem and the rolling 10 day dem is taken
-            # to help catch cases where a large deviation pulls the rolling 4 day dem to center
-            # on its values.  i.e. SCL 2016 Dec 15.
-            prev_max = max(abs(1. - df.loc[prev_good_index, 'dem_rel_diff_wrt_hourly']),
-                            abs(1. - df.loc[prev_good_index, 'dem_rel_diff_wrt_hourly_long']))
-            current_max = max(abs(1. - df.loc[idx, 'dem_rel_diff_wrt_hourly']),
-                            abs(1. - df.loc[idx, 'dem_rel_diff_wrt_hourly_long']))         
-            if abs(current_max) < abs(prev_max):
-                prev_good_index = idx
-            
-            # else, continue to filter this hour
-            else:
-                deltaSingleFiltered[-1] = df.loc[idx, value_column]
-                df.loc[idx, value_column] = np.nan
-                df.loc[idx, 'category'] = 'SINGLE_DELTA'
-        else:
-            prev_good_index = idx
-
-    
-    df['deltaSingleFilteredFwd'] = deltaSingleFiltered
-    
-    
-    ### Go through reversed, ~ copy of above code ###
-    prev_good_index = np.nan
-    
-    deltaSingleFiltered = []
-    for idx in reversed(df.index):
-        deltaSingleFiltered.append(np.nan)
-        if np.isnan(df.loc[idx, value_column]):
-            continue
-        
-        
-        # Initialize first good entry, this will never be flagged
-        if pd.isnull(prev_good_index): #original - if np.isnan(prev_good_index):
-            prev_good_index = idx
-            
-        
-        # Check deltas demand and relative wrt hourly adjustment
-        prev_good_delta_dem = abs(df.loc[prev_good_index, value_column] - df.loc[idx, value_column])
-        prev_good_delta_dem_rel_diff_wrt_hourly = abs(df.loc[prev_good_index, 
-                        'dem_rel_diff_wrt_hourly'] - df.loc[idx, 'dem_rel_diff_wrt_hourly'])
-
-        
-        # delta_rolling_IQR is over 5 days on each side so should be
-        # similar regardless of which hours' we use. If delta is
-        # large, mark this hour anomalous
-        if (prev_good_delta_dem > df.loc[idx, 'delta_rolling_IQR'] * multiplier) and \
-                (prev_good_delta_dem_rel_diff_wrt_hourly > rel_multiplier * iqr_relative_deltas):
-            
-            
-            deltaSingleFiltered[-1] = df.loc[idx, value_column]
-            df.loc[idx, value_column] = np.nan
-            df.loc[idx, 'category'] = 'SINGLE_DELTA'
-        else:
-            prev_good_index = idx
-
-    to_app = [val for val in reversed(deltaSingleFiltered)]
-    df['deltaSingleFilteredBkw'] = to_app
-    
+    values = df[value_column].to_numpy(dtype=np.float64, copy=True)
+    rel_diff = df['dem_rel_diff_wrt_hourly'].to_numpy(dtype=np.float64)
+    rel_diff_long = df['dem_rel_diff_wrt_hourly_long'].to_numpy(dtype=np.float64)
+    delta_iqr = df['delta_rolling_IQR'].to_numpy(dtype=np.float64)
+    rel_threshold = rel_multiplier * iqr_relative_deltas
+
+    # Go through forwards first. If the previous "good" value was farther from
+    # expected values, then the current hour is considered good and the previous
+    # hour will be caught on the way back through the reverse direction.
+    # The max deviation from the rolling 4 day dem and the rolling 10 day dem is taken
+    # to help catch cases where a large deviation pulls the rolling 4 day dem to center
+    # on its values.  i.e. SCL 2016 Dec 15.
+    filtered_fwd = _single_sided_delta_pass(values, rel_diff, rel_diff_long, delta_iqr,
+                                            multiplier, rel_threshold, False)
+    # Then go through reversed, which sees the hours removed on the forward pass
+    filtered_bkw = _single_sided_delta_pass(values, rel_diff, rel_diff_long, delta_iqr,
+                                            multiplier, rel_threshold, True)
+
+    df['deltaSingleFilteredFwd'] = filtered_fwd
+    df['deltaSingleFilteredBkw'] = filtered_bkw
+    df[value_column] = values
+    df['category'] = np.where(~np.isnan(filtered_fwd) | ~np.isnan(filtered_bkw),
+                              CATEGORY_CODES['SINGLE_DELTA'], df['category'])
     return df
 
 
@@ -277,104 +527,91 @@ def filter_runs(df, value_column):
     filtered = df[value_column].mask((d1 == 0) & (d2 == 0))
     df['runFiltered'] = np.where(df[value_column] != filtered, df[value_column], np.nan)
     df[value_column] = filtered
-    df['category'] = np.where(df['runFiltered'].notna(), 'IDENTICAL_RUN', df['category'])
+    df['category'] = np.where(df['runFiltered'].notna(), CATEGORY_CODES['IDENTICAL_RUN'], df['category'])
     return df
     
 
-def filter_anomalous_regions(df, width, anomalous_pct, value_column):
-    
-    percent_good_data_cnt = [0. for _ in df.index]
-    percent_good_data_pre = [0. for _ in df.index]
-    percent_good_data_post = [0. for _ in df.index]
-    df['len_good_data'] = [0 for _ in df.index]
-    data_quality_cnt = []
-    data_quality_short = []
-    start_good_data = np.nan
-    end_good_data = np.nan
-    for idx in df.index:
-            
-        # Remove the oldest item in the list
-        if len(data_quality_short) > width:
-            data_quality_short.pop(0)
-        if len(data_quality_cnt) > 2 * width:
-            data_quality_cnt.pop(0)
-        
-        # Add new item and don't count MISSING as 'bad' data
-        if df.loc[idx, 'category'] == 'OKAY' or df.loc[idx, 'category'] == 'MISSING':
-            data_quality_cnt.append(1)
-            data_quality_short.append(1)
-            # Track length of good data chunks
-            if np.isnan(start_good_data):
-                start_good_data = idx
-            end_good_data = idx
-        else:
-            data_quality_cnt.append(0)
-            data_quality_short.append(0)
-            # Fill in length of good data chunk
-            if not (np.isnan(start_good_data) or np.isnan(end_good_data)):
-                len_good = end_good_data - start_good_data + 1
-                df.loc[start_good_data:end_good_data, 'len_good_data'] = len_good
-            start_good_data = np.nan
-            end_good_data = np.nan
-
-        
-        # centered measurements have length 2 * width
-        if len(data_quality_cnt) > 2 * width:
-            percent_good_data_cnt[idx-width] = np.mean(data_quality_cnt)
-        # left and right / pre and post measurements have length = width + 1
-        if len(data_quality_short) > width:
-            percent_good_data_pre[idx] = np.mean(data_quality_short)
-            percent_good_data_post[idx-width] = np.mean(data_quality_short)
-
-
-
-    
-    anomalousRegionsFiltered = [np.nan for _ in df.index]
-    for idx in df.index:
-        if percent_good_data_cnt[idx] <= anomalous_pct:
-            for j in range(idx-width, idx+width):
-                if j < 1 or j >= len(df.index):
-                    continue
-                if df.loc[j, 'category'] == 'OKAY':
-                    # If this is the start or end of continuous good data, don't filter
-                    if percent_good_data_pre[j] == 1.0 or percent_good_data_post[j] == 1.0:
-                        continue
-                    if df.loc[j, 'len_good_data'] > width:
-                        continue
-                    df.loc[j, 'category'] = 'ANOMALOUS_REGION'
-                    anomalousRegionsFiltered[j] = df.loc[j, value_column]
-                    df.loc[j, value_column] = np.nan
-    
-
-    df['anomalousRegionsFiltered'] = anomalousRegionsFiltered
+def _anomalous_regions(category, width, anomalous_pct):
+    """
+    Finds the hours to filter with the anomalous regions filter, from the category codes of one series
+    Args:
+        category: 1d array of category codes
+        width: width of the regions in time steps
+        anomalous_pct: required fraction of good data in a region
+    Returns:
+        to_filter: boolean array marking the hours to filter
+        len_good_data: array with the length of the chunk of good data that each hour is in
+    """
+    n = len(category)
+
+    # don't count MISSING as 'bad' data
+    good = (category == CATEGORY_CODES['OKAY']) | (category == CATEGORY_CODES['MISSING'])
+    good_cumsum = np.concatenate([[0], np.cumsum(good)])
+
+    # left and right / pre and post measurements have length = width + 1
+    # and are only defined where the full window fits in the data
+    percent_good_data_pre = np.zeros(n)
+    percent_good_data_post = np.zeros(n)
+    if n > width:
+        short_means = (good_cumsum[width+1:] - good_cumsum[:n-width]) / (width + 1)
+        percent_good_data_pre[width:] = short_means
+        percent_good_data_post[:n-width] = short_means
+
+    # centered measurements have length 2 * width + 1
+    percent_good_data_cnt = np.zeros(n)
+    if n > 2 * width:
+        percent_good_data_cnt[width:n-width] = (good_cumsum[2*width+1:] - good_cumsum[:n-2*width]) / (2*width + 1)
+
+    # Track length of good data chunks using a run-length encoding of the good hours.
+    # A chunk only gets its length once a bad hour closes it, so a chunk that runs
+    # to the end of the data keeps a length of 0
+    edges = np.diff(np.concatenate([[0], good.astype(np.int8), [0]]))
+    chunk_starts = np.flatnonzero(edges == 1)
+    chunk_ends = np.flatnonzero(edges == -1)
+    chunk_lengths = np.where(chunk_ends < n, chunk_ends - chunk_starts, 0)
+    # hours before the first chunk get id -1, which points at the appended 0
+    chunk_lengths = np.append(chunk_lengths, 0)
+    chunk_id = np.cumsum(edges[:-1] == 1) - 1
+    len_good_data = np.where(good, chunk_lengths[chunk_id], 0)
+
+    # An hour j is inside the region [idx-width, idx+width) of some anomalous
+    # hour idx if there is an anomalous hour in (j-width, j+width]
+    anomalous = percent_good_data_cnt <= anomalous_pct
+    anomalous_cumsum = np.concatenate([[0], np.cumsum(anomalous)])
+    positions = np.arange(n)
+    lower = np.clip(positions - width + 1, 0, n)
+    upper = np.clip(positions + width + 1, 0, n)
+    in_region = (anomalous_cumsum[upper] - anomalous_cumsum[lower]) > 0
+
+    to_filter = (in_region
+                 & (positions >= 1)
+                 & (category == CATEGORY_CODES['OKAY'])
+                 # If this is the start or end of continuous good data, don't filter
+                 & (percent_good_data_pre != 1.0)
+                 & (percent_good_data_post != 1.0)
+                 & (len_good_data <= width))
+    return to_filter, len_good_data
+
+
+def filter_anomalous_regions(df, width, anomalous_pct, value_column, freq=HOURLY):
+
+    category = df['category'].to_numpy()
+    to_filter, len_good_data = _anomalous_regions(category, window_steps(width, freq), anomalous_pct)
+    df['len_good_data'] = len_good_data
+
+    values = df[value_column].to_numpy(dtype=np.float64, copy=True)
+    df['anomalousRegionsFiltered'] = np.where(to_filter, values, np.nan)
+    df['category'] = np.where(to_filter, CATEGORY_CODES['ANOMALOUS_REGION'], category)
+    values[to_filter] = np.nan
+    df[value_column] = values
     return df
 
-def screen_anomolies(data, value_column,
-                    short_hour_window, # 48 hour moving median (M_{t,48hr})
-                    iqr_hours, # width in hours of IQR values of relative deviations from diurnal cycle template (IQR_{dem,t})
-                    nDays, # Used for normalized hourly demand template (h_{t,diurnal}) and 480 hour moving median (M_{t,480hr})
-                    global_dem_cut, # threshold selection for global demand filter
-                    local_dem_cut_up, # upwards threshold for local demand filter
-                    local_dem_cut_down, # downwards threshold for local demand filter
-                    delta_multiplier, # selection threshold for double-sided delta filter
-                    delta_single_multiplier, # selection threshold for single-sided delta filter
-                    rel_multiplier, # other selection threshold for single-sided delta filter
-                    anomalous_regions_width, # width in hours of anomalous region filter
-                    anomalous_pct # required pct of good data in anomalous region filter
-                    ):
-    
-    df = data.copy()
-    
-    # Add category labels to track which algo screens an hourly value
-    df = add_categories(df, value_column)
+def screen_step_1(df, value_column, global_dem_cut, med=None):
+    """
+    Screening Step 1: filters that only look at each hour and its direct neighbours, plus the global demand filter.
+    The median for the global demand filter can be passed in as med when df only holds part of the series.
+    """
 
-    # Mark missing and empty values
-    df = df.assign(missing=df[value_column].isna())
-    
-    #---------------------------------------------
-    # Screening Step 1
-    #---------------------------------------------
-    
     # Set all negative and zero values to NAN
     # (negative or zero filter)
     df = filter_neg_and_zeros(df, value_column)
@@ -385,39 +622,42 @@ def screen_anomolies(data, value_column,
 
     # Global demand filter on 10x the median value
     # (global demand filter)
-    df = filter_extrem_demand(df, global_dem_cut, value_column)
+    df = filter_extrem_demand(df, global_dem_cut, value_column, med=med)
 
     # Filter +/- 1 hour from any global deman filtered hours
     # (global demand plus/minus 1 hour filter)
     df = filter_global_plus_minus_one(df, value_column)
 
+    return df
 
 
-    
-    #---------------------------------------------
-    # Calculate demand characteristics for Step 2
-    #---------------------------------------------
-    
+def add_demand_characteristics(df, value_column, short_hour_window, iqr_hours, nDays, freq=HOURLY):
+    """
+    Adds the rolling demand characteristics used by Step 2. Every column added here only depends
+    on the Step 1 output within characteristics_reach(short_hour_window, iqr_hours, nDays, freq)
+    time steps of each time step.
+    """
+
     # 48 hour moving median (M_{t,48hr})
-    df = add_rolling_dem(df, short_hour_window, value_column)
+    df = add_rolling_dem(df, short_hour_window, value_column, freq)
 
     # 480 hour moving median (M_{t,480hr})
-    df = add_rolling_dem_long(df, nDays, value_column)
+    df = add_rolling_dem_long(df, nDays, value_column, freq)
 
     # demand minus moving median (Delta(d_{t},M_{t,48hr}))
     df = add_demand_minus_rolling_dem(df, value_column)
 
     # IQR values of relative deviations from diurnal cycle template (IQR_{dem,t})
-    df = add_demand_minus_rolling_dem_iqr(df, iqr_hours)
+    df = add_demand_minus_rolling_dem_iqr(df, iqr_hours, freq)
 
     # demand deltas (delta(d_{t-1},d_{t}))
     df = add_deltas(df, value_column)
 
     # IQR values of demand deltas (IQR_{delta,t})
-    df = add_rolling_delta_iqr(df, iqr_hours)
+    df = add_rolling_delta_iqr(df, iqr_hours, freq)
 
     # normalized hourly demand template (h_{t,diurnal})
-    df = add_hourly_median_dem_deviations(df, nDays)
+    df = add_hourly_median_dem_deviations(df, nDays, freq)
 
     # Demand deviation from hourly diurnal template (r_{t})
     # This adds both the short and long moving medians
@@ -428,28 +668,1018 @@ def screen_anomolies(data, value_column,
     # This adds differences for both the short and long moving medians
     df = add_delta_demand_rel_diff_wrt_hourly(df)
 
-    # Calculate the global IQR for the hour-to-hour differences 
-    # between hourly diurnal templates (IQR_{r})
-    # This is a global value and is not added to the dataframe
-    iqr_relative_deltas = calculate_relative_demand_difference_IQR(df)
+    return df
 
 
-    
-    #---------------------------------------------
-    # Screening Step 2
-    #---------------------------------------------
-    
+def screen_step_2(df, value_column, iqr_relative_deltas,
+                  local_dem_cut_up, local_dem_cut_down, delta_multiplier,
+                  delta_single_multiplier, rel_multiplier, anomalous_regions_width, anomalous_pct, freq=HOURLY):
+    """
+    Screening Step 2: filters based on the demand characteristics
+    """
+
     # (local demand filter)
     df = filter_local_demand(df, local_dem_cut_up, local_dem_cut_down, value_column)
-    
+
     # (double-sided delta filter)
     df = filter_deltas(df, delta_multiplier, value_column)
-    
+
     # (single-sided delta filter)
     df = filter_single_sided_deltas(df, delta_single_multiplier,
                                 rel_multiplier, iqr_relative_deltas, value_column)
-    
+
     # (anomalous regions filter)
-    df = filter_anomalous_regions(df, anomalous_regions_width, anomalous_pct, value_column)
+    df = filter_anomalous_regions(df, anomalous_regions_width, anomalous_pct, value_column, freq)
+
+    return df
+
+
+def screen_anomolies(data, value_column,
+                    short_hour_window, # 48 hour moving median (M_{t,48hr})
+                    iqr_hours, # width in hours of IQR values of relative deviations from diurnal cycle template (IQR_{dem,t})
+                    nDays, # Used for normalized hourly demand template (h_{t,diurnal}) and 480 hour moving median (M_{t,480hr})
+                    global_dem_cut, # threshold selection for global demand filter
+                    local_dem_cut_up, # upwards threshold for local demand filter
+                    local_dem_cut_down, # downwards threshold for local demand filter
+                    delta_multiplier, # selection threshold for double-sided delta filter
+                    delta_single_multiplier, # selection threshold for single-sided delta filter
+                    rel_multiplier, # other selection threshold for single-sided delta filter
+                    anomalous_regions_width, # width in hours of anomalous region filter
+                    anomalous_pct, # required pct of good data in anomalous region filter
+                    compact=False, # only return the screened values and category codes
+                    freq=None # time step of the series, inferred from the index if None
+                    ):
+    """
+    Screens a demand series for anomalous values.
+
+    The window parameters are time spans (see window_steps), so the same parameters can be used for
+    hourly and sub-hourly series. The time step is inferred from a DatetimeIndex, or taken as one hour.
+
+    By default returns a copy of data with the screened value_column, a 'category' column of
+    category labels, and every intermediate column added by the filters. If compact is True,
+    only returns value_column as float32 and 'category' as int8 codes (see CATEGORY_CODES).
+    """
+    if freq is None:
+        freq = infer_step(data.index)
+
+    df = data.copy()
+    
+    # Add category labels to track which algo screens an hourly value
+    df = add_categories(df, value_column)
 
-    return df
\ No newline at end of file
+    # Mark missing and empty values
+    df = df.assign(missing=df[value_column].isna())
+    
+    #---------------------------------------------
+    # Screening Step 1
+    #---------------------------------------------
+
+    df = screen_step_1(df, value_column, global_dem_cut)
+
+    #---------------------------------------------
+    # Calculate demand characteristics for Step 2
+    #---------------------------------------------
+
+    df = add_demand_characteristics(df, value_column, short_hour_window, iqr_hours, nDays, freq)
+
+    # Calculate the global IQR for the hour-to-hour differences 
+    # between hourly diurnal templates (IQR_{r})
+    # This is a global value and is not added to the dataframe
+    iqr_relative_deltas = calculate_relative_demand_difference_IQR(df)
+
+    #---------------------------------------------
+    # Screening Step 2
+    #---------------------------------------------
+
+    df = screen_step_2(df, value_column, iqr_relative_deltas,
+                       local_dem_cut_up, local_dem_cut_down, delta_multiplier,
+                       delta_single_multiplier, rel_multiplier, anomalous_regions_width, anomalous_pct, freq)
+
+    return format_screening_output(df, value_column, compact)
+
+
+def format_screening_output(df, value_column, compact=False):
+    """
+    Returns either the compact output (float32 values and int8 category codes) or the full
+    frame with category labels, for a frame screened with category codes
+    """
+    if compact:
+        return pd.DataFrame({value_column: df[value_column].to_numpy(dtype=np.float32),
+                             'category': df['category'].to_numpy(dtype=np.int8)},
+                            index=df.index)
+    df['category'] = category_labels(df['category'])
+    return df
+
+
+def _carried_single_sided_pass(values, rel_diff, rel_diff_long, delta_iqr, multiplier, rel_threshold, reverse,
+                               state):
+    """
+    Runs one direction of the single-sided delta filter over one chunk of a series, starting from the previous good
+    hour of the chunks already visited in that direction.
+    Args:
+        values: 1d array of the chunk, modified in place
+        state: (value, dem_rel_diff_wrt_hourly, dem_rel_diff_wrt_hourly_long) of the previous good hour, or None
+            if no hour has been visited yet
+    Returns:
+        filtered: array with the filtered values, NaN elsewhere
+        state: the previous good hour for the next chunk in the same direction
+    """
+    if state is not None:
+        # the previous good hour is added as an extra hour before the chunk (after it when going backwards),
+        # which the kernel starts from and never filters
+        def extend(array, value):
+            return np.append(array, value) if reverse else np.concatenate([[value], array])
+        chunk = slice(0, -1) if reverse else slice(1, None)
+        extended = extend(values, state[0])
+        filtered = _single_sided_delta_pass(extended, extend(rel_diff, state[1]), extend(rel_diff_long, state[2]),
+                                            extend(delta_iqr, np.nan), multiplier, rel_threshold, reverse)
+        values[:] = extended[chunk]
+        filtered = filtered[chunk]
+    else:
+        filtered = _single_sided_delta_pass(values, rel_diff, rel_diff_long, delta_iqr,
+                                            multiplier, rel_threshold, reverse)
+
+    # every hour left with a value became the previous good hour when it was visited
+    good = np.flatnonzero(~np.isnan(values))
+    if len(good) > 0:
+        last = good[0] if reverse else good[-1]
+        state = (values[last], rel_diff[last], rel_diff_long[last])
+    return filtered, state
+
+
+def screen_anomolies_chunked(data, value_column,
+                             short_hour_window,
+                             iqr_hours,
+                             nDays,
+                             global_dem_cut,
+                             local_dem_cut_up,
+                             local_dem_cut_down,
+                             delta_multiplier,
+                             delta_single_multiplier,
+                             rel_multiplier,
+                             anomalous_regions_width,
+                             anomalous_pct,
+                             chunk_size='90D',
+                             freq=None
+                             ):
+    """
+    Screens a long series one chunk at a time, with the same results as screen_anomolies(..., compact=True).
+
+    Meant for sub-hourly series, which have many more time steps per year. Every stage runs on one chunk at a time,
+    extended on each side by the widest window it reads (see characteristics_reach), so the intermediate columns
+    only ever exist for one chunk. Across chunks, the screening only carries:
+      - the values that the global statistics are taken from: the values left by the negative/zero and identical run
+        filters for the median of the global demand filter, and the deltas of the relative demand for IQR_{r}
+      - the previous good hour of the single-sided delta filter, at the start of every chunk for the forward pass
+        and from the chunk after for the backward pass
+      - the screened values and category codes that are returned.
+    The Step 1 and demand characteristics of a chunk are computed three times: for IQR_{r}, for the forward pass
+    and again, going back through the chunks, for the backward pass.
+    The screening parameters are the same as for screen_anomolies.
+    Args:
+        data: pandas dataframe containing value_column
+        chunk_size: time span of each chunk, as a number of days or anything accepted by pd.Timedelta
+        freq: time step of the series, inferred from the index if None
+    Returns:
+        dataframe with value_column as float32 and 'category' as int8 codes, on the index of data
+    """
+    if freq is None:
+        freq = infer_step(data.index)
+    values = data[[value_column]].reset_index(drop=True)
+    n = len(values.index)
+    chunk_steps = max(window_steps(chunk_size, freq, unit='D'), 1)
+    starts = range(0, n, chunk_steps)
+    # the Step 1 output of a time step depends on the values up to 2 steps before and 1 step after it
+    context = characteristics_reach(short_hour_window, iqr_hours, nDays, freq) + 3
+
+    # median for the global demand filter, from the values left by the negative/zero and identical run filters
+    prefiltered = np.empty(n)
+    for start in starts:
+        context_start = max(0, start - 2)
+        df = add_categories(values.iloc[context_start:start + chunk_steps].copy(), value_column)
+        df = filter_runs(filter_neg_and_zeros(df, value_column), value_column)
+        prefiltered[start:start + chunk_steps] = df[value_column].to_numpy()[start - context_start:]
+    med = np.nanmedian(prefiltered)
+    del prefiltered
+
+    def characteristics(start):
+        # Step 1 and the demand characteristics of one chunk, computed with the context on each side
+        context_start = max(0, start - context)
+        df = add_categories(values.iloc[context_start:start + chunk_steps + context].copy(), value_column)
+        df = screen_step_1(df, value_column, global_dem_cut, med=med)
+        df = add_demand_characteristics(df, value_column, short_hour_window, iqr_hours, nDays, freq)
+        return df.loc[start:start + chunk_steps - 1]
+
+    # Calculate the global IQR for the hour-to-hour differences
+    # between hourly diurnal templates (IQR_{r})
+    relative_deltas = np.concatenate([characteristics(start)['dem_rel_diff_wrt_hourly_delta_pre'].to_numpy()
+                                      for start in starts] or [np.empty(0)])
+    iqr_relative_deltas = np.nanpercentile(relative_deltas, 75) - np.nanpercentile(relative_deltas, 25)
+    rel_threshold = rel_multiplier * iqr_relative_deltas
+    del relative_deltas
+
+    def single_sided_input(start, state):
+        # the chunk after the pointwise Step 2 filters and the forward single-sided delta pass
+        df = characteristics(start)
+        df = filter_local_demand(df, local_dem_cut_up, local_dem_cut_down, value_column)
+        df = filter_deltas(df, delta_multiplier, value_column)
+        arrays = {'values': df[value_column].to_numpy(dtype=np.float64, copy=True),
+                  'rel_diff': df['dem_rel_diff_wrt_hourly'].to_numpy(dtype=np.float64),
+                  'rel_diff_long': df['dem_rel_diff_wrt_hourly_long'].to_numpy(dtype=np.float64),
+                  'delta_iqr': df['delta_rolling_IQR'].to_numpy(dtype=np.float64)}
+        filtered, state = _carried_single_sided_pass(**arrays, multiplier=delta_single_multiplier,
+                                                     rel_threshold=rel_threshold, reverse=False, state=state)
+        arrays['category'] = np.where(~np.isnan(filtered), CATEGORY_CODES['SINGLE_DELTA'],
+                                      df['category'].to_numpy()).astype(np.int8)
+        return arrays, state
+
+    # forward pass through the chunks, keeping the previous good hour at the start of every chunk
+    forward_states = []
+    state = None
+    for start in starts:
+        forward_states.append(state)
+        _, state = single_sided_input(start, state)
+
+    # backward pass through the chunks, repeating the forward pass of each chunk from its stored starting point
+    cleaned = np.empty(n, dtype=np.float32)
+    codes = np.empty(n, dtype=np.int8)
+    state = None
+    for start, forward_state in reversed(list(zip(starts, forward_states))):
+        arrays, _ = single_sided_input(start, forward_state)
+        filtered, state = _carried_single_sided_pass(arrays['values'], arrays['rel_diff'], arrays['rel_diff_long'],
+                                                     arrays['delta_iqr'], delta_single_multiplier, rel_threshold,
+                                                     True, state)
+        end = start + len(filtered)
+        cleaned[start:end] = arrays['values']
+        codes[start:end] = np.where(~np.isnan(filtered), CATEGORY_CODES['SINGLE_DELTA'], arrays['category'])
+
+    # (anomalous regions filter)
+    # the regions of a time step depend on the categories up to 3 widths + 3 steps on each side. Hours of the
+    # chunks before that were already filtered here were OKAY before, so are read as OKAY
+    width = window_steps(anomalous_regions_width, freq)
+    overlap = 3 * width + 3
+    for start in starts:
+        context_start = max(0, start - overlap)
+        category = codes[context_start:start + chunk_steps + overlap].copy()
+        category[category == CATEGORY_CODES['ANOMALOUS_REGION']] = CATEGORY_CODES['OKAY']
+        to_filter, _ = _anomalous_regions(category, width, anomalous_pct)
+        to_filter = np.flatnonzero(to_filter[start - context_start:start - context_start + chunk_steps]) + start
+        codes[to_filter] = CATEGORY_CODES['ANOMALOUS_REGION']
+        cleaned[to_filter] = np.nan
+
+    return pd.DataFrame({value_column: cleaned, 'category': codes}, index=data.index)
+
+
+# default upper limit on the number of columns screened at once by each task of screen_anomolies_batch
+MAX_COLUMNS_PER_TASK = 128
+
+
+def _rolling_quantile_columns(values, window, quantiles):
+    """
+    rolling_quantiles for each column of a 2d array
+    Returns:
+        list with a 2d array of the same shape as values for each quantile
+    """
+    result = [np.empty(values.shape) for _ in quantiles]
+    for i in range(values.shape[1]):
+        column_quantiles = rolling_quantiles(values[:, i], window, quantiles)
+        for j in range(len(quantiles)):
+            result[j][:, i] = column_quantiles[:, j]
+    return result
+
+
+def _screen_block(values, params):
+    """
+    Screens every column of a 2d (time steps x series) array at once, with the same results as
+    screen_anomolies(..., compact=True) on each column. The window step counts and the day by hour layout of the
+    diurnal template are derived from the time step once for the whole block, the pointwise filters run on the
+    whole block, and the rolling windows and the sequential filters run their array kernels column by column.
+    Used as the task run by each worker in screen_anomolies_batch.
+    Returns:
+        cleaned: float32 array of screened values
+        codes: int8 array of category codes
+    """
+    freq = params['freq']
+    short_window = window_steps(params['short_hour_window'], freq) * 2
+    long_window = window_steps(params['nDays'], freq, unit='D') * 2
+    iqr_window = window_steps(params['iqr_hours'], freq) * 2
+    same_hour_days = window_steps(params['nDays'], '1D', unit='D')
+    steps_per_day = window_steps('1D', freq)
+    width = window_steps(params['anomalous_regions_width'], freq)
+
+    # columns are contiguous, for the kernels that run column by column
+    x = np.asfortranarray(values, dtype=np.float64).copy(order='F')
+    n_series = x.shape[1]
+    category = np.where(np.isnan(x), CATEGORY_CODES['MISSING'], CATEGORY_CODES['OKAY']).astype(np.int8)
+
+    def apply_filter(to_filter, code):
+        to_filter = to_filter & ~np.isnan(x)
+        category[to_filter] = CATEGORY_CODES[code]
+        x[to_filter] = np.nan
+
+    def previous(array, periods=1):
+        # array[t - periods] at each t, as with pandas shift
+        shifted = np.full(array.shape, np.nan)
+        shifted[periods:] = array[:-periods]
+        return shifted
+
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        # all-NaN columns give NaN medians and percentiles, as with screen_anomolies
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+
+        #---------------------------------------------
+        # Screening Step 1
+        #---------------------------------------------
+        apply_filter(x <= 0., 'NEG_OR_ZERO')
+        apply_filter((x - previous(x) == 0) & (x - previous(x, 2) == 0), 'IDENTICAL_RUN')
+        med = np.nanmedian(x, axis=0)
+        apply_filter(~(x < med * params['global_dem_cut']), 'GLOBAL_DEM')
+        is_global = category == CATEGORY_CODES['GLOBAL_DEM']
+        next_to_global = np.zeros(x.shape, dtype=bool)
+        next_to_global[:-1] |= is_global[1:]
+        next_to_global[1:] |= is_global[:-1]
+        apply_filter(next_to_global & (category == CATEGORY_CODES['OKAY']), 'GLOBAL_DEM_PLUS_MINUS')
+
+        #---------------------------------------------
+        # Calculate demand characteristics for Step 2
+        #---------------------------------------------
+        rolling_dem, = _rolling_quantile_columns(x, short_window, [0.5])
+        rolling_dem_long, = _rolling_quantile_columns(x, long_window, [0.5])
+        dem_minus_rolling = x - rolling_dem
+        q25, q75 = _rolling_quantile_columns(dem_minus_rolling, iqr_window, [0.25, 0.75])
+        dem_minus_rolling_iqr = q75 - q25
+        delta_pre = x - previous(x)
+        delta_post = np.full(x.shape, np.nan)
+        delta_post[:-1] = x[:-1] - x[1:]
+        q25, q75 = _rolling_quantile_columns(delta_pre, iqr_window, [0.25, 0.75])
+        delta_rolling_iqr = q75 - q25
+        hourly_median_dem_dev = 1. + same_hour_median(dem_minus_rolling, same_hour_days,
+                                                      steps_per_day=steps_per_day) / rolling_dem_long
+        rel_diff = x / (rolling_dem * hourly_median_dem_dev)
+        rel_diff_long = x / (rolling_dem_long * hourly_median_dem_dev)
+        rel_diff_delta = rel_diff - previous(rel_diff)
+        iqr_relative_deltas = np.nanpercentile(rel_diff_delta, 75, axis=0) - \
+            np.nanpercentile(rel_diff_delta, 25, axis=0)
+
+        #---------------------------------------------
+        # Screening Step 2
+        #---------------------------------------------
+        expected = rolling_dem * hourly_median_dem_dev
+        apply_filter(~(x < expected + params['local_dem_cut_up'] * dem_minus_rolling_iqr), 'LOCAL_DEM_UP')
+        apply_filter(~(x > expected - params['local_dem_cut_down'] * dem_minus_rolling_iqr), 'LOCAL_DEM_DOWN')
+        threshold = delta_rolling_iqr * params['delta_multiplier']
+        apply_filter(((delta_pre > threshold) & (delta_post > threshold)) |
+                     ((delta_pre < -1. * threshold) & (delta_post < -1. * threshold)), 'DELTA')
+
+    for i in range(n_series):
+        column = x[:, i]
+        rel_threshold = params['rel_multiplier'] * iqr_relative_deltas[i]
+        filtered_fwd = _single_sided_delta_pass(column, rel_diff[:, i], rel_diff_long[:, i], delta_rolling_iqr[:, i],
+                                                params['delta_single_multiplier'], rel_threshold, False)
+        filtered_bkw = _single_sided_delta_pass(column, rel_diff[:, i], rel_diff_long[:, i], delta_rolling_iqr[:, i],
+                                                params['delta_single_multiplier'], rel_threshold, True)
+        category[~np.isnan(filtered_fwd) | ~np.isnan(filtered_bkw), i] = CATEGORY_CODES['SINGLE_DELTA']
+
+        to_filter, _ = _anomalous_regions(category[:, i], width, params['anomalous_pct'])
+        category[to_filter, i] = CATEGORY_CODES['ANOMALOUS_REGION']
+        column[to_filter] = np.nan
+
+    return x.astype(np.float32), category
+
+
+def screen_anomolies_batch(data,
+                           short_hour_window,
+                           iqr_hours,
+                           nDays,
+                           global_dem_cut,
+                           local_dem_cut_up,
+                           local_dem_cut_down,
+                           delta_multiplier,
+                           delta_single_multiplier,
+                           rel_multiplier,
+                           anomalous_regions_width,
+                           anomalous_pct,
+                           n_workers=None,
+                           columns_per_task=None,
+                           freq=None
+                           ):
+    """
+    Screens every column of a wide frame of hourly data, spreading the columns over a pool of worker processes.
+    Each task screens its block of columns as one 2d array (see _screen_block), with the same results as
+    screen_anomolies(..., compact=True) on each column. The screening parameters are the same as for
+    screen_anomolies.
+    Args:
+        data: pandas dataframe or 2d numpy array with one row per hour and one column per series
+        n_workers: number of worker processes. Defaults to the number of CPUs. If 1, runs in the current process
+        columns_per_task: number of columns sent to a worker at a time. Defaults to splitting the columns
+            into about four tasks per worker, with at most MAX_COLUMNS_PER_TASK columns. A task holds about
+            20 float64 arrays of hours x columns_per_task
+        freq: time step of the series. Inferred from the index of a dataframe if None, or one hour for an array
+    Returns:
+        cleaned: float32 dataframe of screened values, with NaN for every hour that was filtered or missing
+        categories: dataframe with the category assigned to each hour, as a categorical dtype whose
+            codes are the CATEGORY_CODES
+    """
+    if isinstance(data, pd.DataFrame):
+        index = data.index
+        columns = data.columns
+        values = data.to_numpy(dtype=np.float64)
+    else:
+        values = np.asarray(data, dtype=np.float64)
+        index = pd.RangeIndex(values.shape[0])
+        columns = pd.RangeIndex(values.shape[1])
+
+    params = {'short_hour_window': short_hour_window,
+              'iqr_hours': iqr_hours,
+              'nDays': nDays,
+              'global_dem_cut': global_dem_cut,
+              'local_dem_cut_up': local_dem_cut_up,
+              'local_dem_cut_down': local_dem_cut_down,
+              'delta_multiplier': delta_multiplier,
+              'delta_single_multiplier': delta_single_multiplier,
+              'rel_multiplier': rel_multiplier,
+              'anomalous_regions_width': anomalous_regions_width,
+              'anomalous_pct': anomalous_pct,
+              'freq': infer_step(index) if freq is None else freq}
+
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_series = values.shape[1]
+    if columns_per_task is None:
+        columns_per_task = min(max(1, -(-n_series // (4 * n_workers))), MAX_COLUMNS_PER_TASK)
+    blocks = [values[:, start:start + columns_per_task] for start in range(0, n_series, columns_per_task)]
+
+    if n_workers == 1 or len(blocks) <= 1:
+        results = [_screen_block(block, params) for block in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(_screen_block, blocks, [params] * len(blocks)))
+
+    if results:
+        cleaned = np.concatenate([block[0] for block in results], axis=1)
+        codes = np.concatenate([block[1] for block in results], axis=1)
+    else:
+        cleaned = np.empty(values.shape, dtype=np.float32)
+        codes = np.empty(values.shape, dtype=np.int8)
+
+    cleaned = pd.DataFrame(cleaned, index=index, columns=columns)
+    categories = pd.DataFrame({i: pd.Categorical.from_codes(codes[:, i], categories=CATEGORIES)
+                               for i in range(n_series)}, index=index)
+    categories.columns = columns
+
+    return cleaned, categories
+
+
+class _SortedValues:
+    """
+    Multiset of numbers kept sorted in blocks, for the medians and percentiles of a series that grows.
+    Adding or removing a value only moves the values of one block, and NaN values are ignored.
+    Medians and percentiles are the same as np.nanmedian and np.nanpercentile of all the values.
+    """
+
+    def __init__(self, values=(), block_size=1024):
+        values = np.asarray(values, dtype=np.float64)
+        values = np.sort(values[~np.isnan(values)])
+        self.block_size = block_size
+        self.blocks = [values[start:start + block_size] for start in range(0, len(values), block_size)]
+        # largest value of each block, for finding the block that a value belongs in
+        self.maxes = [block[-1] for block in self.blocks]
+        self.size = len(values)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        for value in values[~np.isnan(values)]:
+            if not self.blocks:
+                self.blocks, self.maxes = [np.array([value])], [value]
+            else:
+                i = min(bisect.bisect_left(self.maxes, value), len(self.blocks) - 1)
+                block = self.blocks[i]
+                block = np.insert(block, np.searchsorted(block, value), value)
+                if len(block) > 2 * self.block_size:
+                    self.blocks[i:i + 1] = [block[:self.block_size], block[self.block_size:]]
+                    self.maxes[i:i + 1] = [block[self.block_size - 1], block[-1]]
+                else:
+                    self.blocks[i] = block
+                    self.maxes[i] = block[-1]
+            self.size += 1
+
+    def remove(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        for value in values[~np.isnan(values)]:
+            # the first block whose largest value is not below value holds it
+            i = bisect.bisect_left(self.maxes, value)
+            block = np.delete(self.blocks[i], np.searchsorted(self.blocks[i], value))
+            if len(block) == 0:
+                del self.blocks[i], self.maxes[i]
+            else:
+                self.blocks[i] = block
+                self.maxes[i] = block[-1]
+            self.size -= 1
+
+    def count_below(self, value, inclusive=False):
+        """
+        Number of values below value, or not above it if inclusive is True
+        """
+        if inclusive:
+            i = bisect.bisect_right(self.maxes, value)
+        else:
+            i = bisect.bisect_left(self.maxes, value)
+        count = sum(len(block) for block in self.blocks[:i])
+        if i < len(self.blocks):
+            count += np.searchsorted(self.blocks[i], value, side='right' if inclusive else 'left')
+        return count
+
+    def _values_at(self, k, n_values=1):
+        # the n_values values from the k-th smallest value on
+        for block in self.blocks:
+            if k < len(block):
+                values = block[k:k + n_values]
+                if len(values) < n_values:
+                    values = np.concatenate([values, self._values_at(0, n_values - len(values))])
+                return values
+            k -= len(block)
+        return np.empty(0)
+
+    def median(self):
+        if self.size == 0:
+            return np.nan
+        middle = self.size // 2
+        if self.size % 2 == 1:
+            return self._values_at(middle)[0]
+        below, above = self._values_at(middle - 1, 2)
+        return (below + above) / 2
+
+    def percentile(self, q):
+        if self.size == 0:
+            return np.nan
+        # linear interpolation between the two values around the percentile, as in np.nanpercentile
+        position = (self.size - 1) * (q / 100)
+        k = int(np.floor(position))
+        if k + 1 >= self.size:
+            return self._values_at(k)[0]
+        return np.quantile(self._values_at(k, 2), position - k)
+
+
+class IncrementalScreener:
+    """
+    Screens an hourly series that grows over time, such as demand data that is appended every day.
+
+    Every rolling window in the screening is bounded, so appending hours only changes the Step 1 output and demand
+    characteristics of a tail of the series (see characteristics_reach). The screener keeps every column of the
+    screening in arrays that grow with the series, and each append only recomputes the tail, using the hours before
+    it as context:
+      - the global values (the median used by the global demand filter and IQR_{r}) are updated from sorted copies
+        of the values they are taken from, and the whole series is only re-screened if the new median changes the
+        global demand filter of an hour that was already screened
+      - the pointwise Step 2 filters only run on the tail
+      - the forward single-sided delta pass resumes at the tail from the stored previous good hour, and the backward
+        pass runs from the end until it reaches the previous good hours of the last call. Both passes keep the
+        relative deltas that they compared with the threshold on IQR_{r}, and are only re-run over the whole series
+        if the new threshold falls on the other side of one of them
+      - the anomalous regions filter only runs on the hours within its reach of the first hour that changed, apart
+        from the length of the chunk of good data that those hours continue (len_good_data).
+    result builds the dataframe of all hours from the arrays when it is read. Results are identical to
+    screen_anomolies on the full series.
+
+    Usage:
+        screener = IncrementalScreener('demand', **params)
+        screener.append(df_history)
+        screener.append(df_new_day)  # returns the screened hours that changed or were added
+        screener.result  # same as screen_anomolies(pd.concat([df_history, df_new_day]), 'demand', **params)
+    """
+
+    # columns of the Step 2 output, in the order screen_step_2 adds them
+    STEP_2_COLUMNS = ['localDemandFilteredUp', 'localDemandFilteredDown', 'deltaFiltered',
+                      'deltaSingleFilteredFwd', 'deltaSingleFilteredBkw', 'len_good_data', 'anomalousRegionsFiltered']
+
+    def __init__(self, value_column,
+                 short_hour_window,
+                 iqr_hours,
+                 nDays,
+                 global_dem_cut,
+                 local_dem_cut_up,
+                 local_dem_cut_down,
+                 delta_multiplier,
+                 delta_single_multiplier,
+                 rel_multiplier,
+                 anomalous_regions_width,
+                 anomalous_pct,
+                 compact=False,
+                 freq=None):
+        self.value_column = value_column
+        self.compact = compact
+        self.short_hour_window = short_hour_window
+        self.iqr_hours = iqr_hours
+        self.nDays = nDays
+        self.global_dem_cut = global_dem_cut
+        self.local_dem_cut_up = local_dem_cut_up
+        self.local_dem_cut_down = local_dem_cut_down
+        self.delta_multiplier = delta_multiplier
+        self.delta_single_multiplier = delta_single_multiplier
+        self.rel_multiplier = rel_multiplier
+        self.anomalous_regions_width = anomalous_regions_width
+        self.anomalous_pct = anomalous_pct
+
+        # time step of the series, inferred from the index of the first data appended if None
+        self.freq = freq
+        # number of time steps on each side of a time step that its demand characteristics depend on
+        self.reach = None
+        # number of time steps on each side of a time step that its anomalous regions filter depends on
+        self.anomalous_reach = None
+
+        # number of hours screened, and the index of the data appended, one piece per call
+        self.n = 0
+        self.index_pieces = []
+        # one array per column, with room for capacity hours (see _grow)
+        self.arrays = {}
+        self.capacity = 0
+        # columns added by Step 1 and the demand characteristics, in the order screen_anomolies adds them
+        self.characteristic_columns = None
+
+        # sorted values for the global median, IQR_{r}, and the relative deltas compared with the threshold
+        # on IQR_{r} by the forward and backward single-sided delta passes
+        self.prefiltered = None
+        self.relative_deltas = None
+        self.forward_critical = None
+        self.backward_critical = None
+        self.global_median = np.nan
+        self.rel_threshold = np.nan
+
+        self._result = None
+
+    def _grow(self, n):
+        """
+        Makes room for n hours in every array, doubling their length when they are full
+        """
+        if n <= self.capacity:
+            return
+        self.capacity = max(n, 2 * self.capacity)
+        for name, array in self.arrays.items():
+            grown = np.empty(self.capacity, dtype=array.dtype)
+            grown[:self.n] = array[:self.n]
+            self.arrays[name] = grown
+
+    def _array(self, name, dtype=np.float64):
+        if name not in self.arrays:
+            self.arrays[name] = np.empty(self.capacity, dtype=dtype)
+        return self.arrays[name]
+
+    def _prefilter(self, df):
+        """
+        Runs the parts of Step 1 that come before the global demand filter, whose median is based on their output
+        """
+        df = add_categories(df, self.value_column)
+        df = df.assign(missing=df[self.value_column].isna())
+        df = filter_neg_and_zeros(df, self.value_column)
+        df = filter_runs(df, self.value_column)
+        return df
+
+    def _screen(self, n_old):
+        """
+        Screens the hours after the first n_old hours, and updates the hours before them that this changes.
+        Screens the whole series if n_old is 0
+        Returns:
+            the first hour whose screening changed
+        """
+        n = self.n
+        if n_old == 0:
+            context_start = keep_start = 0
+        else:
+            # Step 1 changes start at n_old - 1 (the global demand plus/minus one hour filter), so the
+            # characteristics change from n_old - 1 - reach. Those need Step 1 output from another reach
+            # back, which in turn needs 3 hours of context for the identical run and plus/minus one filters.
+            context_start = max(0, n_old - 2 * self.reach - 4)
+            keep_start = context_start + self.reach + 3 if context_start > 0 else 0
+
+        tail = pd.DataFrame({self.value_column: self.arrays['raw'][context_start:n]},
+                            index=pd.RangeIndex(context_start, n))
+        tail = self._prefilter(tail)
+        new_prefiltered = tail[self.value_column].to_numpy(dtype=np.float64)[n_old - context_start:]
+
+        # the global median is computed over the whole series
+        if n_old == 0:
+            self.prefiltered = _SortedValues(new_prefiltered)
+            med = self.prefiltered.median()
+        else:
+            self.prefiltered.add(new_prefiltered)
+            med = self.prefiltered.median()
+            # if the new median changes the global demand filter for any old hour, start over
+            old_cut = self.global_median * self.global_dem_cut
+            new_cut = med * self.global_dem_cut
+            if not np.isnan(old_cut) and not np.isnan(new_cut) and old_cut != new_cut:
+                low, high = min(old_cut, new_cut), max(old_cut, new_cut)
+                n_between = self.prefiltered.count_below(high) - self.prefiltered.count_below(low)
+                n_new_between = ((new_prefiltered >= low) & (new_prefiltered < high)).sum()
+                if n_between > n_new_between:
+                    return self._screen(0)
+        self.global_median = med
+
+        tail = filter_extrem_demand(tail, self.global_dem_cut, self.value_column, med=med)
+        tail = filter_global_plus_minus_one(tail, self.value_column)
+        tail = add_demand_characteristics(tail, self.value_column, self.short_hour_window,
+                                          self.iqr_hours, self.nDays, self.freq)
+        tail = tail.loc[keep_start:]
+        if self.characteristic_columns is None:
+            self.characteristic_columns = [column for column in tail.columns
+                                           if column not in [self.value_column, 'category']]
+
+        # Calculate the global IQR for the hour-to-hour differences
+        # between hourly diurnal templates (IQR_{r}), replacing the deltas that changed
+        relative_deltas = tail['dem_rel_diff_wrt_hourly_delta_pre'].to_numpy(dtype=np.float64)
+        if n_old == 0:
+            self.relative_deltas = _SortedValues(relative_deltas)
+        else:
+            old = self.arrays['dem_rel_diff_wrt_hourly_delta_pre'][keep_start:n_old]
+            new = relative_deltas[:n_old - keep_start]
+            changed = ~((old == new) | (np.isnan(old) & np.isnan(new)))
+            self.relative_deltas.remove(old[changed])
+            self.relative_deltas.add(new[changed])
+            self.relative_deltas.add(relative_deltas[n_old - keep_start:])
+        iqr_relative_deltas = self.relative_deltas.percentile(75) - self.relative_deltas.percentile(25)
+
+        self._array('step_1_values')[keep_start:n] = tail[self.value_column].to_numpy(dtype=np.float64)
+        self._array('step_1_category', np.int8)[keep_start:n] = tail['category'].to_numpy(dtype=np.int8)
+        for column in self.characteristic_columns:
+            self._array(column, tail[column].dtype)[keep_start:n] = tail[column].to_numpy()
+
+        return self._screen_step_2(n_old, keep_start, self.rel_multiplier * iqr_relative_deltas)
+
+    def _screen_step_2(self, n_old, start, rel_threshold):
+        """
+        Runs Step 2 on the hours from start on, which have new demand characteristics, and on the hours before them
+        whose Step 2 results this changes
+        Returns:
+            the first hour whose screening changed
+        """
+        n = self.n
+        arrays = self.arrays
+        if n_old > 0:
+            # the relative deltas of the hours from start on are compared again below
+            self.forward_critical.remove(arrays['forward_critical'][start:n_old])
+            self.backward_critical.remove(arrays['backward_critical'][start:n_old])
+        if n_old > 0 and not (rel_threshold == self.rel_threshold):
+            if np.isnan(rel_threshold) or np.isnan(self.rel_threshold):
+                start = 0
+            else:
+                # the single-sided delta filter of an hour before start changes if its relative delta
+                # is between the old and new thresholds
+                low, high = min(rel_threshold, self.rel_threshold), max(rel_threshold, self.rel_threshold)
+                for critical in [self.forward_critical, self.backward_critical]:
+                    if critical.count_below(high, inclusive=True) > critical.count_below(low, inclusive=True):
+                        start = 0
+            if start == 0:
+                return self._screen_step_2(0, 0, rel_threshold)
+        self.rel_threshold = rel_threshold
+
+        # (local demand filter) and (double-sided delta filter)
+        df = pd.DataFrame({self.value_column: arrays['step_1_values'][start:n],
+                           'category': arrays['step_1_category'][start:n]})
+        for column in ['rollingDem', 'hourly_median_dem_dev', 'dem_minus_rolling_IQR',
+                       'delta_pre', 'delta_post', 'delta_rolling_IQR']:
+            df[column] = arrays[column][start:n]
+        df = filter_local_demand(df, self.local_dem_cut_up, self.local_dem_cut_down, self.value_column)
+        df = filter_deltas(df, self.delta_multiplier, self.value_column)
+        self._array('step_2_values')[start:n] = df[self.value_column].to_numpy()
+        self._array('step_2_category', np.int8)[start:n] = df['category'].to_numpy()
+        for column in ['localDemandFilteredUp', 'localDemandFilteredDown', 'deltaFiltered']:
+            self._array(column)[start:n] = df[column].to_numpy()
+
+        # (single-sided delta filter)
+        values = arrays['step_2_values']
+        rel_diff = arrays['dem_rel_diff_wrt_hourly']
+        rel_diff_long = arrays['dem_rel_diff_wrt_hourly_long']
+        delta_iqr = arrays['delta_rolling_IQR']
+        forward_filtered = self._array('deltaSingleFilteredFwd')
+        forward_trace = self._array('forward_trace', np.int64)
+        forward_critical = self._array('forward_critical')
+        backward_filtered = self._array('deltaSingleFilteredBkw')
+        backward_trace = self._array('backward_trace', np.int64)
+        backward_critical = self._array('backward_critical')
+        forward_values = self._array('forward_values')
+
+        # forward pass, resuming from the previous good hour before start
+        prev_good = forward_trace[start - 1] if start > 0 else -1
+        _single_sided_delta_steps(values[:n], rel_diff[:n], rel_diff_long[:n], delta_iqr[:n],
+                                  self.delta_single_multiplier, rel_threshold, False, start, prev_good,
+                                  forward_filtered, forward_trace, forward_critical, forward_trace, -1)
+        forward_values[start:n] = np.where(np.isnan(forward_filtered[start:n]), values[start:n], np.nan)
+
+        # backward pass over the hours the forward pass left, from the end until it is back on the previous good
+        # hours of the last call, since the hours before start had the same input in the last call. The pass
+        # writes to new arrays, of which only the hours it visits are filled, to compare with the last call
+        new_filtered, new_critical = np.empty(n), np.empty(n)
+        new_trace = np.empty(n, dtype=np.int64)
+        stop = _single_sided_delta_steps(forward_values[:n], rel_diff[:n], rel_diff_long[:n], delta_iqr[:n],
+                                         self.delta_single_multiplier, rel_threshold, True, n - 1, -1,
+                                         new_filtered, new_trace, new_critical, backward_trace, start)
+        stop = min(stop, start)
+        if n_old == 0:
+            self.forward_critical = _SortedValues(forward_critical[:n])
+            self.backward_critical = _SortedValues(new_critical)
+        else:
+            self.forward_critical.add(forward_critical[start:n])
+            self.backward_critical.remove(backward_critical[stop:start])
+            self.backward_critical.add(new_critical[stop:n])
+        backward_filtered[stop:n] = new_filtered[stop:n]
+        backward_trace[stop:n] = new_trace[stop:n]
+        backward_critical[stop:n] = new_critical[stop:n]
+
+        single_category = self._array('single_delta_category', np.int8)
+        single_category[stop:n] = np.where(np.isnan(forward_filtered[stop:n]) & np.isnan(backward_filtered[stop:n]),
+                                           arrays['step_2_category'][stop:n], CATEGORY_CODES['SINGLE_DELTA'])
+
+        # (anomalous regions filter)
+        # the regions of an hour only depend on the categories within anomalous_reach of it
+        changed = min(stop, n_old)
+        context_start = max(0, changed - 2 * self.anomalous_reach)
+        keep_start = max(0, changed - self.anomalous_reach)
+        category = single_category[context_start:n]
+        to_filter, len_good_data = _anomalous_regions(category,
+                                                      window_steps(self.anomalous_regions_width, self.freq),
+                                                      self.anomalous_pct)
+
+        # The length of a chunk of good data (len_good_data) depends on both of its ends, however far apart they are.
+        # Keep the first hour of the chunk that each hour is in, for the chunk that starts before context_start
+        good = (category == CATEGORY_CODES['OKAY']) | (category == CATEGORY_CODES['MISSING'])
+        is_chunk_start = good & np.concatenate([[True], ~good[:-1]])
+        chunk_start = np.maximum.accumulate(np.where(is_chunk_start, np.arange(len(category)), 0)) + context_start
+        stored_chunk_start = self._array('chunk_start', np.int64)
+        stored_len_good_data = self._array('len_good_data', np.int64)
+        if context_start > 0 and good[0] and \
+                single_category[context_start - 1] in [CATEGORY_CODES['OKAY'], CATEGORY_CODES['MISSING']]:
+            first_chunk = good & (chunk_start == context_start)
+            chunk_start[first_chunk] = stored_chunk_start[context_start - 1]
+            # a chunk that runs to the end of the data keeps a length of 0
+            len_good_data[first_chunk] = np.where(len_good_data[first_chunk] > 0,
+                                                  len_good_data[first_chunk] + context_start - chunk_start[first_chunk],
+                                                  0)
+        # the hours before keep_start in the same chunk as keep_start get its new length
+        changed = keep_start
+        last_kept = keep_start - 1 - context_start
+        if last_kept >= 0 and good[last_kept] and len_good_data[last_kept] != stored_len_good_data[keep_start - 1]:
+            changed = chunk_start[last_kept]
+            stored_len_good_data[changed:keep_start] = len_good_data[last_kept]
+        stored_chunk_start[keep_start:n] = chunk_start[keep_start - context_start:]
+        stored_len_good_data[keep_start:n] = len_good_data[keep_start - context_start:]
+
+        to_filter = to_filter[keep_start - context_start:]
+        single_values = np.where(np.isnan(backward_filtered[keep_start:n]), forward_values[keep_start:n], np.nan)
+        self._array('anomalousRegionsFiltered')[keep_start:n] = np.where(to_filter, single_values, np.nan)
+        self._array('values')[keep_start:n] = np.where(to_filter, np.nan, single_values)
+        self._array('category', np.int8)[keep_start:n] = np.where(to_filter, CATEGORY_CODES['ANOMALOUS_REGION'],
+                                                                  single_category[keep_start:n])
+        return changed
+
+    def _frame(self, start=0):
+        """
+        Returns the screened hours from start on, in the same format as screen_anomolies returns
+        """
+        # the index pieces that cover the hours from start on
+        pieces = [self.index_pieces[-1][:0]]
+        n_covered = 0
+        for piece in reversed(self.index_pieces):
+            if n_covered >= self.n - start:
+                break
+            pieces.insert(0, piece)
+            n_covered += len(piece)
+        index = pieces[0].append(pieces[1:])
+        index = index[len(index) - (self.n - start):]
+
+        if self.compact:
+            return pd.DataFrame({self.value_column: self.arrays['values'][start:self.n].astype(np.float32),
+                                 'category': self.arrays['category'][start:self.n].copy()}, index=index)
+        columns = {self.value_column: self.arrays['values'][start:self.n].copy(),
+                   'category': category_labels(self.arrays['category'][start:self.n])}
+        for column in self.characteristic_columns + self.STEP_2_COLUMNS:
+            columns[column] = self.arrays[column][start:self.n].copy()
+        return pd.DataFrame(columns, index=index)
+
+    @property
+    def result(self):
+        """
+        The screened dataframe for all hours, in the same format as screen_anomolies returns
+        """
+        if self._result is None and self.n > 0:
+            self._result = self._frame()
+            self.index_pieces = [self._result.index]
+        return self._result
+
+    def append(self, new_data):
+        """
+        Adds the hours in new_data after the hours already screened and updates the screening results.
+        Args:
+            new_data: pandas dataframe with a value_column, with rows that follow the previously appended rows
+        Returns:
+            changed: the screened dataframe for the hours whose screening changed or that were added, in the same
+                format as screen_anomolies returns. Use result for all hours
+        """
+        if len(new_data.index) == 0:
+            return self._frame(self.n) if self.n > 0 else None
+        if self.n == 0:
+            if self.freq is None:
+                self.freq = infer_step(new_data.index)
+            self.reach = characteristics_reach(self.short_hour_window, self.iqr_hours, self.nDays, self.freq)
+            self.anomalous_reach = 3 * window_steps(self.anomalous_regions_width, self.freq) + 3
+
+        n_old = self.n
+        self._grow(n_old + len(new_data.index))
+        self.n = n_old + len(new_data.index)
+        self._array('raw')[n_old:self.n] = new_data[self.value_column].to_numpy(dtype=np.float64)
+        self.index_pieces.append(new_data.index)
+        self._result = None
+
+        changed = self._screen(n_old)
+        return self._frame(changed)
+
+
+# thresholds that are only used in Step 2, in the order of the screen_step_2 arguments
+STEP_2_THRESHOLDS = ['local_dem_cut_up', 'local_dem_cut_down', 'delta_multiplier',
+                     'delta_single_multiplier', 'rel_multiplier', 'anomalous_regions_width', 'anomalous_pct']
+
+# demand characteristics that are read by Step 2
+STEP_2_INPUT_COLUMNS = ['category', 'rollingDem', 'hourly_median_dem_dev', 'dem_minus_rolling_IQR',
+                        'delta_pre', 'delta_post', 'delta_rolling_IQR',
+                        'dem_rel_diff_wrt_hourly', 'dem_rel_diff_wrt_hourly_long']
+
+
+def _sweep_step_2(characteristics, value_column, iqr_relative_deltas, combinations, freq=HOURLY):
+    """
+    Runs Step 2 for each combination of Step 2 thresholds. Used as the task run by each worker in sweep_thresholds.
+    Returns:
+        counts: array with one row per combination and one column per category code, with the number of hours
+    """
+    counts = np.empty((len(combinations), len(CATEGORIES)), dtype=np.int64)
+    for i, thresholds in enumerate(combinations):
+        df = screen_step_2(characteristics.copy(), value_column, iqr_relative_deltas, **thresholds, freq=freq)
+        counts[i] = np.bincount(df['category'], minlength=len(CATEGORIES))
+    return counts
+
+
+def sweep_thresholds(data, value_column,
+                     short_hour_window,
+                     iqr_hours,
+                     nDays,
+                     threshold_grid,
+                     n_workers=1,
+                     combinations_per_task=None,
+                     freq=None
+                     ):
+    """
+    Screens one series with every combination of screening thresholds in a grid.
+
+    The window parameters are fixed, so Step 1 and the demand characteristics are only computed once
+    for each value of global_dem_cut, and every combination of the other thresholds reuses them for Step 2.
+    Args:
+        data: pandas dataframe containing value_column
+        value_column: name of the column to screen
+        short_hour_window, iqr_hours, nDays: window parameters, as for screen_anomolies
+        threshold_grid: dict mapping each of 'global_dem_cut' and the STEP_2_THRESHOLDS to a list of values to try
+        n_workers: number of worker processes to spread the combinations over. If 1, runs in the current process
+        combinations_per_task: number of combinations sent to a worker at a time. Defaults to about four tasks per worker
+        freq: time step of the series, inferred from the index if None
+    Returns:
+        counts: tidy dataframe with one row per combination of thresholds and category, with a column for each
+            threshold, the 'category' label, and the number of 'hours' assigned to that category
+    """
+    missing_thresholds = [name for name in ['global_dem_cut'] + STEP_2_THRESHOLDS if name not in threshold_grid]
+    if missing_thresholds:
+        raise ValueError(f'threshold_grid is missing values for {missing_thresholds}')
+
+    step_2_combinations = [dict(zip(STEP_2_THRESHOLDS, values))
+                           for values in itertools.product(*[threshold_grid[name] for name in STEP_2_THRESHOLDS])]
+    if combinations_per_task is None:
+        combinations_per_task = max(1, -(-len(step_2_combinations) // (4 * max(n_workers, 1))))
+    tasks = [step_2_combinations[start:start + combinations_per_task]
+             for start in range(0, len(step_2_combinations), combinations_per_task)]
+
+    if freq is None:
+        freq = infer_step(data.index)
+    base = data[[value_column]].reset_index(drop=True)
+    base = add_categories(base, value_column)
+
+    results = []
+    pool = ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+    try:
+        for global_dem_cut in threshold_grid['global_dem_cut']:
+            df = screen_step_1(base.copy(), value_column, global_dem_cut)
+            df = add_demand_characteristics(df, value_column, short_hour_window, iqr_hours, nDays, freq)
+            iqr_relative_deltas = calculate_relative_demand_difference_IQR(df)
+            characteristics = df[[value_column] + STEP_2_INPUT_COLUMNS]
+
+            if pool is None:
+                counts = [_sweep_step_2(characteristics, value_column, iqr_relative_deltas, task, freq)
+                          for task in tasks]
+            else:
+                counts = list(pool.map(_sweep_step_2, [characteristics] * len(tasks), [value_column] * len(tasks),
+                                       [iqr_relative_deltas] * len(tasks), tasks, [freq] * len(tasks)))
+
+            combinations = pd.DataFrame(step_2_combinations, columns=STEP_2_THRESHOLDS)
+            combinations.insert(0, 'global_dem_cut', global_dem_cut)
+            counts = pd.DataFrame(np.concatenate(counts), columns=CATEGORIES)
+            results.append(pd.concat([combinations, counts], axis=1))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    results = pd.concat(results, ignore_index=True)
+    return results.melt(id_vars=['global_dem_cut'] + STEP_2_THRESHOLDS, var_name='category', value_name='hours')
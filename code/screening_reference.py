@@ -0,0 +1,237 @@
+"""
+Original row-by-row implementations of the screening filters
+
+These are the `df.loc` based loops that were replaced by array implementations
+in screening.py. They are kept only as a reference, so that benchmark_screening.py
+can time the old and new versions and check that they give identical results.
+"""
+
+import pandas as pd
+import numpy as np
+
+
+# March through all hours recording previous "good"
+# demand value and its index.  Calculate deltas between
+# this value and next "good" hour.  If delta is LARGE
+# mark NAN.
+# Go forwards once, then backwards once to get all options.
+def filter_single_sided_deltas(df, multiplier, rel_multiplier, iqr_relative_deltas, value_column):
+
+
+    # Go through forwards first, then reverse
+    prev_good_index = np.nan
+    
+    deltaSingleFiltered = []
+    for idx in df.index:
+        deltaSingleFiltered.append(np.nan)
+        if np.isnan(df.loc[idx, value_column]):
+            continue
+        
+        
+        # Initialize first good entry, this will never be flagged
+        if np.isnan(prev_good_index):
+            prev_good_index = idx
+            
+        
+        # Check deltas demand and relative wrt hourly adjustment
+        prev_good_delta_dem = abs(df.loc[prev_good_index, value_column] - df.loc[idx, value_column])
+        prev_good_delta_dem_rel_diff_wrt_hourly = abs(df.loc[prev_good_index, 
+                        'dem_rel_diff_wrt_hourly'] - df.loc[idx, 'dem_rel_diff_wrt_hourly'])
+
+        
+        # delta_rolling_IQR is over 5 days on each side so should be
+        # similar regardless of which hours' we use. If delta is
+        # large, mark this hour anomalous
+        if (prev_good_delta_dem > df.loc[idx, 'delta_rolling_IQR'] * multiplier) and \
+                (prev_good_delta_dem_rel_diff_wrt_hourly > rel_multiplier * iqr_relative_deltas):
+            
+            
+            # If the previous "good" value was farther from expected values, then consider current hour good
+            # and the previous hour will be caught on the way back through the reverse direction.
+            # The max deviation from the rolling 4 day dem and the rolling 10 day dem is taken
+            # to help catch cases where a large deviation pulls the rolling 4 day dem to center
+            # on its values.  i.e. SCL 2016 Dec 15.
+            prev_max = max(abs(1. - df.loc[prev_good_index, 'dem_rel_diff_wrt_hourly']),
+                            abs(1. - df.loc[prev_good_index, 'dem_rel_diff_wrt_hourly_long']))
+            current_max = max(abs(1. - df.loc[idx, 'dem_rel_diff_wrt_hourly']),
+                            abs(1. - df.loc[idx, 'dem_rel_diff_wrt_hourly_long']))         
+            if abs(current_max) < abs(prev_max):
+                prev_good_index = idx
+            
+            # else, continue to filter this hour
+            else:
+                deltaSingleFiltered[-1] = df.loc[idx, value_column]
+                df.loc[idx, value_column] = np.nan
+                df.loc[idx, 'category'] = 'SINGLE_DELTA'
+        else:
+            prev_good_index = idx
+
+    
+    df['deltaSingleFilteredFwd'] = deltaSingleFiltered
+    
+    
+    ### Go through reversed, ~ copy of above code ###
+    prev_good_index = np.nan
+    
+    deltaSingleFiltered = []
+    for idx in reversed(df.index):
+        deltaSingleFiltered.append(np.nan)
+        if np.isnan(df.loc[idx, value_column]):
+            continue
+        
+        
+        # Initialize first good entry, this will never be flagged
+        if pd.isnull(prev_good_index): #original - if np.isnan(prev_good_index):
+            prev_good_index = idx
+            
+        
+        # Check deltas demand and relative wrt hourly adjustment
+        prev_good_delta_dem = abs(df.loc[prev_good_index, value_column] - df.loc[idx, value_column])
+        prev_good_delta_dem_rel_diff_wrt_hourly = abs(df.loc[prev_good_index, 
+                        'dem_rel_diff_wrt_hourly'] - df.loc[idx, 'dem_rel_diff_wrt_hourly'])
+
+        
+        # delta_rolling_IQR is over 5 days on each side so should be
+        # similar regardless of which hours' we use. If delta is
+        # large, mark this hour anomalous
+        if (prev_good_delta_dem > df.loc[idx, 'delta_rolling_IQR'] * multiplier) and \
+                (prev_good_delta_dem_rel_diff_wrt_hourly > rel_multiplier * iqr_relative_deltas):
+            
+            
+            deltaSingleFiltered[-1] = df.loc[idx, value_column]
+            df.loc[idx, value_column] = np.nan
+            df.loc[idx, 'category'] = 'SINGLE_DELTA'
+        else:
+            prev_good_index = idx
+
+    to_app = [val for val in reversed(deltaSingleFiltered)]
+    df['deltaSingleFilteredBkw'] = to_app
+    
+    return df
+
+
+def filter_anomalous_regions(df, width, anomalous_pct, value_column):
+    
+    percent_good_data_cnt = [0. for _ in df.index]
+    percent_good_data_pre = [0. for _ in df.index]
+    percent_good_data_post = [0. for _ in df.index]
+    df['len_good_data'] = [0 for _ in df.index]
+    data_quality_cnt = []
+    data_quality_short = []
+    start_good_data = np.nan
+    end_good_data = np.nan
+    for idx in df.index:
+            
+        # Remove the oldest item in the list
+        if len(data_quality_short) > width:
+            data_quality_short.pop(0)
+        if len(data_quality_cnt) > 2 * width:
+            data_quality_cnt.pop(0)
+        
+        # Add new item and don't count MISSING as 'bad' data
+        if df.loc[idx, 'category'] == 'OKAY' or df.loc[idx, 'category'] == 'MISSING':
+            data_quality_cnt.append(1)
+            data_quality_short.append(1)
+            # Track length of good data chunks
+            if np.isnan(start_good_data):
+                start_good_data = idx
+            end_good_data = idx
+        else:
+            data_quality_cnt.append(0)
+            data_quality_short.append(0)
+            # Fill in length of good data chunk
+            if not (np.isnan(start_good_data) or np.isnan(end_good_data)):
+                len_good = end_good_data - start_good_data + 1
+                df.loc[start_good_data:end_good_data, 'len_good_data'] = len_good
+            start_good_data = np.nan
+            end_good_data = np.nan
+
+        
+        # centered measurements have length 2 * width
+        if len(data_quality_cnt) > 2 * width:
+            percent_good_data_cnt[idx-width] = np.mean(data_quality_cnt)
+        # left and right / pre and post measurements have length = width + 1
+        if len(data_quality_short) > width:
+            percent_good_data_pre[idx] = np.mean(data_quality_short)
+            percent_good_data_post[idx-width] = np.mean(data_quality_short)
+
+
+
+    
+    anomalousRegionsFiltered = [np.nan for _ in df.index]
+    for idx in df.index:
+        if percent_good_data_cnt[idx] <= anomalous_pct:
+            for j in range(idx-width, idx+width):
+                if j < 1 or j >= len(df.index):
+                    continue
+                if df.loc[j, 'category'] == 'OKAY':
+                    # If this is the start or end of continuous good data, don't filter
+                    if percent_good_data_pre[j] == 1.0 or percent_good_data_post[j] == 1.0:
+                        continue
+                    if df.loc[j, 'len_good_data'] > width:
+                        continue
+                    df.loc[j, 'category'] = 'ANOMALOUS_REGION'
+                    anomalousRegionsFiltered[j] = df.loc[j, value_column]
+                    df.loc[j, value_column] = np.nan
+    
+
+    df['anomalousRegionsFiltered'] = anomalousRegionsFiltered
+    return df
+
+
+def add_hourly_median_dem_deviations(df, nDays):
+    # Create a df to hold all values to take nanmedian later
+    vals_dem_minus_rolling = df['dem_minus_rolling']
+    # Loop over nDays days on each side
+    for i in range(-nDays, nDays+1):
+        # Already initialized with zero value
+        if i == 0:
+            continue
+        vals_dem_minus_rolling = pd.concat(
+            [vals_dem_minus_rolling, df.shift(periods=i*24)['dem_minus_rolling']], axis=1)
+
+    df['vals_dem_minus_rolling'] = vals_dem_minus_rolling.median(axis=1, skipna=True)
+    # 1+vals to make it a scale factor
+    return df.assign(hourly_median_dem_dev=1.+df['vals_dem_minus_rolling']/df['rollingDemLong'])
+
+
+def filter_global_plus_minus_one(df, value_column):
+    globalDemPlusMinusFiltered = [np.nan for _ in df.index]
+    for idx in df.index:
+        if df.loc[idx, 'category'] == 'GLOBAL_DEM':
+            if df.loc[idx-1, 'category'] == 'OKAY':
+                df.loc[idx-1, 'category'] = 'GLOBAL_DEM_PLUS_MINUS'
+                globalDemPlusMinusFiltered[idx-1] = df.loc[idx-1, value_column]
+                df.loc[idx-1, value_column] = np.nan
+            if df.loc[idx+1, 'category'] == 'OKAY':
+                df.loc[idx+1, 'category'] = 'GLOBAL_DEM_PLUS_MINUS'
+                globalDemPlusMinusFiltered[idx+1] = df.loc[idx+1, value_column]
+                df.loc[idx+1, value_column] = np.nan
+    df['globalDemPlusMinusFiltered'] = globalDemPlusMinusFiltered
+    return df
+
+
+def add_rolling_dem(df, short_hour_window, value_column):
+    df["rollingDem"] = df[value_column].rolling(
+        short_hour_window * 2, min_periods=1, center=True
+    ).median()
+    return df
+
+
+def add_rolling_dem_long(df, nDays, value_column):
+    df["rollingDemLong"] = df[value_column].rolling(
+        nDays * 24 * 2, min_periods=1, center=True
+    ).median()
+    return df
+
+
+def add_demand_minus_rolling_dem_iqr(df, iqr_hours):
+    rolling_window = df["dem_minus_rolling"].rolling(iqr_hours * 2, min_periods=1, center=True)
+    df["dem_minus_rolling_IQR"] = rolling_window.quantile(0.75) - rolling_window.quantile(0.25)
+    return df
+
+
+def add_rolling_delta_iqr(df, iqr_hours):
+    rolling_window = df["delta_pre"].rolling(iqr_hours * 2, min_periods=1, center=True)
+    df["delta_rolling_IQR"] = rolling_window.quantile(0.75) - rolling_window.quantile(0.25)
+    return df
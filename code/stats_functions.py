@@ -1,4 +1,32 @@
 import numpy as np
+import pandas as pd
+
+
+def _group_codes(df, groupby_columns:list):
+    """
+    Numbers the groups of the rows of a dataframe, in the sorted order of groupby
+    Args:
+        df: pandas dataframe
+        groupby_columns: list of column names to group the data by
+    Returns:
+        codes: integer group of each row, or -1 for rows with a missing group key (dropped by groupby)
+        keys: MultiIndex with the key of each group
+    """
+    level_codes = []
+    levels = []
+    for column in groupby_columns:
+        column_codes, uniques = pd.factorize(df[column], sort=True)
+        level_codes.append(column_codes)
+        levels.append(uniques)
+    has_key = np.all([column_codes >= 0 for column_codes in level_codes], axis=0) if level_codes else \
+        np.ones(len(df.index), dtype=bool)
+    shape = [max(len(uniques), 1) for uniques in levels]
+    combined = np.ravel_multi_index([column_codes[has_key] for column_codes in level_codes], shape)
+    unique_combined, inverse = np.unique(combined, return_inverse=True)
+    codes = np.full(len(df.index), -1, dtype=np.int64)
+    codes[has_key] = inverse.ravel()
+    keys = pd.MultiIndex(levels=levels, codes=list(np.unravel_index(unique_combined, shape)), names=groupby_columns)
+    return codes, keys
 
 
 def cov(df, groupby_columns:list, value_column:str):
@@ -12,21 +40,119 @@ def cov(df, groupby_columns:list, value_column:str):
         result: a pandas df with grouped statistics for count, mean, population standard deviation, and cov
     """
 
-    # define a function to calculate the population standard deviation with ddof=0
-    std_p = lambda x: x.std(ddof=0)
-    std_p.__name__ = 'std_p'
+    # the moments of each group are accumulated in one vectorized pass, see GroupedMoments
+    return GroupedMoments(groupby_columns, value_column).update(df).result()
 
-    columns_to_keep = groupby_columns + [value_column]
 
-    df = df.copy()[columns_to_keep]
-
-    result = df.groupby(groupby_columns).agg(['count','mean',std_p])
-
-    result = result.droplevel(level=0, axis=1)
-
-    result['cov'] = result['std_p'] / result['mean']
+class GroupedMoments:
+    """
+    Accumulates the count, mean and sum of squared deviations (M2) of a value column for each group, so that the
+    statistics returned by cov can be calculated from data that is read or processed in chunks.
+
+    Each chunk is summarized in arrays and combined with the groups seen so far with the parallel update of
+    Chan et al., and the accumulators of separate chunks, files or worker processes can be merged the same way.
+
+    Usage:
+        moments = GroupedMoments(['ba', 'year'], 'ef')
+        for chunk in pd.read_csv(path, chunksize=100000):
+            moments.update(chunk)
+        moments.merge(moments_from_another_file)
+        result = moments.result()
+    """
 
-    return result
+    def __init__(self, groupby_columns:list, value_column:str):
+        self.groupby_columns = list(groupby_columns)
+        self.value_column = value_column
+        # group keys, as a MultiIndex with one level per groupby column, and the moments of each group
+        self.index = None
+        self.count = np.zeros(0, dtype=np.int64)
+        self.mean = np.zeros(0)
+        self.m2 = np.zeros(0)
+
+    def update(self, df):
+        """
+        Adds the rows of a dataframe to the accumulated moments. Rows with a missing group key are skipped, as in
+        groupby, and missing values are not counted
+        Returns:
+            self
+        """
+        codes, keys = _group_codes(df, self.groupby_columns)
+        values = df[self.value_column].to_numpy(dtype=np.float64)
+        valid = (codes >= 0) & ~np.isnan(values)
+        codes, values = codes[valid], values[valid]
+
+        n_groups = len(keys)
+        count = np.bincount(codes, minlength=n_groups)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(codes, weights=values, minlength=n_groups) / count
+        # deviations from the mean of the chunk, which keeps M2 accurate
+        m2 = np.bincount(codes, weights=(values - mean[codes]) ** 2, minlength=n_groups)
+        return self._combine(keys, count, mean, m2)
+
+    def merge(self, other):
+        """
+        Adds the moments accumulated by another GroupedMoments to this one
+        Returns:
+            self
+        """
+        if other.index is None:
+            return self
+        return self._combine(other.index, other.count, other.mean, other.m2)
+
+    def _combine(self, index, count, mean, m2):
+        """
+        Combines the moments of the groups in index with the accumulated moments
+        """
+        if self.index is None:
+            self.index, self.count, self.mean, self.m2 = index, count.astype(np.int64), mean, m2
+            return self
+
+        keys = self.index.append(index).unique()
+        count_a = np.zeros(len(keys), dtype=np.int64)
+        count_b = np.zeros(len(keys), dtype=np.int64)
+        mean_a = np.zeros(len(keys))
+        mean_b = np.zeros(len(keys))
+        m2_total = np.zeros(len(keys))
+        a = keys.get_indexer(self.index)
+        b = keys.get_indexer(index)
+        count_a[a], mean_a[a] = self.count, np.nan_to_num(self.mean)
+        count_b[b], mean_b[b] = count, np.nan_to_num(mean)
+        m2_total[a] += self.m2
+        m2_total[b] += m2
+
+        total = count_a + count_b
+        delta = mean_b - mean_a
+        with np.errstate(invalid='ignore', divide='ignore'):
+            combined_mean = np.where(total > 0, mean_a + delta * count_b / total, np.nan)
+            m2_total += np.where(total > 0, delta ** 2 * count_a * count_b / total, 0.)
+
+        self.index, self.count, self.mean, self.m2 = keys, total, combined_mean, m2_total
+        return self
+
+    def result(self):
+        """
+        Returns the statistics of each group, as returned by cov: a pandas df indexed by the group keys with
+        count, mean, population standard deviation (std_p) and cov
+        """
+        if self.index is None:
+            index = pd.MultiIndex.from_arrays([[]] * len(self.groupby_columns), names=self.groupby_columns)
+        else:
+            index = self.index.set_names(self.groupby_columns)
+        order = index.argsort() if len(index) > 0 else np.zeros(0, dtype=np.int64)
+        index = index[order]
+        if len(self.groupby_columns) == 1:
+            index = index.get_level_values(0)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std_p = np.sqrt(self.m2 / self.count)
+        result = pd.DataFrame({'count': self.count.astype(np.int64), 'mean': self.mean, 'std_p': std_p},
+                              index=np.arange(len(self.count)))
+        result = result.iloc[order]
+        result.index = index
+
+        result['cov'] = result['std_p'] / result['mean']
+
+        return result
 
 
 def mae(df, y:str, yhats:list):
@@ -128,4 +254,93 @@ def mse(df, y:str, yhats:list):
     #sum the values and take the average
     df = df.mean()
 
-    return df   
\ No newline at end of file
+    return df   
+
+def _group_sums(values, starts, group_ids, n_groups):
+    """
+    Sums the rows of a 2d array within each group
+    Args:
+        values: 2d array of rows x columns, with the rows sorted by group
+        starts: position of the first row of each group that has rows
+        group_ids: group of each of the starts
+        n_groups: number of groups
+    Returns:
+        sums: array of n_groups x columns, with 0 for groups that have no rows
+    """
+    sums = np.zeros((n_groups, values.shape[1]))
+    if len(starts) > 0:
+        sums[group_ids] = np.add.reduceat(values, starts, axis=0)
+    return sums
+
+
+def error_metrics(df, y:str, yhats:list, groupby_columns:list=None, columns_per_block:int=512):
+    """
+    Calculates the MAE, MAPE, MPE, MSE and RMSE of each estimate in one pass over the data, optionally by group.
+    The errors are calculated as in mae, mape, mpe and mse: missing values are skipped, and the percentage errors
+    of rows where y is 0 are counted as 0
+    Args:
+        df: pandas dataframe
+        y: name of column with actual data
+        yhats: list of column names with estimated data
+        groupby_columns: list of column names to group the data by. If None, the errors are calculated over all rows
+        columns_per_block: number of estimate columns to calculate at once, which bounds the memory used
+    Returns:
+        result: tidy dataframe with one row per group and estimate, with the group columns, the 'estimate' column
+            name, the number of non-missing errors ('count') and the 'mae', 'mape', 'mpe', 'mse' and 'rmse'
+    """
+    actual = df[y].to_numpy(dtype=np.float64)[:, np.newaxis]
+    if groupby_columns is None:
+        codes = np.zeros(len(actual), dtype=np.int64)
+        groups = None
+        n_groups = 1
+    else:
+        # rows with a missing group key are dropped, as in groupby
+        codes, groups = _group_codes(df, groupby_columns)
+        n_groups = len(groups)
+    # sort the rows by group once, so that each group is a contiguous run of rows
+    keep = np.flatnonzero(codes >= 0)
+    order = keep[np.argsort(codes[keep], kind='stable')]
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.diff(sorted_codes, prepend=-1))
+    group_ids = sorted_codes[starts]
+    actual = actual[order]
+
+    metrics = {'count': [], 'mae': [], 'mape': [], 'mpe': [], 'mse': []}
+    for start in range(0, len(yhats), columns_per_block):
+        block = list(yhats[start:start + columns_per_block])
+        estimates = df[block].to_numpy(dtype=np.float64)[order]
+
+        difference = estimates - actual
+        with np.errstate(invalid='ignore', divide='ignore'):
+            percentage = difference / actual
+        # inf percentages (y is 0) count as 0, while 0 / 0 is missing
+        percentage[np.isinf(percentage)] = 0.
+        valid = ~np.isnan(difference)
+        valid_percentage = ~np.isnan(percentage)
+        difference[~valid] = 0.
+        percentage[~valid_percentage] = 0.
+
+        def group_sums(values):
+            return _group_sums(values, starts, group_ids, n_groups)
+
+        count = group_sums(valid.astype(np.float64))
+        count_percentage = group_sums(valid_percentage.astype(np.float64))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            metrics['count'].append(count)
+            metrics['mae'].append(group_sums(np.abs(difference)) / count)
+            metrics['mape'].append(group_sums(np.abs(percentage)) / count_percentage)
+            metrics['mpe'].append(group_sums(percentage) / count_percentage)
+            metrics['mse'].append(group_sums(difference ** 2) / count)
+
+    # one row per group and estimate, with the estimates of each group together
+    result = pd.DataFrame({metric: np.concatenate(blocks, axis=1).ravel() if blocks else np.array([])
+                           for metric, blocks in metrics.items()})
+    result['count'] = result['count'].astype(np.int64)
+    result['rmse'] = np.sqrt(result['mse'])
+    result.insert(0, 'estimate', np.tile(list(yhats), n_groups))
+    if groupby_columns is not None:
+        keys = groups.to_frame(index=False)
+        keys.columns = groupby_columns
+        result = pd.concat([keys.iloc[np.repeat(np.arange(n_groups), len(yhats))].reset_index(drop=True), result],
+                           axis='columns')
+    return result
@@ -0,0 +1,135 @@
+"""
+Generates synthetic hourly demand data with known anomalies
+
+Used to benchmark the screening filters in screening.py and to measure how well they detect each kind of anomaly.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# types of anomalies that can be injected, with the number of events per 8760 hours
+ANOMALY_RATES = {'zero': 5,
+                 'run': 5,
+                 'spike': 20,
+                 'single_delta': 20,
+                 'anomalous_region': 3}
+
+# screening categories that are meant to catch each type of anomaly
+EXPECTED_CATEGORIES = {'zero': ['NEG_OR_ZERO'],
+                       'run': ['IDENTICAL_RUN'],
+                       'spike': ['GLOBAL_DEM', 'LOCAL_DEM_UP', 'LOCAL_DEM_DOWN', 'DELTA'],
+                       'single_delta': ['SINGLE_DELTA', 'LOCAL_DEM_UP', 'LOCAL_DEM_DOWN'],
+                       'anomalous_region': ['ANOMALOUS_REGION']}
+
+
+def demand_shape(index, base=1000., seasonal_amplitude=0.25, weekend_factor=0.85, noise=0.02, rng=None):
+    """
+    Creates a demand profile with seasonal, weekly and diurnal shape plus multiplicative noise
+    Args:
+        index: pandas DatetimeIndex of hourly timestamps
+        base: average demand
+        seasonal_amplitude: relative difference between peak (summer and winter) and shoulder season demand
+        weekend_factor: demand on weekends relative to weekdays
+        noise: standard deviation of the relative noise added to each hour
+        rng: numpy random Generator
+    Returns:
+        demand: numpy array of demand values
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    day_of_year = index.dayofyear.to_numpy()
+    hour = index.hour.to_numpy()
+
+    # two seasonal peaks, in summer and in winter
+    seasonal = 1 + seasonal_amplitude * np.cos(4 * np.pi * (day_of_year - 15) / 365)
+    weekly = np.where(index.dayofweek.to_numpy() >= 5, weekend_factor, 1.)
+    # morning and evening peaks with a trough overnight
+    diurnal = 1 + 0.15 * np.exp(-((hour - 8) ** 2) / 8) + 0.3 * np.exp(-((hour - 18) ** 2) / 10) \
+        - 0.2 * np.exp(-((hour - 3) ** 2) / 6)
+
+    return base * seasonal * weekly * diurnal * (1 + rng.normal(0, noise, len(index)))
+
+
+def inject_anomalies(demand, rates=ANOMALY_RATES, rng=None):
+    """
+    Injects anomalies into a demand series.
+
+    Each event of each type is placed at a random hour:
+    - zero: one hour set to 0
+    - run: the value of one hour repeated for the next 3 to 6 hours
+    - spike: one hour multiplied by 1.4-2.5 or 0.2-0.6
+    - single_delta: 2 to 8 consecutive hours multiplied by 1.5 or 0.55
+    - anomalous_region: 30% of the hours in a 4 day stretch multiplied by 0.2-2.0
+    Args:
+        demand: numpy array of demand values
+        rates: dict of the number of events of each type per 8760 hours
+        rng: numpy random Generator
+    Returns:
+        demand: copy of demand with the anomalies injected
+        anomalies: array with the anomaly type of each hour, or '' for hours that were not changed
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    demand = np.array(demand, dtype=np.float64)
+    n_hours = len(demand)
+    anomalies = np.full(n_hours, '', dtype=object)
+
+    def event_starts(anomaly_type, length):
+        n_events = int(round(rates.get(anomaly_type, 0) * n_hours / 8760))
+        # leave at least a day of normal data at each end of the series
+        if n_events == 0 or n_hours - length - 48 <= 24:
+            return []
+        return rng.integers(24, n_hours - length - 24, size=n_events)
+
+    # larger events are injected first so that smaller ones can land inside them
+    for start in event_starts('anomalous_region', 96):
+        hours = start + np.flatnonzero(rng.random(96) < 0.3)
+        demand[hours] *= rng.uniform(0.2, 2.0, size=len(hours))
+        anomalies[hours] = 'anomalous_region'
+
+    for start in event_starts('single_delta', 8):
+        hours = np.arange(start, start + rng.integers(2, 9))
+        demand[hours] *= rng.choice([1.5, 0.55])
+        anomalies[hours] = 'single_delta'
+
+    for start in event_starts('run', 7):
+        hours = np.arange(start + 1, start + 1 + rng.integers(3, 7))
+        demand[hours] = demand[start]
+        anomalies[hours] = 'run'
+
+    for start in event_starts('spike', 1):
+        demand[start] *= rng.choice([rng.uniform(1.4, 2.5), rng.uniform(0.2, 0.6)])
+        anomalies[start] = 'spike'
+
+    for start in event_starts('zero', 1):
+        demand[start] = 0.
+        anomalies[start] = 'zero'
+
+    return demand, anomalies
+
+
+def generate_demand(n_hours=8760, n_series=1, start='2019-01-01', rates=ANOMALY_RATES, seed=None):
+    """
+    Generates one or more hourly demand series with injected anomalies
+    Args:
+        n_hours: number of hours in each series
+        n_series: number of series
+        start: timestamp of the first hour
+        rates: dict of the number of events of each anomaly type per 8760 hours
+        seed: seed for the random number generator
+    Returns:
+        demand: dataframe with one column per series, named demand_0, demand_1, ...
+        anomalies: dataframe with the same shape, with the injected anomaly type of each hour or ''
+    """
+    rng = np.random.default_rng(seed)
+    index = pd.date_range(start=start, periods=n_hours, freq='h', name='datetime_local')
+
+    demand = {}
+    anomalies = {}
+    for i in range(n_series):
+        base = rng.uniform(500, 20000)
+        clean = demand_shape(index, base=base, seasonal_amplitude=rng.uniform(0.1, 0.35), rng=rng)
+        demand[f'demand_{i}'], anomalies[f'demand_{i}'] = inject_anomalies(clean, rates=rates, rng=rng)
+
+    return pd.DataFrame(demand, index=index), pd.DataFrame(anomalies, index=index)